@@ -1,6 +1,8 @@
 """Common code for collocated optimization problems."""
 
 
+import collections
+import inspect
 import itertools
 
 import numpy as np
@@ -8,21 +10,371 @@ import numpy as np
 from . import optim, rk, utils
 
 
+class CollocationFunction:
+    """Collocation function evaluated from a point function of a model.
+    
+    The point function and its sparse derivatives, generated by the model,
+    are evaluated at all collocation points at once and combined across each
+    piece by a batched product with a weight matrix. The work is thus done
+    by dense array operations for any collocation order instead of by code
+    generated for each element, so it scales to high-order pseudospectral
+    pieces. The derivatives are dense within each piece. The interface is
+    that of the generated optimization functions.
+    """
+    
+    point_variables = {'x': 'xp', 'u': 'up'}
+    """Piece-ravelled variables of the point function arguments."""
+    
+    sign = 1
+    """Sign of the weighted point function in the collocation function."""
+    
+    def __init__(self, model, collocation, fname, weights):
+        self.model = model
+        """The underlying model."""
+        
+        self.collocation = collocation
+        """Collocation method of the pieces."""
+        
+        self.fname = fname
+        """Name of the point function."""
+        
+        self.point_fun = getattr(model, fname)
+        """The point function."""
+        
+        self.point_desc = model.point_functions[fname]
+        """Shape and sparse derivatives of the point function."""
+        
+        self.weights = np.asarray(weights)
+        """Weights of the point values in each output row of a piece."""
+        
+        self.point_args = utils.sig_arg_names(self.point_fun)
+        """Names of the point function arguments."""
+        
+        self.fsize = np.prod(self.point_desc['shape'], dtype=int)
+        """Size of the point function output."""
+        
+        args = [self.point_variables.get(a, a) for a in self.point_args]
+        args.append('piece_len')
+        self.__signature__ = inspect.Signature([
+            inspect.Parameter(a, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+            for a in args
+        ])
+        """The object call signature."""
+        
+        self.base_shapes = {}
+        """Base (non-vectorized) shapes of the decision variables."""
+        
+        for arg in self.point_args:
+            shape = model.base_shapes.get(arg)
+            if shape is None:
+                continue
+            elif arg in self.point_variables:
+                shape = (collocation.n,) + shape
+            self.base_shapes[self.point_variables.get(arg, arg)] = shape
+    
+    @property
+    def __name__(self):
+        return type(self).__name__
+    
+    @property
+    def fused(self):
+        """Whether the point function has a fused derivatives function."""
+        return 'fused' in self.point_desc
+    
+    def fused_val(self, *args):
+        """Fused point function output at all collocation points."""
+        fused_fun = getattr(self.model, self.point_desc['fused']['name'])
+        return fused_fun(*self._point_arguments(args))
+    
+    def _point_arguments(self, args):
+        """Point function arguments at all collocation points of the pieces.
+        
+        The arguments which are not defined at the points are broadcast.
+        """
+        point_args = []
+        for name, arg in zip(self.point_args, args):
+            if name not in self.point_variables:
+                base_ndim = len(self.model.base_shapes.get(name, ()))
+                arg = np.expand_dims(arg, -base_ndim - 1)
+            point_args.append(arg)
+        return point_args
+    
+    def _weighted(self, point_val, piece_len):
+        """Weighted sum of (..., npieces, ncol, m) point values of pieces."""
+        piece_len = np.asarray(piece_len)[..., None, None]
+        return self.sign * piece_len * np.matmul(self.weights, point_val)
+    
+    def _weighted_fun(self, *args, fused=None):
+        """Weighted point function, with the output rows of each piece."""
+        if fused is None:
+            val = self.point_fun(*self._point_arguments(args))
+            val = np.reshape(val, np.shape(val)[:val.ndim - len(
+                self.point_desc['shape'])] + (self.fsize,))
+        else:
+            blocks = self.point_desc['fused']['blocks']
+            val = fused[..., slice(*blocks[self.fname])]
+        return self._weighted(val, args[-1])
+    
+    def _pattern(self, wrt, dname):
+        """Nonzero indices of a point derivative and its identity elements.
+        
+        Returns the indices of the derivative, with the arguments' rows
+        followed by the output's, and a mask of the elements whose
+        collocation function derivatives include the identity, or None.
+        """
+        if dname is None:
+            return np.zeros((len(wrt) + 1, 0), int), None
+        return getattr(self.model, f'{dname}_ind'), None
+    
+    def _sparse_deriv_nnz(self, deriv, dec_shapes, out_shape):
+        out_ext = out_shape[:len(out_shape) - len(self.out_shape)]
+        nnz = 0
+        for wrt, dname in deriv.items():
+            nrows, ncol = self.weights.shape
+            piece_nnz = self._pattern(wrt, dname)[0].shape[1] * nrows
+            if any(w in self.point_variables for w in wrt):
+                piece_nnz *= ncol
+            nnz += piece_nnz * np.prod(out_ext, dtype=int)
+        return nnz
+    
+    def _sparse_deriv_ind(self, deriv, dec_shapes, out_shape):
+        nrows, ncol = self.weights.shape
+        out_ext = out_shape[:len(out_shape) - len(self.out_shape)]
+        out_sz = np.prod(self.out_shape, dtype=int)
+        piece = np.arange(np.prod(out_ext, dtype=int)).reshape(out_ext)
+        ret = collections.OrderedDict()
+        for wrt, dname in deriv.items():
+            # Indices over the (nrows, [ncol,] nnz) grid of each piece
+            point_ind = self._pattern(wrt, dname)[0]
+            row = np.arange(nrows)[:, None]
+            point = 0
+            grid = (nrows, point_ind.shape[1])
+            if any(w in self.point_variables for w in wrt):
+                row = row[..., None]
+                point = np.arange(ncol)[:, None]
+                grid = (nrows, ncol, point_ind.shape[1])
+            
+            ind = []
+            for w, w_ind in zip(wrt, point_ind):
+                name = self.point_variables.get(w, w)
+                base_shape = self.base_shapes[name]
+                if w in self.point_variables:
+                    w_ind = point * np.prod(base_shape[1:], dtype=int) + w_ind
+                w_shape = dec_shapes.get(name, base_shape)
+                w_ext = w_shape[:len(w_shape) - len(base_shape)]
+                w_offs = np.arange(np.prod(w_ext, dtype=int)).reshape(w_ext)
+                w_offs = np.broadcast_to(w_offs, out_ext)
+                w_offs = w_offs * np.prod(base_shape, dtype=int)
+                w_ind = np.broadcast_to(w_ind, grid).ravel()
+                ind.append(w_ind + w_offs[..., None])
+            
+            out_ind = np.broadcast_to(row * self.fsize + point_ind[-1], grid)
+            ind.append(out_ind.ravel() + piece[..., None] * out_sz)
+            ret[self._collocation_wrt(wrt)] = np.array(ind)
+        return ret
+    
+    def _collocation_wrt(self, wrt):
+        return tuple(self.point_variables.get(w, w) for w in wrt)
+    
+    def _point_deriv_values(self, dnames, point_args, fused=None):
+        """Values of point function derivatives, by derivative name.
+        
+        They are views of the `fused_val` output `fused`, if given.
+        """
+        layout = self.point_desc.get('fused')
+        dnames = [dname for dname in dnames if dname is not None]
+        return self.model.sparse_values(layout, dnames, *point_args, 
+                                        fused=fused)
+    
+    def _deriv_val(self, wrt, dname, args, point_vals):
+        """Values of a derivative, with the nonzeros of each piece last."""
+        point_ind, identity = self._pattern(wrt, dname)
+        if dname is None:
+            shape = np.shape(args[self.args.index('xp')])[:-1]
+            val = np.zeros(shape + (0,))
+        else:
+            val = point_vals[dname]
+        
+        # Pad with the structural zeros of the identity elements
+        missing = point_ind.shape[1] - val.shape[-1]
+        if missing:
+            padding = np.zeros(val.shape[:-1] + (missing,))
+            val = np.concatenate([val, padding], axis=-1)
+        
+        piece_len = np.asarray(args[-1])
+        if any(w in self.point_variables for w in wrt):
+            weights = self.sign * self.weights[..., None]
+            piece_len = piece_len[..., None, None, None]
+            val = piece_len * weights * val[..., None, :, :]
+            if identity is not None:
+                val = val + self.identity[..., None] * identity
+            return val.reshape(val.shape[:-3] + (-1,))
+        else:
+            val = self._weighted(val, piece_len)
+            return val.reshape(val.shape[:-2] + (-1,))
+    
+    def _sparse_deriv_val(self, deriv, args, out=None, fused=None):
+        point_args = self._point_arguments(args)
+        point_vals = self._point_deriv_values(deriv.values(), point_args, 
+                                              fused)
+        vals = [self._deriv_val(wrt, dname, args, point_vals)
+                for wrt, dname in deriv.items()]
+        if out is None:
+            return collections.OrderedDict(
+                (self._collocation_wrt(wrt), val)
+                for wrt, val in zip(deriv, vals)
+            )
+        
+        if not isinstance(out, np.ndarray):
+            assert len(out) == len(vals)
+            for block_out, val in zip(out, vals):
+                block_out[...] = val.reshape(block_out.shape)
+            return out
+        
+        batch_shape = out.shape[:-1]
+        offset = 0
+        for val in vals:
+            val = val.reshape(batch_shape + (-1,))
+            out[..., offset:offset + val.shape[-1]] = val
+            offset += val.shape[-1]
+        assert offset == out.shape[-1]
+        return out
+    
+    @property
+    def args(self):
+        """Argument names."""
+        return tuple(self.__signature__.parameters)
+    
+    @property
+    def _hess(self):
+        return collections.OrderedDict(self.point_desc['hess'])
+    
+    def hess_nnz(self, dec_shapes, out_shape):
+        return self._sparse_deriv_nnz(self._hess, dec_shapes, out_shape)
+    
+    def hess_ind(self, dec_shapes, out_shape):
+        return self._sparse_deriv_ind(self._hess, dec_shapes, out_shape)
+    
+    def hess_val(self, *args, out=None, fused=None):
+        return self._sparse_deriv_val(self._hess, args, out, fused)
+
+
+class CollocationDefects(CollocationFunction):
+    """Collocation defects `e` evaluated from the ODE function `f`."""
+    
+    sign = -1
+    
+    def __init__(self, model, collocation):
+        super().__init__(model, collocation, 'f', collocation.J)
+        
+        self.out_shape = (collocation.ninterv,) + self.point_desc['shape']
+        """Function output base shape."""
+        
+        ninterv = collocation.ninterv
+        self.identity = np.eye(ninterv, collocation.n, 1)
+        self.identity -= np.eye(ninterv, collocation.n)
+        """Coefficients of the piece-ravelled states in the defects."""
+    
+    def __call__(self, *args, fused=None):
+        xp = np.asarray(args[self.args.index('xp')])
+        weighted = self._weighted_fun(*args, fused=fused)
+        defects = xp[..., 1:, :] - xp[..., :-1, :] + weighted
+        return defects.reshape(defects.shape[:-1] + self.point_desc['shape'])
+    
+    def _pattern(self, wrt, dname):
+        point_ind, identity = super()._pattern(wrt, dname)
+        if wrt != ('x',):
+            return point_ind, identity
+        
+        # Include the state derivatives' diagonal for the identity elements
+        diagonal = point_ind[0, point_ind[0] == point_ind[1]]
+        missing = np.setdiff1d(np.arange(self.fsize), diagonal)
+        point_ind = np.concatenate([point_ind, [missing, missing]], axis=1)
+        return point_ind, point_ind[0] == point_ind[1]
+    
+    @property
+    def _jac(self):
+        jac = collections.OrderedDict(self.point_desc['jac'])
+        jac.setdefault(('x',), None)
+        return jac
+    
+    def jac_nnz(self, dec_shapes, out_shape):
+        return self._sparse_deriv_nnz(self._jac, dec_shapes, out_shape)
+    
+    def jac_ind(self, dec_shapes, out_shape):
+        return self._sparse_deriv_ind(self._jac, dec_shapes, out_shape)
+    
+    def jac_val(self, *args, out=None, fused=None):
+        return self._sparse_deriv_val(self._jac, args, out, fused)
+
+
+class CollocationQuadrature(CollocationFunction):
+    """Integral `IL` of the running cost `L` by collocation quadrature."""
+    
+    out_shape = ()
+    """Function output base shape."""
+    
+    def __init__(self, model, collocation):
+        super().__init__(model, collocation, 'L', collocation.K[None])
+    
+    def __call__(self, *args, fused=None):
+        return self._weighted_fun(*args, fused=fused)[..., 0, 0]
+    
+    def grad(self, *args, fused=None):
+        point_args = self._point_arguments(args)
+        piece_len = np.asarray(args[-1])[..., None, None]
+        jac = self.point_desc['jac']
+        point_vals = self._point_deriv_values(jac.values(), point_args, fused)
+        ret = collections.OrderedDict()
+        for (w,), dname in jac.items():
+            name = self.point_variables.get(w, w)
+            w_ind = getattr(self.model, f'{dname}_ind')[0]
+            w_size = np.prod(self.model.base_shapes[w], dtype=int)
+            val = point_vals[dname]
+            dense = np.zeros(val.shape[:-1] + (w_size,))
+            dense[..., w_ind] = val
+            dense *= self.sign * piece_len * self.weights[0, :, None]
+            if w not in self.point_variables:
+                dense = dense.sum(axis=(-3, -2))
+            wrt_shape = np.shape(args[self.args.index(name)])
+            ret[name] = dense.reshape(wrt_shape)
+        return ret
+
+
 class Problem(optim.Problem):
-    """Collocated optimization problem base."""
+    """Collocated optimization problem base.
+    
+    The collocation order can vary across the pieces, e.g., fewer pieces of
+    higher order over smooth segments. The `model` is then a sequence of
+    models of the same system generated with each of the orders in `order`,
+    the collocation order of each piece. The pieces of each order form a
+    group over which the piece functions are vectorized, with the piece
+    variables of the group suffixed by its order, e.g., `xp_3`.
     
-    def __init__(self, model, t):
+    Models generated without the symbolic collocation functions (see
+    `symcol.Model.symbolic_collocation`) can be used with any order, as the
+    collocation functions are then evaluated from their point functions,
+    e.g., for single- or few-piece pseudospectral problems.
+    """
+    
+    point_collocation = {'e': CollocationDefects}
+    """Collocation functions evaluated from the point functions of a model."""
+    
+    def __init__(self, model, t, order=None):
         # Initialize base class
         super().__init__()
         
-        self.model = model
+        models = list(model) if isinstance(model, (list, tuple)) else [model]
+        self.model = models[0]
         """Underlying model."""
         
-        col = rk.LGLCollocation(model.collocation_order)
-        self.collocation = col
-        """Collocation method."""
+        self.models = {m.collocation_order: m for m in models}
+        """Underlying models of each collocation order."""
         
         assert np.ndim(t) == 1
+        self.t = np.asarray(t, float)
+        """Normalized piece boundary time grid."""
+        
         self.piece_len = np.diff(t)
         """Normalized length of each collocation piece."""
         
@@ -31,28 +383,206 @@ class Problem(optim.Problem):
         self.npieces = npieces
         """Number of collocation pieces."""
         
-        self.tc = self.collocation.grid(t)
-        """Normalized collocation time grid."""
+        if order is None:
+            order = self.model.collocation_order
+        self.order = np.array(np.broadcast_to(order, npieces), int)
+        """Collocation order (number of points) of each piece."""
+        
+        self.piece_groups = {n: np.flatnonzero(self.order == n)
+                             for n in np.unique(self.order)}
+        """Indices of the pieces of each collocation order."""
+        
+        missing = self.piece_groups.keys() - self.models.keys()
+        if missing and 'f' not in getattr(self.model, 'point_functions', {}):
+            raise ValueError(f"no model of collocation order {min(missing)}")
+        
+        self.collocations = {n: rk.lgl_collocation(n)
+                             for n in self.piece_groups}
+        """Collocation method of each order."""
         
-        npoints = self.tc.size
+        collocations = list(self.collocations.values())
+        uniform = len(collocations) == 1
+        self.collocation = collocations[0] if uniform else None
+        """Collocation method of all pieces, None if the order varies."""
+        
+        self.piece_start = np.r_[0, np.cumsum(self.order - 1)]
+        """Index of the first collocation point of each piece and the last."""
+        
+        npoints = self.piece_start[-1] + 1
         self.npoints = npoints
         """Total number of collocation points."""
         
+        self.piece_points = {
+            n: self.piece_start[pieces, None] + np.arange(n)
+            for n, pieces in self.piece_groups.items()
+        }
+        """Collocation point indices of the pieces of each order."""
+        
+        self.tc = np.empty(npoints)
+        """Normalized collocation time grid."""
+        
+        self.tc[-1] = self.t[-1]
+        for n, pieces in self.piece_groups.items():
+            points = self.collocations[n].points[:-1]
+            increments = self.piece_len[pieces, None] * points
+            ind = self.piece_points[n][:, :-1]
+            self.tc[ind] = self.t[pieces, None] + increments
+        
+        self.piece_variables = {'piece_len'}
+        """Names of the variables and constants defined for each group."""
+        
+        self._group_piece_len = {
+            self.group_name('piece_len', n): self.piece_len[pieces]
+            for n, pieces in self.piece_groups.items()
+        }
+        self.ext_variables.update(self._group_piece_len)
+        
         # Register problem variables
         self._init_collocation_variables()
         
         # Register problem functions
-        self.add_constraint(model.e, (npieces, col.ninterv, model.nx))
+        for n, group_size, e, args in self.piece_functions('e'):
+            self.add_constraint(e, (group_size, n - 1, self.model.nx), args)
+    
+    def group_name(self, name, n):
+        """Name of the piece variable `name` of the group of order `n`."""
+        return name if self.collocation is not None else f'{name}_{n}'
+    
+    def add_piece_variable(self, name, unravelled):
+        """Register the piece-ravelled views of a collocation point variable.
+        
+        One variable is registered for each group of pieces of the same
+        collocation order.
+        """
+        for n, point_ind in self.piece_points.items():
+            if self.collocation is not None:
+                spec = PieceRavelledVariable(unravelled, self.npieces, n)
+            else:
+                spec = PieceGroupVariable(unravelled, point_ind)
+            self.add_dependent_variable(self.group_name(name, n), spec)
+        self.piece_variables.add(name)
+    
+    def piece_functions(self, name):
+        """Iterate over the model functions `name` of each group of pieces.
+        
+        Yields the collocation order, number of pieces, function and problem
+        variable names of the arguments of each group.
+        """
+        for n, pieces in self.piece_groups.items():
+            fun = self.collocation_function(name, n)
+            args = None
+            if self.collocation is None:
+                args = [self.group_name(arg, n) 
+                        if arg in self.piece_variables else arg
+                        for arg in utils.sig_arg_names(fun)]
+            yield n, len(pieces), fun, args
+    
+    def collocation_function(self, name, n):
+        """The collocation function `name` of the pieces of order `n`.
+        
+        It is the generated function of the model of that order, if any, or
+        else evaluated from the point functions of the model.
+        """
+        model = self.models.get(n, self.model)
+        if model.collocation_order == n and hasattr(model, name):
+            return getattr(model, name)
+        function_class = self.point_collocation[name]
+        return function_class(model, self.collocations[n])
+    
+    @utils.cached_property
+    def point_weights(self):
+        """Quadrature weight of each collocation point over the whole grid."""
+        weights = np.zeros(self.npoints)
+        for n, pieces in self.piece_groups.items():
+            K = self.collocations[n].K
+            weights_n = self.piece_len[pieces, None] * K
+            np.add.at(weights, self.piece_points[n], weights_n)
+        return weights
+    
+    def interpolant(self, values):
+        """Piecewise-polynomial interpolant of values at collocation points.
+        
+        The first axis of `values` indexes the collocation points. Returns a
+        `PiecewiseInterpolant`, which evaluates the collocation polynomials
+        of the pieces at any array of times.
+        """
+        return PiecewiseInterpolant(self, values)
+    
+    def interpolate(self, values, t):
+        """Evaluate the collocation interpolant of point values at times `t`.
+        
+        The first axis of `values` indexes the collocation points. Times
+        outside the problem's horizon are clamped to it.
+        """
+        return self.interpolant(values)(t)
+    
+    def interval_index(self, t):
+        """Index of the collocation interval containing each time in `t`.
+        
+        Times outside the problem's horizon are clamped to it.
+        """
+        ind = np.searchsorted(self.tc, t, 'right') - 1
+        return np.clip(ind, 0, self.npoints - 2)
     
     def _init_collocation_variables(self):
         """Register problem collocation variables."""
         x = self.add_decision('x', (self.npoints, self.model.nx))
-        xp = PieceRavelledVariable(x, self.npieces, self.collocation.n)
-        self.add_dependent_variable('xp', xp)
+        self.add_piece_variable('xp', x)
     
     def variables(self, dvec):
         """Get all variables needed to evaluate problem functions."""
-        return {'piece_len': self.piece_len, **super().variables(dvec)}
+        return {**self._group_piece_len, **super().variables(dvec)}
+
+
+class PiecewiseInterpolant:
+    """Piecewise-polynomial interpolant of a collocated trajectory.
+    
+    The polynomial of each piece is stored as its Legendre series over the
+    piece, padded with zeros to the highest collocation order, and evaluated
+    with Clenshaw's recurrence. Any number of times are thus evaluated with
+    a binary search over the piece boundaries and a fixed number of array
+    operations, for all pieces and orders at once.
+    """
+    
+    def __init__(self, problem, values):
+        values = np.asarray(values)
+        assert values.shape[0] == problem.npoints
+        
+        self.t = problem.t
+        """Piece boundary time grid."""
+        
+        self.piece_len = problem.piece_len
+        """Length of each piece."""
+        
+        dtype = np.result_type(values, float)
+        nmax = max(problem.piece_groups)
+        coef = np.zeros((problem.npieces, nmax) + values.shape[1:], dtype)
+        for n, point_ind in problem.piece_points.items():
+            pieces = problem.piece_groups[n]
+            transform = problem.collocations[n].legendre_transform
+            piece_values = values[point_ind]
+            coef[pieces, :n] = np.einsum('ij,kj...->ki...', transform,
+                                         piece_values)
+        self.coef = coef
+        """Legendre series coefficients of each piece's polynomial."""
+    
+    def __call__(self, t):
+        """Evaluate the interpolant at times `t`.
+        
+        Times outside the interpolant's horizon are clamped to it.
+        """
+        t = np.asarray(t, float)
+        npieces, nmax = self.coef.shape[:2]
+        k = np.searchsorted(self.t, t, 'right') - 1
+        k = np.clip(k, 0, npieces - 1)
+        s = np.clip((t - self.t[k]) / self.piece_len[k], 0, 1)
+        x = np.reshape(2 * s - 1, t.shape + (1,) * (self.coef.ndim - 2))
+        
+        b1 = b2 = 0
+        for j in reversed(range(nmax)):
+            a = (2 * j + 1) / (j + 1) * x
+            b1, b2 = self.coef[k, j] + a * b1 - (j + 1) / (j + 2) * b2, b1
+        return b1
 
 
 class PieceRavelledVariable:
@@ -65,6 +595,10 @@ class PieceRavelledVariable:
         
         self.ncol = ncol
         """Number of collocation points per piece."""
+        
+        piece_offset = np.arange(npieces)[:, None] * (ncol - 1)
+        self.point_ind = piece_offset + np.arange(ncol)
+        """Index of the unravelled point of each piece collocation point."""
     
     @property
     def shape(self):
@@ -74,30 +608,75 @@ class PieceRavelledVariable:
     @property
     def size(self):
         """Total number of elements."""
-        return np.prod(self.shape, dtype=np.intc)
+        return np.prod(self.shape, dtype=int)
+    
+    @utils.cached_property
+    def parent_ind(self):
+        """Index of each element in the parent vector."""
+        return self.convert_ind(np.arange(self.size)).reshape(self.shape)
     
     def unpack_from(self, vec):
-        """Extract component from parent vector."""
+        """Extract component from parent vector.
+        
+        As consecutive pieces share their boundary point, the result is a
+        read-only strided view of the unravelled variable, without copies.
+        """
         ur = self.unravelled.unpack_from(vec)
-        out = np.zeros(self.shape)
-        out[:, :-1].flat = ur[:-1].flat
-        out[:-1, -1] = out[1:, 0]
-        out[-1, -1] = ur[-1]
-        return out
+        ninterv = self.ncol - 1
+        strides = (ninterv * ur.strides[0],) + ur.strides
+        return np.lib.stride_tricks.as_strided(
+            ur, self.shape, strides, writeable=False
+        )
     
     def add_to(self, destination, value):
         value = np.asarray(value)
         assert value.shape == self.shape
         
+        # Scatter directly into the unravelled variable's view of destination
         ninterv = self.ncol - 1
-        dec = np.zeros(self.unravelled.shape)
-        dec[:-1].flat = value[:, :-1].flat
-        dec[ninterv::ninterv] += value[:,-1]
-        self.unravelled.add_to(destination, dec)
+        dec = self.unravelled.unpack_from(destination)
+        assert np.may_share_memory(dec, destination)
+        interior = dec[:-1].reshape((self.npieces, ninterv) + dec.shape[1:])
+        interior += value[:, :-1]
+        dec[ninterv::ninterv] += value[:, -1]
+    
+    def convert_ind(self, rav_ind, dtype=int):
+        """Convert component indices to parent vector indices."""
+        rav_ind = np.asarray(rav_ind, dtype=dtype)
+        piece = rav_ind // np.prod(self.shape[1:], dtype=rav_ind.dtype)
+        ur_ind = rav_ind - piece * np.prod(self.shape[2:], dtype=rav_ind.dtype)
+        return self.unravelled.convert_ind(ur_ind, dtype)
+
+
+class PieceGroupVariable(PieceRavelledVariable):
+    """Piece-ravelled variable over a subset of the collocation pieces.
+    
+    Used for the groups of pieces of the same order when the collocation
+    order varies, whose points are not evenly spaced in the unravelled
+    variable. Unlike in the base class, the unpacked variable is a copy.
+    """
+    
+    def __init__(self, unravelled, point_ind):
+        point_ind = np.asarray(point_ind)
+        super().__init__(unravelled, *point_ind.shape)
+        self.point_ind = point_ind
+    
+    def unpack_from(self, vec):
+        """Extract component from parent vector."""
+        return self.unravelled.unpack_from(vec)[self.point_ind]
+    
+    def add_to(self, destination, value):
+        value = np.asarray(value)
+        assert value.shape == self.shape
+        dec = self.unravelled.unpack_from(destination)
+        assert np.may_share_memory(dec, destination)
+        np.add.at(dec, self.point_ind, value)
     
-    def convert_ind(self, rav_ind):
+    def convert_ind(self, rav_ind, dtype=int):
         """Convert component indices to parent vector indices."""
-        rav_ind = np.asarray(rav_ind, dtype=int)
-        piece = rav_ind // np.prod(self.shape[1:], dtype=int)
-        ur_ind = rav_ind - piece * np.prod(self.shape[2:], dtype=int)
-        return self.unravelled.convert_ind(ur_ind)
+        rav_ind = np.asarray(rav_ind, dtype=dtype)
+        point_sz = np.prod(self.shape[2:], dtype=rav_ind.dtype)
+        point = rav_ind // point_sz
+        ur_point = self.point_ind.ravel()[point].astype(rav_ind.dtype)
+        ur_ind = ur_point * point_sz + (rav_ind - point * point_sz)
+        return self.unravelled.convert_ind(ur_ind, dtype)
@@ -27,9 +27,32 @@ def optimization_meta(name, bases, dict):
         )
         setattr(cls, name, objective)
     
+    cls.sparse_values = sparse_values
     return cls
 
 
+def sparse_values(model, layout, dnames, *args, fused=None, **kwargs):
+    """Values of the sparse derivatives `dnames` of a model function.
+    
+    If the function has a fused value and derivatives function, described
+    by `layout`, the values are views of its output `fused`, which is
+    evaluated from the arguments if not given. Otherwise the value function
+    of each derivative is called.
+    """
+    if layout is None:
+        return collections.OrderedDict(
+            (dname, getattr(model, f'{dname}_val')(*args, **kwargs))
+            for dname in dnames
+        )
+    
+    if fused is None:
+        fused = getattr(model, layout['name'])(*args, **kwargs)
+    blocks = layout['blocks']
+    return collections.OrderedDict(
+        (dname, fused[..., slice(*blocks[dname])]) for dname in dnames
+    )
+
+
 class OptimizationFunction:
     
     out_shape = ()
@@ -38,6 +61,9 @@ class OptimizationFunction:
     out_sz = 1
     """Function output base size."""
     
+    fused = False
+    """Whether the function has a fused value and derivatives function."""
+    
     def __init__(self, model):
         self.model = model
         """The parent model."""
@@ -53,8 +79,16 @@ class OptimizationFunction:
     def __name__(self):
         return type(self).__name__
     
-    def __call__(self, *args, **kwargs):
-        return self.method(self.model, *args, **kwargs)
+    def __call__(self, *args, fused=None, **kwargs):
+        if fused is None:
+            return self.method(self.model, *args, **kwargs)
+        
+        val = fused[..., slice(*self._fused['blocks'][self.__name__])]
+        return val.reshape(val.shape[:-1] + self.out_shape)
+    
+    def fused_val(self, *args, **kwargs):
+        """Value and sparse derivatives, concatenated along the last axis."""
+        return getattr(self.model, self._fused['name'])(*args, **kwargs)
     
     def _shape_ext(self, shape=None, varname=None):
         """Return a variable's shape extension from its base shape."""
@@ -105,11 +139,48 @@ class OptimizationFunction:
             ret[wrt] = np.array(ind)
         return ret
         
-    def _sparse_deriv_val(self, deriv, *args, **kwargs):
-        ret = collections.OrderedDict()
-        for wrt, dname in deriv.items():
-            ret[wrt] = getattr(self.model, f'{dname}_val')(*args, **kwargs)
-        return ret
+    def _sparse_deriv_val(self, deriv, *args, out=None, **kwargs):
+        if out is not None:
+            return self._sparse_deriv_val_into(deriv, out, *args, **kwargs)
+        
+        vals = self._deriv_values(deriv, *args, **kwargs)
+        return collections.OrderedDict(zip(deriv, vals))
+    
+    def _deriv_values(self, deriv, *args, **kwargs):
+        """List of the nonzero values of each derivative.
+        
+        They are taken from the output of `fused_val`, if given as the
+        `fused` keyword argument, or evaluated from the other arguments.
+        """
+        vals = self.model.sparse_values(
+            self._fused, deriv.values(), *args, **kwargs
+        )
+        return list(vals.values())
+    
+    def _sparse_deriv_val_into(self, deriv, out, *args, **kwargs):
+        """Write the nonzero derivatives consecutively along out's last axis.
+        
+        Leading axes of `out` are a batch, matching those of the arguments.
+        Alternatively, `out` can be a sequence with one array per derivative.
+        """
+        vals = self._deriv_values(deriv, *args, **kwargs)
+        if not isinstance(out, np.ndarray):
+            assert len(out) == len(deriv)
+            for val, block_out in zip(vals, out):
+                block_out[...] = val.reshape(block_out.shape)
+            return out
+        
+        batch_shape = out.shape[:-1]
+        offset = 0
+        for val in vals:
+            val_shape = batch_shape + val.shape[len(batch_shape):]
+            size = shape_size(val_shape[len(batch_shape):])
+            block = out[..., offset:offset + size].reshape(val_shape)
+            assert np.may_share_memory(block, out)
+            block[...] = val
+            offset += size
+        assert offset == out.shape[-1]
+        return out
     
     def hess_nnz(self, dec_shapes, out_shape):
         return self._sparse_deriv_nnz(self._hess, dec_shapes, out_shape)
@@ -137,6 +208,12 @@ class OptimizationFunctionMeta(type):
         
         self._hess = collections.OrderedDict(desc['hess'])
         """Second derivatives."""
+        
+        self._fused = desc.get('fused')
+        """Layout of the fused value and derivatives function, if any."""
+        
+        self.fused = self._fused is not None
+        """Whether the function has a fused value and derivatives function."""
     
     def __get__(self, instance, owner=None):
         if instance is None:
@@ -166,7 +243,7 @@ class ObjectiveFunction(OptimizationFunction):
                 wrt_shape = np.shape(args[arg_indices[wrt]])
             
             # Accumulate so the gradient has the same shape as the variable
-            ret[wrt] = grad_val.reshape(-1, *wrt_shape).sum(0)
+            ret[wrt] = sum_to_shape(grad_val, wrt_shape)
         return ret
 
 
@@ -240,6 +317,24 @@ def with_signature(f, sig):
     return new_f
 
 
+def sum_to_shape(a, shape):
+    """Sum an array over the axes along which `shape` was broadcast.
+    
+    >>> sum_to_shape(np.ones((2, 4, 3)), (2, 1, 3)).shape
+    (2, 1, 3)
+    >>> sum_to_shape(np.ones((4, 2, 3)), (3,))
+    array([8., 8., 8.])
+    
+    """
+    a = np.asarray(a)
+    lead = a.ndim - len(shape)
+    axes = tuple(range(lead)) + tuple(
+        lead + i for i, n in enumerate(shape) 
+        if n == 1 and a.shape[lead + i] != 1
+    )
+    return a.sum(axis=axes, keepdims=True).reshape(shape)
+
+
 def shape_size(shape):
     return np.prod(shape, dtype=int)
 
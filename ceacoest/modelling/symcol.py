@@ -44,8 +44,11 @@ class Model(symoptim.Model):
         v['xp'] = [[f'{n}_piece_{k}' for n in x] for k in range(ncol)]
         v['up'] = [[f'{n}_piece_{k}' for n in u] for k in range(ncol)]
         
-        # Register collocation constraint
-        self.add_constraint('e')
+        # Register collocation constraint, or the point function to evaluate it
+        if self.symbolic_collocation:
+            self.add_constraint('e')
+        else:
+            self.add_point_function('f')
         
         # Mark `f` function for code generation
         self.generate_functions.add('f')
@@ -55,10 +58,22 @@ class Model(symoptim.Model):
         """Order of collocation method."""
         return getattr(super(), 'collocation_order', 2)
     
+    @property
+    def symbolic_collocation(self):
+        """Whether to generate the collocation functions symbolically.
+        
+        Otherwise only the point functions, such as `f`, are generated with
+        their derivatives and the problem evaluates the collocation functions
+        with matrix products for any collocation order. This is suited to
+        high-order (pseudospectral) pieces, whose generated collocation
+        functions grow quadratically with the order.
+        """
+        return getattr(super(), 'symbolic_collocation', True)
+    
     @utils.cached_property
     def collocation(self):
         """Collocation method."""
-        return rk.LGLCollocation(self.collocation_order)
+        return rk.lgl_collocation(self.collocation_order)
     
     @property
     def generate_assignments(self):
@@ -31,7 +31,10 @@ class Model(symcol.Model):
         super().__init__(variables, decision)
         
         # Add objectives and constraints
-        self.add_objective('IL')
+        if self.symbolic_collocation:
+            self.add_objective('IL')
+        else:
+            self.add_point_function('L')
         self.add_objective('M')
         self.add_constraint('g')
         self.add_constraint('h')
@@ -4,7 +4,9 @@ import inspect
 import itertools
 
 import numpy as np
+import sym2num.function
 import sym2num.model
+import sym2num.printing
 import sym2num.var
 import sympy
 
@@ -31,6 +33,9 @@ class Model(sym2num.model.Base):
         
         self.objectives = {}
         """Objective function descriptions."""
+        
+        self.point_functions = {}
+        """Descriptions of functions with derivatives, but not in the NLP."""
 
         self.sparse_nzind = {}
         """Nonzero indices of sparse functions"""
@@ -40,13 +45,34 @@ class Model(sym2num.model.Base):
 
         self.generate_functions = set()
         """Names of functions to generate code."""
+        
+        self.cse_functions = set()
+        """Names of functions to generate with common subexpressions."""
 
+    @property
+    def fused_derivatives(self):
+        """Whether to generate fused value and sparse derivatives functions.
+        
+        Each constraint and point function `fname` then has a `{fname}_fused`
+        function computing its value and the nonzeros of its sparse
+        derivatives together, with their common subexpressions evaluated only
+        once, instead of one function per derivative. The model code must be
+        generated with `print_class` or `compile_class` of this module.
+        
+        Objectives are not fused, as their gradients are dense arrays reduced
+        to the variable shapes instead of sparse blocks. With the numerical
+        point collocation, the running cost integral `IL` is fused through
+        its point function `L`.
+        """
+        return getattr(super(), 'fused_derivatives', False)
+    
     @property
     def generate_assignments(self):
         """Dictionary of assignments in generated class code."""
         a = dict(
             constraints=self.constraints, 
             objectives=self.objectives,
+            point_functions=self.point_functions,
             base_shapes={d: self.variables[d].shape for d in self.decision}
         )
         for k, v in self.sparse_nzind.items():
@@ -92,9 +118,35 @@ class Model(sym2num.model.Base):
         desc = dict(shape=fshape, jac=jac, hess=hess)
         self.constraints[fname] = desc
         self.generate_functions.add(fname)
-                
+        self._add_sparse_derivatives(fname, jac, hess, derivatives)
+        if self.fused_derivatives:
+            self.add_fused_function(fname, desc)
+    
+    def add_point_function(self, fname, derivatives=2):
+        """Add a function with sparse derivatives, evaluated pointwise.
+        
+        It is not part of the optimization problem, but its values and
+        derivatives are used to evaluate the problem functions numerically.
+        """
+        fshape = self.default_function_output(fname).shape
+        
+        jac = {}
+        hess = {}
+        desc = dict(shape=fshape, jac=jac, hess=hess)
+        self.point_functions[fname] = desc
+        self.generate_functions.add(fname)
+        self._add_sparse_derivatives(fname, jac, hess, derivatives)
+        if self.fused_derivatives:
+            self.add_fused_function(fname, desc)
+    
+    def _add_sparse_derivatives(self, fname, jac, hess, derivatives):
+        """Add the sparse derivatives of a function wrt decision variables.
+        
+        In fused mode, their separate value functions are not generated.
+        """
         if not derivatives:
             return
+        gen = not self.fused_derivatives
 
         # Get variables needed for derivative calculation
         args = self.function_codegen_arguments(fname)
@@ -104,16 +156,48 @@ class Model(sym2num.model.Base):
         if derivatives >= 1:
             for argname in wrt:
                 derivname = self.first_derivative_name(fname, argname)
-                if self.add_sparse_derivative(fname, argname, derivname):
+                if self.add_sparse_derivative(fname, argname, derivname,
+                                              gen=gen):
                     jac[argname,] = derivname
         
         # Calculate second derivatives
         if derivatives >= 2:
             for pair in itertools.combinations_with_replacement(wrt, 2):
                 derivname = self.second_derivative_name(fname, pair)
-                if self.add_sparse_derivative(fname, pair, derivname):
+                if self.add_sparse_derivative(fname, pair, derivname,
+                                              gen=gen):
                     hess[pair] = derivname
     
+    def add_fused_function(self, fname, desc):
+        """Add the fused value and sparse derivatives function of `fname`.
+        
+        Its output concatenates the raveled value of `fname` and the nonzeros
+        of each of its derivatives in `desc`, whose offsets are saved in the
+        description under `'fused'`.
+        """
+        output = self.default_function_output(fname)
+        exprs = [output[ind] for ind in np.ndindex(*output.shape)]
+        blocks = {fname: (0, len(exprs))}
+        for dname in itertools.chain(desc['jac'].values(),
+                                     desc['hess'].values()):
+            start = len(exprs)
+            exprs.extend(self.default_function_output(f'{dname}_val'))
+            blocks[dname] = (start, len(exprs))
+        
+        # Create symbolic function
+        fused_name = f'{fname}_fused'
+        fargs = self.function_codegen_arguments(fname, include_self=True)
+        fused = sym2num.function.SymbolicSubsFunction(
+            fargs, sympy.Array(exprs, len(exprs))
+        )
+        setattr(self, fused_name, fused)
+        desc['fused'] = dict(name=fused_name, blocks=blocks)
+        
+        # Include in set of functions to generate code, eliminating the
+        # common subexpressions
+        self.generate_functions.add(fused_name)
+        self.cse_functions.add(fused_name)
+    
     def add_sparse_derivative(self, fname, wrt, dname, sel='tril', gen=True):
         if isinstance(wrt, str):
             wrt = (wrt,)
@@ -173,4 +257,71 @@ class Model(sym2num.model.Base):
             return f'd2{fname}_d{wrt[0]}2'
         else:
             return f'd2{fname}_d{wrt[0]}_d{wrt[1]}'
+
+
+class CSEFunctionPrinter(sym2num.function.FunctionPrinter):
+    """Function printer which eliminates common subexpressions."""
+    
+    def print_def(self):
+        """Print the function definition code."""
+        printer = sym2num.printing.Printer()
+        indices = list(np.ndindex(*self.output.shape))
+        symbols = sympy.numbered_symbols('_cse')
+        cse_subs, exprs = sympy.cse([self.output[i] for i in indices], symbols)
+        
+        # Print the expressions before rendering, registering their imports
+        for cse_symbol, cse_expr in cse_subs:
+            printer.doprint(cse_expr)
+        output_code = [(ind, printer.doprint(expr))
+                       for ind, expr in zip(indices, exprs) if expr != 0]
+        
+        context = dict(
+            f=self,
+            printer=printer,
+            np=printer.numpy_alias,
+            output_code=output_code,
+            cse_subs=cse_subs,
+        )
+        return self.template.render(context)
+
+
+class ModelPrinter(sym2num.model.ModelPrinter):
+    """Model code printer with common-subexpression elimination.
     
+    It is applied to the functions in the `cse_functions` of the model, such
+    as the fused value and sparse derivatives functions, which are left out
+    of the functions printed by the base class and appended to its methods.
+    They must be instance methods of the model.
+    """
+    
+    def __init__(self, model, **options):
+        try:
+            functions = options['functions']
+        except KeyError:
+            functions = getattr(model, 'generate_functions', [])
+        cse = getattr(model, 'cse_functions', set())
+        options['functions'] = [f for f in functions if f not in cse]
+        
+        # Initialize base class
+        super().__init__(model, **options)
+        
+        self.cse_functions = [f for f in functions if f in cse]
+        """Names of the functions printed with common subexpressions."""
+    
+    @property
+    def methods(self):
+        yield from super().methods
+        for fname in self.cse_functions:
+            output = self.model.default_function_output(fname)
+            arguments = self.model.function_codegen_arguments(fname)
+            yield CSEFunctionPrinter(fname, output, arguments).print_def()
+
+
+def print_class(model, **options):
+    """Print the code of the generated class of a symbolic model."""
+    return ModelPrinter(model, **options).print_class()
+
+
+def compile_class(model, **options):
+    """Compile the generated class of a symbolic model."""
+    return ModelPrinter(model, **options).class_obj()
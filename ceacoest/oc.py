@@ -1,38 +1,260 @@
 """Optimal control."""
 
 
+import collections
 import itertools
 
 import numpy as np
 
-from . import col, optim, utils
+from . import col, optim, rk, solvers, utils
 
 
 class Problem(col.Problem):
     """Optimal control problem with LGL direct collocation."""
+    
+    point_collocation = {**col.Problem.point_collocation,
+                         'IL': col.CollocationQuadrature}
+    """Collocation functions evaluated from the point functions of a model."""
 
-    def __init__(self, model, t):
-        super().__init__(model, t)
+    def __init__(self, model, t, order=None):
+        super().__init__(model, t, order)
 
-        ncol = self.collocation.n
+        model = self.model
         npoints = self.npoints
-        npieces = self.npieces
         
         # Register decision variables
         x = self.decision['x']
-        u = self.add_decision('u', (npoints, model.nu))
         self.add_decision('p', model.np)
         
         # Define and add dependent variables
-        up = col.PieceRavelledVariable(u, npieces, ncol)
-        self.add_dependent_variable('up', up)
         self.add_dependent_variable('xe', XEVariable(x))
         
         # Register problem functions
-        self.add_objective(model.IL, npieces)
+        for n, group_size, IL, args in self.piece_functions('IL'):
+            self.add_objective(IL, group_size, args)
         self.add_objective(model.M, ())
         self.add_constraint(model.g, (npoints, model.ng))
         self.add_constraint(model.h, model.nh)
+    
+    def _init_collocation_variables(self):
+        """Register problem collocation variables."""
+        super()._init_collocation_variables()
+        u = self.add_decision('u', (self.npoints, self.model.nu))
+        self.add_piece_variable('up', u)
+    
+    def piece_errors(self, dec):
+        """Estimate the relative collocation error of each piece.
+        
+        The state dynamics evaluated on the interpolated states and controls
+        are integrated across each piece with the quadrature of a higher
+        order LGL collocation and compared with the interpolated states. The
+        errors are relative to one plus the largest magnitude of each state.
+        """
+        variables = self.variables(dec)
+        x = variables['x']
+        scale = 1 + np.max(np.abs(x), axis=0)
+        errors = np.zeros(self.npieces)
+        for n, pieces in self.piece_groups.items():
+            fine = rk.lgl_collocation(n + 1)
+            piece_len = self.piece_len[pieces, None]
+            t_fine = self.t[pieces, None] + piece_len * fine.points
+            x_fine = self.interpolate(x, t_fine)
+            u_fine = self.interpolate(variables['u'], t_fine)
+            model = self.models.get(n, self.model)
+            f_fine = model.f(x_fine, u_fine, variables['p'])
+            
+            increments = np.einsum('ij,kjl->kil', fine.J, f_fine)
+            increments *= piece_len[..., None]
+            x_integ = x_fine[:, :1] + np.cumsum(increments, axis=1)
+            rel_err = np.abs(x_integ - x_fine[:, 1:]) / scale
+            errors[pieces] = np.max(rel_err, axis=(1, 2))
+        return errors
+
+
+def refine_mesh(model, t, bounds, dec0, solver='ipopt', tol=1e-6,
+                max_iter=10, max_split=4, order=None, max_order=None,
+                **options):
+    """Solve an optimal control problem with adaptive hp mesh refinement.
+    
+    The problem is solved on the piece grid `t` and the pieces whose
+    estimated error (see `Problem.piece_errors`) exceeds `tol` are refined.
+    A piece of order `n` with error `err` has its order raised by the
+    estimate `ceil(log(err / tol) / log(n))` if a model of the new order
+    is available, and is otherwise split in up to `max_split` equal pieces
+    of the same order, according to the convergence rate of the
+    collocation. The refined problem is warm-started from the
+    interpolated solution and the process repeats until all errors are
+    below the tolerance or for at most `max_iter` refinements.
+    
+    Parameters
+    ----------
+    model :
+        The optimal control model, or a sequence of models of each
+        collocation order, see `col.Problem`.
+    t : (npieces + 1,) array_like
+        Initial piece grid.
+    bounds : callable
+        Function of the problem returning its decision variable and
+        constraint bounds.
+    dec0 : array_like or callable
+        Initial guess of the decision vector, or function of the problem
+        returning it.
+    solver : str
+        Name of the solver, from `solvers.SOLVERS`.
+    order : int or array_like, optional
+        Initial collocation order of each piece, see `col.Problem`.
+    max_order : int, optional
+        Largest collocation order of the raised pieces, by default that of
+        the models. Models which evaluate the collocation from their point
+        functions (see `col.Problem`) can be raised to any order up to it,
+        others only to the orders of the given models.
+    **options :
+        Solver options.
+    
+    Returns
+    -------
+    problem : Problem
+        The problem on the final mesh.
+    decopt : array
+        The solution.
+    info : dict
+        Solver information, with the `piece_errors` of the solution.
+    """
+    models = list(model) if isinstance(model, (list, tuple)) else [model]
+    orders = {m.collocation_order for m in models}
+    if max_order is None:
+        max_order = max(orders)
+    if 'f' in getattr(models[0], 'point_functions', {}):
+        orders.update(range(2, max_order + 1))
+    orders = np.array(sorted(n for n in orders if n <= max_order))
+    
+    t = np.asarray(t, float)
+    warm_start = None
+    for iteration in range(max_iter + 1):
+        problem = Problem(model, t, order)
+        d_bounds, constr_bounds = bounds(problem)
+        nlp = solvers.get(solver)(problem, d_bounds, constr_bounds, **options)
+        if warm_start is not None:
+            dec_init, mult = warm_start.shift(problem)
+            decopt, info = nlp.solve(dec_init, **mult)
+        else:
+            dec_init = dec0(problem) if callable(dec0) else dec0
+            decopt, info = nlp.solve(dec_init)
+        
+        errors = problem.piece_errors(decopt)
+        info['piece_errors'] = errors
+        if np.all(errors <= tol) or iteration == max_iter:
+            return problem, decopt, info
+        
+        # Raise the order of the inaccurate pieces, or split them
+        order = problem.order.copy()
+        nsplit = np.ones(problem.npieces, int)
+        for k in np.flatnonzero(errors > tol):
+            n = problem.order[k]
+            increase = max(1, np.ceil(np.log(errors[k] / tol) / np.log(n)))
+            higher = orders[orders >= n + increase]
+            if higher.size:
+                order[k] = higher[0]
+            else:
+                split = np.ceil((errors[k] / tol) ** (1 / n))
+                nsplit[k] = np.clip(split, 2, max_split)
+        pieces = [np.linspace(ti, tf, n + 1)[:-1]
+                  for ti, tf, n in zip(t[:-1], t[1:], nsplit)]
+        t = np.concatenate(pieces + [t[-1:]])
+        order = np.repeat(order, nsplit)
+        warm_start = WarmStart(problem, decopt, info)
+
+
+class MultiPhaseProblem(optim.Problem):
+    """Optimal control problem with several phases linked by constraints.
+    
+    Each phase is a collocated problem, e.g., an `oc.Problem`, with its own
+    model, collocation order and mesh. Its variables are included in the
+    composite problem with the phase name as prefix, e.g., `ascent_x` for
+    the states of the `ascent` phase, and its objectives and constraints
+    act on them. The decision vector of each phase is a contiguous segment
+    of the composite one, so the derivatives have one block per phase plus
+    the linkage constraints between them.
+    """
+    
+    def __init__(self, phases):
+        super().__init__()
+        
+        self.phases = collections.OrderedDict(phases)
+        """The phase problems, by name."""
+        
+        self.phase_offsets = {}
+        """Offset of each phase in the decision vector."""
+        
+        self.constants = {}
+        """Prefixed problem constants of the phases, e.g., piece lengths."""
+        
+        for name, phase in self.phases.items():
+            prefix = f'{name}_'
+            offset = self.ndec
+            self.phase_offsets[name] = offset
+            for var, spec in phase.decision.items():
+                self.add_decision(prefix + var, spec.shape)
+            for var, spec in phase.remapped.items():
+                shifted = optim.OffsetVariable(spec, offset, phase.ndec)
+                self.add_dependent_variable(prefix + var, shifted)
+            
+            phase_vars = phase.variables(np.zeros(phase.ndec))
+            for var, value in phase_vars.items():
+                if var not in phase.decision and var not in phase.remapped:
+                    self.constants[prefix + var] = value
+            self.ext_variables.update(prefix + v for v in phase.ext_variables)
+            
+            for obj in phase.objectives:
+                args = [prefix + arg for arg in obj.args]
+                self.add_objective(obj.fun, obj.shape, args)
+            for constr in phase.constraints:
+                args = [prefix + arg for arg in constr.args]
+                self.add_constraint(constr.fun, constr.shape, args)
+    
+    def variables(self, dvec):
+        """Get all variables needed to evaluate problem functions."""
+        return {**self.constants, **super().variables(dvec)}
+    
+    def phase_slice(self, name):
+        """Slice of a phase's decision vector in the composite one."""
+        offset = self.phase_offsets[name]
+        return slice(offset, offset + self.phases[name].ndec)
+    
+    def phase_dec(self, name, dvec):
+        """View of a phase's decision vector in a composite one.
+        
+        Can be used with the phase's `variables` to set bounds and initial
+        guesses phase by phase.
+        """
+        return np.asarray(dvec)[..., self.phase_slice(name)]
+    
+    def add_linkage(self, a, b, a_index=(), b_index=()):
+        """Add a constraint linking the elements of two variables.
+        
+        The constraint is the difference between the elements `a_index` of
+        the variable `a` and `b_index` of `b`, to be bounded to zero for
+        continuity or otherwise for jump conditions.
+        """
+        if a == b:
+            raise ValueError("linkage must be between different variables")
+        a_shape = self.variable_spec(a).shape
+        b_shape = self.variable_spec(b).shape
+        a_ind = np.arange(np.prod(a_shape, dtype=int)).reshape(a_shape)
+        b_ind = np.arange(np.prod(b_shape, dtype=int)).reshape(b_shape)
+        linkage = optim.Linkage(a_shape, a_ind[a_index], 
+                                b_shape, b_ind[b_index])
+        self.add_constraint(linkage, linkage.out_shape, [a, b])
+        return self.constraints[-1]
+    
+    def link_states(self, before, after, states=slice(None)):
+        """Add continuity constraints on states between consecutive phases.
+        
+        The final `states` of the phase `before` are linked to the initial
+        ones of the phase `after`.
+        """
+        return self.add_linkage(f'{before}_x', f'{after}_x', 
+                                (-1, states), (0, states))
 
 
 class XEVariable:
@@ -50,25 +272,265 @@ class XEVariable:
     @property
     def size(self):
         """Total number of elements."""
-        return np.prod(self.shape, dtype=np.intc)
+        return np.prod(self.shape, dtype=int)
     
     def unpack_from(self, vec):
         """Extract component from parent vector."""
         x = self.x.unpack_from(vec)
         return x[[0, -1]]
     
+    @utils.cached_property
+    def parent_ind(self):
+        """Index of each element in the parent vector."""
+        return self.convert_ind(np.arange(self.size)).reshape(self.shape)
+    
     def add_to(self, destination, value):
         value = np.asarray(value)
         assert value.shape == self.shape
-        
-        xval = np.zeros(self.x.shape)
-        xval[0] = value[0]
-        xval[-1] = value[-1]
-        self.x.add_to(destination, xval)
+        np.add.at(destination, self.parent_ind, value)
     
-    def convert_ind(self, xe_ind):
-        xe_ind = np.asarray(xe_ind, int)
+    def convert_ind(self, xe_ind, dtype=int):
+        xe_ind = np.asarray(xe_ind, dtype)
         npoints, nx = self.x.shape
         x_final = xe_ind >= nx
-        x_ind = xe_ind + x_final * (npoints - 2) * nx
-        return self.x.convert_ind(x_ind)
+        final_offset = xe_ind.dtype.type((npoints - 2) * nx)
+        x_ind = np.where(x_final, xe_ind + final_offset, xe_ind)
+        return self.x.convert_ind(x_ind, dtype)
+
+
+class WarmStart:
+    """Solution of an optimal control problem, for warm-starting others.
+    
+    Saves the primal solution and the bound and constraint multipliers of a
+    solver run. They are shifted to the time grid of a new problem of the
+    same model with the collocation interpolants, e.g., for receding-horizon
+    solves. The shifted values are given to the solver's `solve` method::
+        
+        dec0, mult = warm_start.shift(new_problem)
+        decopt, info = nlp.solve(dec0, **mult)
+    
+    Times of the new grid beyond the saved horizon take the final values.
+    The multipliers not provided by the solver are left out of the shifted
+    ones, so the new solve starts from its default multipliers instead.
+    """
+    
+    ipopt_options = dict(
+        warm_start_bound_push=1e-9,
+        warm_start_bound_frac=1e-9,
+        warm_start_slack_bound_push=1e-9,
+        warm_start_slack_bound_frac=1e-9,
+        warm_start_mult_bound_push=1e-9,
+    )
+    """IPOPT options to keep the warm-start point close to the original.
+    
+    A small `mu_init` is usually also beneficial for good warm starts.
+    """
+    
+    point_variables = ('x', 'u')
+    """Decision variables defined at the collocation points."""
+    
+    def __init__(self, problem, dec, info):
+        self.problem = problem
+        """The solved problem."""
+        
+        self.dec = np.array(dec, float)
+        """The solution decision vector."""
+        
+        self.mult_g = optional_array(info['mult_g'])
+        """Constraint multipliers, or None if not available."""
+        
+        self.mult_x_L = optional_array(info['mult_x_L'])
+        """Decision variable lower bound multipliers, or None."""
+        
+        self.mult_x_U = optional_array(info['mult_x_U'])
+        """Decision variable upper bound multipliers, or None."""
+    
+    def shift(self, problem, offset=0):
+        """Shift the saved solution to the time grid of `problem`.
+        
+        The grid of `problem` starts `offset` after that of the saved
+        solution. Returns the initial decision vector and a dictionary with
+        the available ones of the `mult_g`, `mult_x_L` and `mult_x_U`
+        multipliers.
+        """
+        tc = problem.tc + offset
+        old = self.problem
+        dec = np.zeros(problem.ndec)
+        mult = {}
+        for name, spec in problem.decision.items():
+            old_spec = old.decision[name]
+            if name in self.point_variables:
+                value = old_spec.unpack_from(self.dec)
+                spec.pack_into(dec, old.interpolate(value, tc))
+            else:
+                spec.pack_into(dec, old_spec.unpack_from(self.dec))
+        
+        for key in ('mult_x_L', 'mult_x_U'):
+            old_mult = getattr(self, key)
+            if old_mult is None:
+                continue
+            new_mult = mult[key] = np.zeros(problem.ndec)
+            for name, spec in problem.decision.items():
+                value = old.decision[name].unpack_from(old_mult)
+                if name in self.point_variables:
+                    value = np.maximum(self._point_mult(value, problem, tc), 0)
+                spec.pack_into(new_mult, value)
+        
+        if self.mult_g is not None:
+            mult['mult_g'] = self._shift_mult_g(problem, tc)
+        return dec, mult
+    
+    def _shift_mult_g(self, problem, tc):
+        """Shift the constraint multipliers to the time grid `tc`."""
+        old = self.problem
+        
+        # The piece constraints are matched by name, as the groups of pieces
+        # of each collocation order may differ, and the others in order
+        interv_mult = self._interval_mult()
+        old_constraints = (constr for constr in old.constraints
+                           if self._constraint_kind(old, constr) != 'piece')
+        mult_g = np.zeros(problem.ncons)
+        for constr in problem.constraints:
+            kind = self._constraint_kind(problem, constr)
+            if kind == 'piece':
+                interv = self._piece_spec(problem, constr).point_ind[:, :-1]
+                mid = (tc[interv] + tc[interv + 1]) / 2
+                value = interv_mult[constr.name][old.interval_index(mid)]
+            else:
+                old_constr = next(old_constraints)
+                value = old_constr.unpack_from(self.mult_g)
+                if kind == 'point':
+                    value = self._point_mult(value, problem, tc)
+            constr.pack_into(mult_g, value.reshape(constr.shape))
+        return mult_g
+    
+    def _point_mult(self, value, problem, tc):
+        """Shift the multipliers of a constraint at the collocation points.
+        
+        The multipliers scale with the quadrature weight of their points, so
+        their densities are interpolated instead.
+        """
+        old = self.problem
+        bcast = (1,) * (value.ndim - 1)
+        old_weights = old.point_weights.reshape((-1,) + bcast)
+        new_weights = problem.point_weights.reshape((-1,) + bcast)
+        density = old.interpolate(value / old_weights, tc)
+        return density * new_weights
+    
+    def _interval_mult(self):
+        """Saved multipliers of the piece constraints at each interval.
+        
+        Returns a dictionary with the multipliers of the constraints of each
+        name over all collocation intervals of the saved problem.
+        """
+        old = self.problem
+        interv_mult = {}
+        for constr in old.constraints:
+            if self._constraint_kind(old, constr) != 'piece':
+                continue
+            interv = self._piece_spec(old, constr).point_ind[:, :-1]
+            shape = (old.npoints - 1,) + constr.shape[2:]
+            dest = interv_mult.setdefault(constr.name, np.zeros(shape))
+            dest[interv] = constr.unpack_from(self.mult_g)
+        return interv_mult
+    
+    def _piece_spec(self, problem, constr):
+        """The piece-ravelled variable among the arguments of a constraint."""
+        for arg in constr.args:
+            spec = problem.remapped.get(arg)
+            if isinstance(spec, col.PieceRavelledVariable):
+                return spec
+    
+    def _constraint_kind(self, problem, constr):
+        """Whether a constraint is defined per 'piece', 'point' or 'fixed'."""
+        if self._piece_spec(problem, constr) is not None:
+            return 'piece'
+        elif any(arg in self.point_variables for arg in constr.args):
+            return 'point'
+        else:
+            return 'fixed'
+
+
+class MPC:
+    """Receding-horizon model predictive controller over an `oc.Problem`.
+    
+    The problem, with its sparsity structure, buffers and model, is built
+    once and kept for all control cycles. Each `step` only updates the
+    bounds fixing the initial state and the references, and warm-starts the
+    solver from the previous solution shifted to the current time. The
+    problem's time grid is relative to the time of each step.
+    """
+    
+    def __init__(self, problem, d_bounds, constr_bounds, solver='ipopt',
+                 **options):
+        self.problem = problem
+        """The underlying optimal control problem."""
+        
+        self.d_bounds = np.array(d_bounds, float)
+        """Decision variable bounds, updated in place at each step."""
+        
+        self.constr_bounds = np.array(constr_bounds, float)
+        """Constraint bounds."""
+        
+        if solver == 'ipopt':
+            options = {**WarmStart.ipopt_options, **options}
+        self.solver = solvers.get(solver)(
+            problem, self.d_bounds, self.constr_bounds, **options
+        )
+        """The nonlinear programming solver, sharing the bound arrays."""
+        
+        self.warm_start = None
+        """Solution of the last step."""
+        
+        self.t = None
+        """Time of the last step."""
+        
+        problem.finalize()
+    
+    def step(self, x0, t, dec0=None, **fixed):
+        """Solve the problem for initial state `x0` at time `t`.
+        
+        The keyword arguments fix decision variables other than the states,
+        such as references given as parameters, to the given values. Other
+        names raise a ValueError. Without a previous solution, `dec0` is the
+        initial guess, defaulting to the constant state `x0` and zeros
+        elsewhere. Returns the optimal decision vector and the solver
+        information.
+        """
+        problem = self.problem
+        for name in fixed:
+            if name == 'x':
+                raise ValueError("the states are fixed only through `x0`")
+            if name not in problem.decision:
+                raise ValueError(f"'{name}' is not a decision variable")
+        
+        var_L = problem.variables(self.d_bounds[0])
+        var_U = problem.variables(self.d_bounds[1])
+        var_L['x'][0] = x0
+        var_U['x'][0] = x0
+        for name, value in fixed.items():
+            var_L[name][...] = value
+            var_U[name][...] = value
+        
+        mult = {}
+        if dec0 is None and self.warm_start is not None:
+            dec0, mult = self.warm_start.shift(problem, t - self.t)
+        elif dec0 is None:
+            dec0 = np.zeros(problem.ndec)
+            problem.variables(dec0)['x'][...] = x0
+        else:
+            dec0 = np.array(dec0, float)
+        
+        # Make the initial guess consistent with the fixed variables
+        fixed_dec = self.d_bounds[0] == self.d_bounds[1]
+        dec0[fixed_dec] = self.d_bounds[0, fixed_dec]
+        
+        decopt, info = self.solver.solve(dec0, **mult)
+        self.warm_start = WarmStart(problem, decopt, info)
+        self.t = t
+        return decopt, info
+
+
+def optional_array(a):
+    """Float array copy of `a`, or None if it is None."""
+    return None if a is None else np.array(a, float)
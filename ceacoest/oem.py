@@ -3,7 +3,7 @@
 
 import numpy as np
 
-from . import col, optim
+from . import col, optim, utils
 
 
 class Problem(col.Problem):
@@ -20,7 +20,7 @@ class Problem(col.Problem):
         
         ymask = np.ma.getmaskarray(y)
         kmeas_coarse, = np.nonzero(np.any(~ymask, axis=1))
-        self.kmeas = kmeas_coarse * self.collocation.ninterv
+        self.kmeas = self.piece_start[kmeas_coarse]
         """Collocation time indices with active measurements."""
         
         self.y = y[kmeas_coarse]
@@ -79,26 +79,28 @@ class XMVariable:
     @property
     def size(self):
         """Total number of elements."""
-        return np.prod(self.shape, dtype=np.int)
+        return np.prod(self.shape, dtype=int)
     
     def unpack_from(self, vec):
         """Extract component from parent vector."""
         x = self.x.unpack_from(vec)
         return x[self.kmeas]
 
+    @utils.cached_property
+    def parent_ind(self):
+        """Index of each element in the parent vector."""
+        return self.convert_ind(np.arange(self.size)).reshape(self.shape)
+    
     def add_to(self, destination, value):
         value = np.asarray(value)
         assert value.shape == self.shape
-        
-        xval = np.zeros(self.x.shape)
-        xval[self.kmeas] = value
-        self.x.add_to(destination, xval)
+        np.add.at(destination, self.parent_ind, value)
 
-    def convert_ind(self, xm_ind):
+    def convert_ind(self, xm_ind, dtype=int):
         """Convert component indices to parent vector indices."""
-        nx = self.x.shape[1]
-        xm_coord = np.unravel_index(xm_ind, self.shape)
-        x_coord = (self.kmeas[xm_coord[0]], xm_coord[1])
-        x_ind = np.ravel_multi_index(x_coord, self.x.shape)
-        return self.x.convert_ind(x_ind)
+        xm_ind = np.asarray(xm_ind, dtype)
+        nx = xm_ind.dtype.type(self.x.shape[1])
+        meas, state = np.divmod(xm_ind, nx)
+        x_ind = self.kmeas.astype(dtype)[meas] * nx + state
+        return self.x.convert_ind(x_ind, dtype)
 
@@ -3,12 +3,15 @@
 
 import collections
 import contextlib
+import functools
 import itertools
 import numbers
+import types
 
 import numpy as np
+from scipy import sparse
 
-from . import utils
+from . import solvers, utils
 
 
 class Problem:
@@ -32,6 +35,51 @@ class Problem:
         
         self.ncons = 0
         """Size of the constraint vector."""
+        
+        self._sparsity = None
+        """Cached sparsity structure of the problem derivatives."""
+        
+        self._variables_cache = None
+        """Last evaluated decision vector, its variables and fused outputs."""
+        
+        self._coalesce_hessian = False
+        """Whether duplicate Lagrangian Hessian entries are summed."""
+        
+        self._index_dtype = np.dtype(np.int32)
+        """Integer type of the sparse derivative indices."""
+        
+        self.executor = None
+        """Optional `concurrent.futures.Executor` for component evaluation.
+        
+        When set, the sparse value functions evaluate each component, or
+        each chunk of `chunk_size` pieces of a component, as a separate task
+        writing into its own part of the output. The objective and its
+        gradient are summed from a partial output of each task. A thread
+        pool gives parallel speedups as the NumPy code of the models
+        releases the GIL.
+        """
+        
+        self.evaluator = None
+        """Optional out-of-process evaluator of the problem functions,
+        see `ceacoest.parallel.ProcessPoolEvaluator`."""
+        
+        self.chunk_size = None
+        """Maximum length of the vectorized axis in each function evaluation.
+        
+        Components vectorized over a longer first axis, e.g., over collocation
+        pieces, are evaluated in chunks streamed into the output buffers. This
+        bounds the size of the model temporaries regardless of the horizon.
+        """
+        
+        self.ext_variables = set()
+        """Names of the variables vectorized along the function outputs.
+        
+        The constants and variables named here have a leading axis along the
+        first vectorized axis of the functions using them, e.g., one element
+        per collocation piece, and are sliced with it in chunked evaluations.
+        The function arguments with a base shape in the model are vectorized
+        according to it and need not be named.
+        """
     
     def add_decision(self, name, shape):
         """Add a decision variable to this problem."""
@@ -46,13 +94,16 @@ class Problem:
         dec = Decision(shape, self.ndec)
         self.ndec += dec.size
         self.decision[name] = dec
+        self.invalidate()
         return dec
     
     def add_objective(self, fun, shape, args=None):
         """Add an objective function to this problem."""
         if isinstance(shape, numbers.Integral):
             shape = shape,
-        self.objectives.append(Objective(shape, fun, args))
+        obj = Objective(shape, fun, args, self.ext_variables)
+        self.objectives.append(obj)
+        self.invalidate()
     
     def add_dependent_variable(self, name, spec):
         if not isinstance(name, str):
@@ -62,22 +113,165 @@ class Problem:
         if name in self.remapped:
             raise ValueError(f"{name} already defined as auxiliary variable")
         self.remapped[name] = spec
+        self.invalidate()
         return spec
     
     def add_constraint(self, fun, shape, args=None):
         """Add a constraint function to this problem."""
         if isinstance(shape, numbers.Integral):
             shape = shape,
-        cons = Constraint(shape, self.ncons, fun, args)
+        cons = Constraint(shape, self.ncons, fun, args, self.ext_variables)
         self.ncons += cons.size
         self.constraints.append(cons)
+        self.invalidate()
+    
+    def invalidate(self):
+        """Discard the cached problem structure after a problem change."""
+        self._sparsity = None
+        self._variables_cache = None
+    
+    @property
+    def coalesce_hessian(self):
+        """Whether duplicate Lagrangian Hessian entries are summed.
+        
+        When set, `lag_hess_ind` has one lower-triangular entry per unique
+        position of the Lagrangian Hessian and `lag_hess_val` sums the
+        contributions of all objectives and constraints to each of them.
+        """
+        return self._coalesce_hessian
+    
+    @coalesce_hessian.setter
+    def coalesce_hessian(self, value):
+        self._coalesce_hessian = bool(value)
+        self.invalidate()
+    
+    @property
+    def index_dtype(self):
+        """Integer type of the sparse derivative indices.
+        
+        Defaults to 32-bit integers, the `Index` type of IPOPT. Building the
+        sparsity structure raises `OverflowError` if the problem dimensions
+        or number of nonzero elements do not fit in this type.
+        """
+        return self._index_dtype
+    
+    @index_dtype.setter
+    def index_dtype(self, value):
+        dtype = np.dtype(value)
+        if dtype.kind not in 'iu':
+            raise TypeError(f"index dtype must be an integer type, got {dtype}")
+        self._index_dtype = dtype
+        self.invalidate()
+    
+    @property
+    def sparsity(self):
+        """Sparsity structure of the problem derivatives, built on demand."""
+        if self._sparsity is None:
+            self._sparsity = Sparsity(self)
+        return self._sparsity
+    
+    def finalize(self):
+        """Build the sparsity structure ahead of the problem evaluations."""
+        return self.sparsity
+    
+    def compile(self):
+        """Freeze the problem layout into an immutable `CompiledProblem`.
+        
+        The sparsity structure and the assembly buffers of the result are
+        built once, in a single pass over the specifications. This problem
+        is left untouched and can be further extended as a builder.
+        """
+        cls = compiled_class(type(self))
+        compiled = cls.__new__(cls)
+        compiled.__dict__.update(self.__dict__)
+        compiled.decision = types.MappingProxyType(
+            collections.OrderedDict(self.decision)
+        )
+        compiled.remapped = types.MappingProxyType(dict(self.remapped))
+        compiled.objectives = tuple(self.objectives)
+        compiled.constraints = tuple(self.constraints)
+        compiled._variables_cache = None
+        compiled._sparsity = sparsity = Sparsity(compiled)
+        sparsity.buffer('constr_jac')
+        sparsity.buffer('lag_hess')
+        return compiled
+    
+    def sparsity_report(self):
+        """Summary of the derivative sparsity, without evaluating the model."""
+        return SparsityReport(self)
     
     def variables(self, dvec):
-        """Get all variables needed to evaluate problem functions."""
+        """Get all variables needed to evaluate problem functions.
+        
+        The decision variables of a single decision vector are views into
+        it. A (nbatch, ndec) batch of decision vectors gives copies of the
+        variables with an additional leading batch axis.
+        """
         dvec = np.asarray(dvec)
-        assert dvec.shape == (self.ndec,)
+        assert dvec.shape[-1:] == (self.ndec,) and dvec.ndim <= 2
         items = itertools.chain(self.decision.items(), self.remapped.items())
-        return {k: v.unpack_from(dvec) for k,v in items}
+        if dvec.ndim == 1:
+            return {k: v.unpack_from(dvec) for k,v in items}
+        else:
+            return {k: dvec[:, v.parent_ind] for k,v in items}
+    
+    def cached_variables(self, dvec, out=None):
+        """Variables of `dvec`, cached for repeated evaluations at a point.
+        
+        The variables of the last decision vector are cached, so the
+        objective, constraint and derivative evaluations at the same point
+        only unpack them once. They are unpacked from a private read-only
+        copy of `dvec`, so later changes to `dvec` do not affect the cache.
+        The outputs of the fused functions at the point are cached with them.
+        
+        If `out` is given, the variables are stored in that dictionary,
+        which is returned instead of a new one. Tasks built once against
+        `out` thus see the variables of each new point.
+        """
+        dvec = np.asarray(dvec)
+        cached = self._variables_cache
+        if (cached is not None and np.array_equal(cached[0], dvec)
+            and (out is None or cached[1] is out)):
+            return cached[1]
+        
+        point = readonly(np.array(dvec, float))
+        variables = self.variables(point)
+        if out is not None:
+            out.clear()
+            out.update(variables)
+            variables = out
+        self._variables_cache = point, variables, {}
+        return variables
+    
+    def _fused_val(self, comp, variables, batched, chunk):
+        """Fused value and derivatives of a component, or None if unfused.
+        
+        Components whose functions are `fused` evaluate their values and
+        sparse derivatives together. The output of a whole component is
+        computed once at the cached point, so that the evaluations of the
+        constraints, objective, Jacobian and Hessian at the same point share
+        it, and discarded with the cached variables. The outputs of chunks
+        are not cached, as that would keep them for the whole horizon and
+        defeat the bounded memory of the chunked evaluations.
+        """
+        if not comp.fused:
+            return None
+        
+        cached = self._variables_cache
+        if chunk is not None or cached is None or cached[1] is not variables:
+            return comp.fused_val(variables, batched, chunk)
+        
+        fused = cached[2]
+        val = fused.get(comp)
+        if val is None:
+            val = fused[comp] = comp.fused_val(variables, batched)
+        return val
+    
+    def _batched(self, dvec):
+        """Names of the variables with a batch axis, if `dvec` is a batch."""
+        if np.ndim(dvec) == 1:
+            return frozenset()
+        return frozenset(itertools.chain(self.decision, self.remapped))
     
     @property
     def variable_shapes(self):
@@ -100,177 +294,962 @@ class Problem:
                 ret[name] = cons.unpack_from(cvec)
         return ret
     
-    def _sparse_fun_val(self, dvec, nnz, components, val_fun_name):
-        variables = self.variables(dvec)
-        val = np.empty(nnz)
-        offset = 0
-        for comp in components:
+    def _sparse_fun_val(self, dvec, name, out=None):
+        nnz = getattr(self.sparsity, f'{name}_nnz')
+        out_shape = np.shape(dvec)[:-1] + (nnz,)
+        if out is None:
+            out = np.empty(out_shape)
+        assert out.shape == out_shape
+        
+        batched = self._batched(dvec)
+        if self.evaluator is not None and not batched:
+            return self.evaluator.evaluate(name, dvec, out)
+        
+        variables = self.cached_variables(dvec)
+        self._run(self._evaluation_tasks(name, variables, batched, out))
+        return out
+    
+    def _evaluation_tasks(self, name, variables, batched, out):
+        """List of independent tasks writing the values of `name` to `out`.
+        
+        The `name` is either `'constr'` or that of a sparse value function
+        (`'obj_hess'`, `'constr_jac'` or `'constr_hess'`). The list is the
+        same for all evaluations of a problem with the same `chunk_size`.
+        """
+        if name == 'constr':
+            return self._constr_tasks(variables, batched, out)
+        
+        sparsity = self.sparsity
+        slices = getattr(sparsity, f'{name}_slices')
+        blocks = getattr(sparsity, f'{name}_blocks')
+        if name == 'obj_hess':
+            components = self.objectives
+            val_fun_name = 'hess_val'
+        else:
+            components = self.constraints
+            val_fun_name = name[len('constr_'):] + '_val'
+        
+        tasks = []
+        for comp, s, comp_blocks in zip(components, slices, blocks):
             val_fun = getattr(comp, val_fun_name)
-            for varnames, comp_val in val_fun(variables).items():
-                comp_nnz = comp_val.size
-                assert offset + comp_nnz <= nnz                
-                s = slice(offset, offset + comp_nnz)
-                val[s] = comp_val.ravel()
-                offset += comp_nnz
-        assert offset == nnz
-        return val
+            comp_out = out[..., s]
+            for chunk in comp.chunks(self.chunk_size, comp_blocks):
+                if chunk is None:
+                    chunk_out = comp_out
+                else:
+                    chunk_out = comp.chunk_blocks(comp_out, comp_blocks, chunk)
+                task = self._sparse_val_task(comp, val_fun, variables, 
+                                             batched, chunk_out, chunk)
+                tasks.append(task)
+        return tasks
+    
+    def _sparse_val_task(self, comp, val_fun, variables, batched, out, chunk):
+        """Task writing sparse derivative values, or a chunk of them."""
+        def task():
+            fused = self._fused_val(comp, variables, batched, chunk)
+            val_fun(variables, out, batched, chunk, fused)
+        return task
+    
+    def _run(self, tasks):
+        """Run independent tasks, in the executor if one is set."""
+        if self.executor is None:
+            for task in tasks:
+                task()
+        else:
+            futures = [self.executor.submit(task) for task in tasks]
+            for future in futures:
+                future.result()
+    
+    def _run_summed(self, tasks, out):
+        """Run tasks adding terms to `out`, in the executor if one is set.
+        
+        In the executor, each task adds its terms to a separate partial
+        output, as in `ceacoest.parallel.ProcessPoolEvaluator`, and the
+        partial outputs are then summed into `out`.
+        """
+        if self.executor is None or len(tasks) < 2:
+            for task in tasks:
+                task(out)
+            return
+        
+        partial = np.zeros((len(tasks),) + out.shape)
+        self._run([functools.partial(task, partial[i, ...])
+                   for i, task in enumerate(tasks)])
+        out += partial.sum(axis=0)
     
     def obj(self, dvec):
         """Optimization problem objective function."""
-        variables = self.variables(dvec)
-        obj_val = 0.0
-        for obj in self.objectives:
-            obj_val += np.sum(obj(variables))
-        return obj_val
+        obj_val = np.zeros(np.shape(dvec)[:-1])
+        batched = self._batched(dvec)
+        if self.evaluator is not None and not batched:
+            return self.evaluator.evaluate('obj', dvec, obj_val)[()]
+        
+        variables = self.cached_variables(dvec)
+        tasks = self._objective_tasks('obj', variables, batched)
+        self._run_summed(tasks, obj_val)
+        return obj_val[()]
     
     def obj_grad(self, dvec):
         """Objective function gradient."""
-        variables = self.variables(dvec)
-        grad = np.zeros(self.ndec)
+        grad = np.zeros(np.shape(dvec))
+        batched = self._batched(dvec)
+        if self.evaluator is not None and not batched:
+            return self.evaluator.evaluate('obj_grad', dvec, grad)
+        
+        variables = self.cached_variables(dvec)
+        tasks = self._objective_tasks('obj_grad', variables, batched)
+        self._run_summed(tasks, grad)
+        return grad
+    
+    def _objective_tasks(self, name, variables, batched):
+        """List of tasks adding the objective terms of `name` to their output.
+        
+        The `name` is either `'obj'` or `'obj_grad'`. Each task is called with
+        the output array, to which it adds the terms of an objective or of a
+        chunk of its pieces, so the tasks can be split among separate outputs
+        and summed. The list is the same for all evaluations of a problem with
+        the same `chunk_size`.
+        """
+        tasks = []
         for obj in self.objectives:
-            for wrt, val in obj.grad(variables).items():
+            for chunk in obj.chunks(self.chunk_size):
+                if name == 'obj':
+                    task = self._obj_task(obj, variables, batched, chunk)
+                else:
+                    task = self._obj_grad_task(obj, variables, batched, chunk)
+                tasks.append(task)
+        return tasks
+    
+    def _obj_task(self, obj, variables, batched, chunk):
+        """Task adding the objective values, or a chunk of them, to `out`."""
+        def task(out):
+            fused = self._fused_val(obj, variables, batched, chunk)
+            val = obj(variables, batched, chunk, fused)
+            out += np.sum(np.reshape(val, out.shape + (-1,)), -1)
+        return task
+    
+    def _obj_grad_task(self, obj, variables, batched, chunk):
+        """Task adding the objective gradient, or a chunk of it, to `out`."""
+        def task(out):
+            batch_shape = out.shape[:-1]
+            chunked = obj.chunked_variables(variables, batched)
+            fused = self._fused_val(obj, variables, batched, chunk)
+            grad_items = obj.grad(variables, batched, chunk, fused).items()
+            for wrt, val in grad_items:
                 wrt_var = self.variable_spec(wrt)
                 if wrt_var is None:
                     raise RuntimeError(f"unrecognized variable '{wrt}'")
-                wrt_var.add_to(grad, val)
-        return grad
+                if batched or chunk is not None:
+                    ind = wrt_var.parent_ind
+                    if chunk is not None and wrt in chunked:
+                        ind = ind[chunk]
+                    val = np.reshape(val, batch_shape + ind.shape)
+                    batch_index = (slice(None),) * len(batch_shape)
+                    np.add.at(out, batch_index + (ind,), val)
+                else:
+                    wrt_var.add_to(out, val)
+        return task
 
-    @property
-    def obj_hess_nnz(self):
-        shapes = self.variable_shapes
-        return sum(obj.hess_nnz(shapes) for obj in self.objectives)
-    
-    @property
-    def obj_hess_ind(self):
-        shapes = self.variable_shapes
-        nnz = self.obj_hess_nnz
-        ind = np.empty((2, nnz), int)
+    def _obj_hess_ind(self, shapes):
+        """Build the objective Hessian indices, nnz and wrt of blocks."""
+        nnz = sum(obj.hess_nnz(shapes) for obj in self.objectives)
+        dtype = self.index_dtype
+        ind = np.empty((2, nnz), dtype)
+        blocks = []
+        block_wrt = []
         offset = 0
         for obj in self.objectives:
-            for (var0name, var1name), loc_ind in obj.hess_ind(shapes).items():
+            blocks.append([])
+            block_wrt.append([])
+            for wrt, loc_ind in obj.hess_ind(shapes).items():
+                var0name, var1name = wrt
                 var0 = self.variable_spec(var0name)
                 var1 = self.variable_spec(var1name)
                 loc_nnz = loc_ind[0].size
                 assert offset + loc_nnz <= nnz
                 
                 s = slice(offset, offset + loc_nnz)
-                ind[0, s] = var0.convert_ind(loc_ind[0].ravel())
-                ind[1, s] = var1.convert_ind(loc_ind[1].ravel())
+                ind[0, s] = var0.convert_ind(loc_ind[0].ravel(), dtype)
+                ind[1, s] = var1.convert_ind(loc_ind[1].ravel(), dtype)
+                blocks[-1].append(loc_nnz)
+                block_wrt[-1].append(wrt)
                 offset += loc_nnz
         assert offset == nnz
-        return ind
-    
-    def obj_hess_val(self, dvec):
-        nnz = self.obj_hess_nnz
-        components = self.objectives
-        return self._sparse_fun_val(dvec, nnz, components, 'hess_val')
-    
-    def constr(self, dvec):
-        cvec = np.zeros(self.ncons)
-        variables = self.variables(dvec)
-        for constr in self.constraints:
-            constr.pack_into(cvec, constr(variables))
-        return cvec
-    
-    @property
-    def constr_jac_nnz(self):
-        shapes = self.variable_shapes
-        return sum(c.jac_nnz(shapes) for c in self.constraints)
+        return ind, blocks, block_wrt
     
-    @property
-    def constr_jac_ind(self):
-        shapes = self.variable_shapes
-        nnz = self.constr_jac_nnz
-        ind = np.empty((2, nnz), int)
+    def _constr_jac_ind(self, shapes):
+        """Build the constraint Jacobian indices, nnz and wrt of blocks."""
+        nnz = sum(c.jac_nnz(shapes) for c in self.constraints)
+        dtype = self.index_dtype
+        ind = np.empty((2, nnz), dtype)
+        blocks = []
+        block_wrt = []
         offset = 0
         for c in self.constraints:
-            for (varname,), loc_ind in c.jac_ind(shapes).items():
+            blocks.append([])
+            block_wrt.append([])
+            for wrt, loc_ind in c.jac_ind(shapes).items():
+                varname, = wrt
                 var = self.variable_spec(varname)
                 loc_nnz = loc_ind[0].size
                 assert offset + loc_nnz <= nnz
 
                 s = slice(offset, offset + loc_nnz)
-                ind[0, s] = var.convert_ind(loc_ind[0].ravel())
-                ind[1, s] = c.convert_ind(loc_ind[1].ravel())
+                ind[0, s] = var.convert_ind(loc_ind[0].ravel(), dtype)
+                ind[1, s] = c.convert_ind(loc_ind[1].ravel(), dtype)
+                blocks[-1].append(loc_nnz)
+                block_wrt[-1].append(wrt)
                 offset += loc_nnz
         assert offset == nnz
-        return ind
-    
-    def constr_jac_val(self, dvec):
-        nnz = self.constr_jac_nnz
-        components = self.constraints
-        return self._sparse_fun_val(dvec, nnz, components, 'jac_val')
-    
-    @property
-    def constr_hess_nnz(self):
-        shapes = self.variable_shapes
-        return sum(c.hess_nnz(shapes) for c in self.constraints)
+        return ind, blocks, block_wrt
     
-    @property
-    def constr_hess_ind(self):
-        shapes = self.variable_shapes
-        nnz = self.constr_hess_nnz
-        ind = np.empty((3, nnz), int)
+    def _constr_hess_ind(self, shapes):
+        """Build the constraint Hessian indices, nnz and wrt of blocks."""
+        nnz = sum(c.hess_nnz(shapes) for c in self.constraints)
+        dtype = self.index_dtype
+        ind = np.empty((3, nnz), dtype)
+        blocks = []
+        block_wrt = []
         offset = 0
         for c in self.constraints:
-            for (var0name, var1name), loc_ind in c.hess_ind(shapes).items():
+            blocks.append([])
+            block_wrt.append([])
+            for wrt, loc_ind in c.hess_ind(shapes).items():
+                var0name, var1name = wrt
                 var0 = self.variable_spec(var0name)
                 var1 = self.variable_spec(var1name)
                 loc_nnz = loc_ind[0].size
                 assert offset + loc_nnz <= nnz
                 
                 s = slice(offset, offset + loc_nnz)
-                ind[0, s] = var0.convert_ind(loc_ind[0].ravel())
-                ind[1, s] = var1.convert_ind(loc_ind[1].ravel())
-                ind[2, s] = c.convert_ind(loc_ind[2].ravel())
+                ind[0, s] = var0.convert_ind(loc_ind[0].ravel(), dtype)
+                ind[1, s] = var1.convert_ind(loc_ind[1].ravel(), dtype)
+                ind[2, s] = c.convert_ind(loc_ind[2].ravel(), dtype)
+                blocks[-1].append(loc_nnz)
+                block_wrt[-1].append(wrt)
                 offset += loc_nnz
         assert offset == nnz
-        return ind
+        return ind, blocks, block_wrt
+    
+    @property
+    def obj_hess_nnz(self):
+        return self.sparsity.obj_hess_nnz
+    
+    @property
+    def obj_hess_ind(self):
+        return self.sparsity.obj_hess_ind
+    
+    def obj_hess_val(self, dvec, out=None):
+        return self._sparse_fun_val(dvec, 'obj_hess', out)
+    
+    def constr(self, dvec):
+        cvec = np.zeros(np.shape(dvec)[:-1] + (self.ncons,))
+        batched = self._batched(dvec)
+        if self.evaluator is not None and not batched:
+            return self.evaluator.evaluate('constr', dvec, cvec)
+        
+        variables = self.cached_variables(dvec)
+        self._run(self._constr_tasks(variables, batched, cvec))
+        return cvec
+    
+    def _constr_tasks(self, variables, batched, cvec):
+        """List of independent tasks writing the constraint values."""
+        batch_shape = cvec.shape[:-1]
+        tasks = []
+        for constr in self.constraints:
+            chunks = constr.chunks(self.chunk_size)
+            if chunks == [None]:
+                task = self._constr_task(constr, variables, batched, cvec)
+                tasks.append(task)
+                continue
+            
+            comp_out = cvec[..., constr.slice]
+            comp_out = comp_out.reshape(batch_shape + constr.shape)
+            assert np.may_share_memory(comp_out, cvec)
+            for chunk in chunks:
+                chunk_out = constr.chunk_view(comp_out, chunk)
+                task = self._constr_task(constr, variables, batched, 
+                                         chunk_out, chunk)
+                tasks.append(task)
+        return tasks
+    
+    def _constr_task(self, constr, variables, batched, out, chunk=None):
+        """Task writing the constraint values, or a chunk of them, to `out`."""
+        def task():
+            fused = self._fused_val(constr, variables, batched, chunk)
+            val = constr(variables, batched, chunk, fused)
+            if chunk is None:
+                constr.pack_into(out, val)
+            else:
+                out[...] = val
+        return task
+    
+    @property
+    def constr_jac_nnz(self):
+        return self.sparsity.constr_jac_nnz
+    
+    @property
+    def constr_jac_ind(self):
+        return self.sparsity.constr_jac_ind
+    
+    def constr_jac_val(self, dvec, out=None):
+        return self._sparse_fun_val(dvec, 'constr_jac', out)
+    
+    def constr_jac(self, dvec, format='csr', out=None):
+        """Constraint Jacobian as a (ncons, ndec) compressed sparse matrix.
+        
+        If `out` is a matrix previously returned by this function with the
+        same format, its data is overwritten in place and it is returned.
+        """
+        sparsity = self.sparsity
+        assembly = sparsity.assembly('constr_jac', format)
+        if self.evaluator is not None:
+            # Assemble directly from the shared output of the evaluator
+            val = self.evaluator.evaluate('constr_jac', dvec)
+        else:
+            val = self.constr_jac_val(dvec, out=sparsity.buffer('constr_jac'))
+        return assembly(val, out)
+    
+    @property
+    def constr_hess_nnz(self):
+        return self.sparsity.constr_hess_nnz
+    
+    @property
+    def constr_hess_ind(self):
+        return self.sparsity.constr_hess_ind
 
-    def constr_hess_val(self, dvec):
-        nnz = self.constr_hess_nnz
-        components = self.constraints
-        return self._sparse_fun_val(dvec, nnz, components, 'hess_val')
+    def constr_hess_val(self, dvec, out=None):
+        return self._sparse_fun_val(dvec, 'constr_hess', out)
     
     @property
     def lag_hess_nnz(self):
-        return self.obj_hess_nnz + self.constr_hess_nnz
+        return self.sparsity.lag_hess_nnz
     
     @property
     def lag_hess_ind(self):
-        obj_nnz = self.obj_hess_nnz
-        nnz = self.lag_hess_nnz
-        ind = np.zeros((2, nnz), int)
-        ind[:, :obj_nnz] = self.obj_hess_ind
-        ind[:, obj_nnz:] = self.constr_hess_ind[:2]
-        return ind
-
-    def lag_hess_val(self, dvec, obj_mult, constr_mult):
-        assert np.shape(constr_mult) == (self.ncons,)
-        nnz = self.lag_hess_nnz
-        obj_nnz = self.obj_hess_nnz
-        mult_ind = self.constr_hess_ind[2]
-        
-        val = np.zeros(nnz)
-        val[:obj_nnz] = self.obj_hess_val(dvec) * obj_mult
-        val[obj_nnz:] = self.constr_hess_val(dvec) * constr_mult[mult_ind]
-        return val
+        return self.sparsity.lag_hess_ind
+
+    def lag_hess_val(self, dvec, obj_mult, constr_mult, out=None):
+        batch_shape = np.shape(dvec)[:-1]
+        assert np.shape(constr_mult) == batch_shape + (self.ncons,)
+        sparsity = self.sparsity
+        obj_nnz = sparsity.obj_hess_nnz
+        mult_ind = sparsity.constr_hess_ind[2]
+        coalescing = sparsity.lag_hess_coalescing
+        
+        if out is None:
+            out = np.empty(batch_shape + (sparsity.lag_hess_nnz,))
+        if coalescing is None:
+            val = out
+        elif batch_shape:
+            val = np.empty(batch_shape + (coalescing.perm.size,))
+        else:
+            val = sparsity.buffer('lag_hess_raw', coalescing.perm.size)
+        
+        obj_mult = np.asarray(obj_mult)[..., None]
+        if batch_shape:
+            mult = np.take(constr_mult, mult_ind, axis=-1)
+        else:
+            nnz = sparsity.constr_hess_nnz
+            mult = sparsity.buffer('constr_hess_mult', nnz)
+            np.take(constr_mult, mult_ind, out=mult)
+        
+        obj_val = val[..., :obj_nnz]
+        constr_val = val[..., obj_nnz:]
+        if self.evaluator is not None and not batch_shape:
+            # Scale the shared outputs of the evaluator into place
+            obj_hess = self.evaluator.evaluate('obj_hess', dvec)
+            np.multiply(obj_hess, obj_mult, out=obj_val)
+            constr_hess = self.evaluator.evaluate('constr_hess', dvec)
+            np.multiply(constr_hess, mult, out=constr_val)
+        else:
+            self.obj_hess_val(dvec, out=obj_val)
+            obj_val *= obj_mult
+            self.constr_hess_val(dvec, out=constr_val)
+            constr_val *= mult
+        
+        if coalescing is not None:
+            coalescing.reduce(val, out)
+        return out
+    
+    def lag_hess(self, dvec, obj_mult, constr_mult, format='csr', out=None):
+        """Lagrangian Hessian as a symmetric compressed sparse matrix.
+        
+        Unlike `lag_hess_val`, both triangles of the Hessian are filled. If
+        `out` is a matrix previously returned by this function with the same
+        format, its data is overwritten in place and it is returned.
+        """
+        sparsity = self.sparsity
+        assembly = sparsity.assembly('lag_hess', format)
+        val = sparsity.buffer('lag_hess')
+        self.lag_hess_val(dvec, obj_mult, constr_mult, out=val)
+        return assembly(val, out)
     
     @contextlib.contextmanager
     def ipopt(self, d_bounds, constr_bounds):
         from mseipopt import ez
+        sparsity = self.finalize()
+        jac_ind = sparsity.constr_jac_ind[[1, 0]]
+        hess_ind = sparsity.lag_hess_ind
         f = self.obj
         g = self.constr
         grad = self.obj_grad
-        jac_ind = lambda: self.constr_jac_ind[[1,0]]
-        hess_ind = lambda: self.lag_hess_ind
-        jac = jac_ind, self.constr_jac_val
-        hess = hess_ind, self.lag_hess_val
-        nele_jac = self.constr_jac_nnz
-        nele_hess = self.lag_hess_nnz
+        jac = (lambda: jac_ind), self.constr_jac_val
+        hess = (lambda: hess_ind), self.lag_hess_val
+        nele_jac = sparsity.constr_jac_nnz
+        nele_hess = sparsity.lag_hess_nnz
         with ez.Problem(d_bounds, constr_bounds, f, g,
                         grad, jac, nele_jac, hess, nele_hess) as problem:
             yield problem
+    
+    def solve(self, dec0, d_bounds, constr_bounds, solver='ipopt', **options):
+        """Solve the problem with a solver registered in `solvers.SOLVERS`.
+        
+        Returns the optimal decision vector and the solution information.
+        """
+        return solvers.solve(self, dec0, d_bounds, constr_bounds, solver,
+                             **options)
+
+
+class CompiledProblem:
+    """Mixin of problems with an immutable layout, see `Problem.compile`.
+    
+    The compiled problems are instances of a subclass of both this class
+    and the class of the original problem, so they keep its evaluation
+    functions. Adding variables or functions and changing the settings of
+    the sparsity structure raise errors.
+    
+    Copies and pickles of a compiled problem are compiled again from a
+    plain problem with its layout, as the read-only views of its
+    specifications cannot be copied.
+    """
+    
+    source_class = None
+    """Class of the problems compiled into this class."""
+    
+    coalesce_hessian = property(Problem.coalesce_hessian.fget,
+                                doc=Problem.coalesce_hessian.__doc__)
+    
+    index_dtype = property(Problem.index_dtype.fget,
+                           doc=Problem.index_dtype.__doc__)
+    
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("the layout of a compiled problem cannot change")
+    
+    add_decision = add_objective = _immutable
+    add_dependent_variable = add_constraint = invalidate = _immutable
+    
+    def compile(self):
+        return self
+    
+    def __reduce__(self):
+        source = self.source_class.__new__(self.source_class)
+        source.__dict__.update(self.__dict__)
+        source.decision = collections.OrderedDict(self.decision)
+        source.remapped = dict(self.remapped)
+        source.objectives = list(self.objectives)
+        source.constraints = list(self.constraints)
+        source._sparsity = None
+        source._variables_cache = None
+        return Problem.compile, (source,)
+
+
+@functools.lru_cache()
+def compiled_class(cls):
+    """Compiled problem subclass of a problem class."""
+    if issubclass(cls, CompiledProblem):
+        return cls
+    namespace = dict(__module__=cls.__module__, source_class=cls)
+    return type(f'Compiled{cls.__name__}', (CompiledProblem, cls), namespace)
+
+
+class Sparsity:
+    """Frozen sparsity structure of an optimization problem's derivatives.
+    
+    Built once from the problem specification and reused by all sparse value
+    functions. The index arrays are read-only, any change to the problem
+    layout must go through `Problem.invalidate`.
+    """
+    
+    def __init__(self, problem):
+        shapes = problem.variable_shapes
+        objectives = problem.objectives
+        constraints = problem.constraints
+        
+        self.obj_hess_slices = component_slices(
+            obj.hess_nnz(shapes) for obj in objectives
+        )
+        """Slices of each objective in the Hessian nonzero values."""
+        
+        self.constr_jac_slices = component_slices(
+            c.jac_nnz(shapes) for c in constraints
+        )
+        """Slices of each constraint in the Jacobian nonzero values."""
+        
+        self.constr_hess_slices = component_slices(
+            c.hess_nnz(shapes) for c in constraints
+        )
+        """Slices of each constraint in the Hessian nonzero values."""
+        
+        # Ensure all indices and nonzero counts are representable
+        obj_hess_nnz = slices_stop(self.obj_hess_slices)
+        constr_hess_nnz = slices_stop(self.constr_hess_slices)
+        check_index_range(
+            problem.index_dtype, problem.ndec, problem.ncons,
+            obj_hess_nnz + constr_hess_nnz, 
+            slices_stop(self.constr_jac_slices),
+            *(spec.size for spec in problem.decision.values()),
+            *(spec.size for spec in problem.remapped.values()),
+            *(c.size for c in constraints),
+        )
+        
+        self._buffers = {}
+        """Persistent work arrays, see `Sparsity.buffer`."""
+        
+        self._assemblies = {}
+        """Compressed sparse matrix assemblies, see `Sparsity.assembly`."""
+        
+        self.ndec = problem.ndec
+        """Size of the decision vector."""
+        
+        self.ncons = problem.ncons
+        """Size of the constraint vector."""
+        
+        obj_hess_ind, self.obj_hess_blocks, self.obj_hess_block_wrt = (
+            problem._obj_hess_ind(shapes)
+        )
+        self.obj_hess_ind = readonly(obj_hess_ind)
+        """Objective Hessian indices."""
+        
+        constr_jac_ind, self.constr_jac_blocks, self.constr_jac_block_wrt = (
+            problem._constr_jac_ind(shapes)
+        )
+        self.constr_jac_ind = readonly(constr_jac_ind)
+        """Constraint Jacobian indices, decision index first."""
+        
+        constr_hess_ind, self.constr_hess_blocks, self.constr_hess_block_wrt = (
+            problem._constr_hess_ind(shapes)
+        )
+        self.constr_hess_ind = readonly(constr_hess_ind)
+        """Constraint Hessian indices, with constraint index last."""
+        
+        lag_hess_ind = np.c_[self.obj_hess_ind, self.constr_hess_ind[:2]]
+        self.lag_hess_coalescing = None
+        """Summation of the duplicate Lagrangian Hessian entries, if enabled."""
+        
+        if problem.coalesce_hessian:
+            lower = np.sort(lag_hess_ind, axis=0)[::-1]
+            shape = self.ndec, self.ndec
+            coalescing = SparseAssembly(lower[0], lower[1], shape)
+            lag_hess_ind = coalescing.coo_ind()
+            self.lag_hess_coalescing = coalescing
+        
+        self.lag_hess_ind = readonly(lag_hess_ind)
+        """Lagrangian Hessian indices."""
+    
+    @property
+    def obj_hess_nnz(self):
+        """Number of nonzero elements of the objective Hessian."""
+        return self.obj_hess_ind.shape[1]
+    
+    @property
+    def constr_jac_nnz(self):
+        """Number of nonzero elements of the constraint Jacobian."""
+        return self.constr_jac_ind.shape[1]
+    
+    @property
+    def constr_hess_nnz(self):
+        """Number of nonzero elements of the constraint Hessian."""
+        return self.constr_hess_ind.shape[1]
+    
+    @property
+    def lag_hess_nnz(self):
+        """Number of nonzero elements of the Lagrangian Hessian."""
+        return self.lag_hess_ind.shape[1]
+    
+    def buffer(self, name, size=None):
+        """Persistent work array associated with this sparsity structure.
+        
+        The size defaults to the number of nonzero elements of the `name`
+        sparse function, e.g., `buffer('constr_jac')` for the constraint
+        Jacobian values. The same array is returned on every call, so its
+        contents are only valid until the next evaluation that uses it.
+        """
+        try:
+            return self._buffers[name]
+        except KeyError:
+            pass
+        if size is None:
+            size = getattr(self, f'{name}_nnz')
+        buf = self._buffers[name] = np.empty(size)
+        return buf
+    
+    def assembly(self, name, format='csr'):
+        """Compressed sparse matrix assembly of the `name` sparse function.
+        
+        Supports the constraint Jacobian `constr_jac`, as a (ncons, ndec)
+        matrix, and the Lagrangian Hessian `lag_hess`, as a symmetric
+        (ndec, ndec) matrix. The assemblies are built on first use.
+        """
+        key = name, format
+        try:
+            return self._assemblies[key]
+        except KeyError:
+            pass
+        
+        if name == 'constr_jac':
+            dec_ind, cons_ind = self.constr_jac_ind
+            shape = self.ncons, self.ndec
+            assembly = SparseAssembly(cons_ind, dec_ind, shape, format)
+        elif name == 'lag_hess':
+            row, col = self.lag_hess_ind
+            shape = self.ndec, self.ndec
+            assembly = SparseAssembly(row, col, shape, format, symmetric=True)
+        else:
+            raise ValueError(f"no compressed assembly for '{name}'")
+        self._assemblies[key] = assembly
+        return assembly
+    
+    @property
+    def assemblies(self):
+        """Assemblies built so far, by (name, format), see `assembly`."""
+        return dict(self._assemblies)
+
+
+class SparseAssembly:
+    """Precomputed conversion of COO values to a compressed sparse matrix.
+    
+    The sorting of the COO entries into compressed order is done once on
+    construction, so each assembly is a single gather of the values into the
+    matrix data, followed by a sum of the duplicate entries if there are any.
+    
+    >>> row, col = [1, 0, 1, 0], [0, 1, 0, 0]
+    >>> assembly = SparseAssembly(row, col, (2, 2))
+    >>> assembly([1.0, 2.0, 3.0, 4.0]).toarray()
+    array([[4., 2.],
+           [4., 0.]])
+    
+    """
+    
+    def __init__(self, row, col, shape, format='csr', symmetric=False):
+        row = np.asarray(row)
+        col = np.asarray(col)
+        dtype = np.promote_types(row.dtype, col.dtype)
+        src = np.arange(row.size, dtype=dtype)
+        if symmetric:
+            offdiag = row != col
+            row, col = np.r_[row, col[offdiag]], np.r_[col, row[offdiag]]
+            src = np.r_[src, src[offdiag]]
+        
+        if format == 'csr':
+            major, minor = row, col
+            self.matrix_class = sparse.csr_matrix
+            nmajor = shape[0]
+        elif format == 'csc':
+            major, minor = col, row
+            self.matrix_class = sparse.csc_matrix
+            nmajor = shape[1]
+        else:
+            raise ValueError(f"unsupported sparse format '{format}'")
+        
+        # The doubled triangle of a symmetric matrix may not fit the indices
+        check_index_range(dtype, major.size)
+        
+        order = np.lexsort((minor, major))
+        major = major[order]
+        minor = minor[order]
+        first = np.ones(order.size, bool)
+        first[1:] = (major[1:] != major[:-1]) | (minor[1:] != minor[:-1])
+        
+        self.shape = shape
+        """Shape of the assembled matrix."""
+        
+        self.format = format
+        """Compressed sparse matrix format, 'csr' or 'csc'."""
+        
+        self.perm = src[order]
+        """COO value index of each entry in compressed order."""
+        
+        self.starts = np.flatnonzero(first).astype(dtype)
+        """Start of each run of duplicate entries in compressed order."""
+        
+        self.indices = minor[first]
+        """Compressed sparse matrix indices."""
+        
+        major_nnz = np.bincount(major[first], minlength=nmajor)
+        self.indptr = np.r_[0, np.cumsum(major_nnz)].astype(dtype)
+        """Compressed sparse matrix index pointers."""
+        
+        self.nnz = self.indices.size
+        """Number of stored elements of the assembled matrix."""
+        
+        self._gathered = np.empty(order.size) if self.has_duplicates else None
+        """Work array for the gathered values with duplicates."""
+    
+    @property
+    def nbytes(self):
+        """Memory used by the assembly arrays."""
+        arrays = [self.perm, self.starts, self.indices, self.indptr]
+        if self._gathered is not None:
+            arrays.append(self._gathered)
+        return sum(a.nbytes for a in arrays)
+    
+    @property
+    def has_duplicates(self):
+        """Whether some COO entries share the same position."""
+        return self.nnz < self.perm.size
+    
+    def coo_ind(self):
+        """Row and column indices of the stored elements, in order."""
+        major = np.repeat(np.arange(self.indptr.size - 1), np.diff(self.indptr))
+        if self.format == 'csr':
+            return np.array([major, self.indices])
+        else:
+            return np.array([self.indices, major])
+    
+    def reduce(self, val, out):
+        """Gather the COO values in compressed order, summing duplicates.
+        
+        Leading axes of `val` and `out` are treated as a batch.
+        """
+        if not self.has_duplicates:
+            return np.take(val, self.perm, axis=-1, out=out)
+        if np.ndim(val) == 1:
+            gathered = np.take(val, self.perm, out=self._gathered)
+        else:
+            gathered = np.take(val, self.perm, axis=-1)
+        np.add.reduceat(gathered, self.starts, axis=-1, out=out)
+        return out
+    
+    def __call__(self, val, out=None):
+        """Assemble the COO values into a compressed sparse matrix."""
+        if out is None:
+            data = np.empty(self.nnz)
+        else:
+            assert out.format == self.format and out.shape == self.shape
+            assert out.data.shape == (self.nnz,)
+            data = out.data
+        
+        self.reduce(val, data)
+        if out is None:
+            indices = self.indices.copy()
+            indptr = self.indptr.copy()
+            out = self.matrix_class((data, indices, indptr), self.shape)
+            out.has_sorted_indices = True
+        return out
+
+
+class SparsityReport:
+    """Summary of the sparsity structure of an optimization problem.
+    
+    Breaks down the number of nonzero elements of the constraint Jacobian
+    and Lagrangian Hessian by function and variable, and estimates the cost
+    of factorizing the KKT matrix [[H, J.T], [J, 0]] of the problem.
+    """
+    
+    def __init__(self, problem):
+        sparsity = problem.sparsity
+        
+        self.sparsity = sparsity
+        """The underlying problem sparsity structure."""
+        
+        self.ndec = problem.ndec
+        """Size of the decision vector."""
+        
+        self.ncons = problem.ncons
+        """Size of the constraint vector."""
+        
+        self.jac_blocks = component_blocks(
+            problem.constraints, sparsity.constr_jac_block_wrt,
+            sparsity.constr_jac_blocks
+        )
+        """Jacobian nnz of each (function, variables) pair."""
+        
+        self.hess_blocks = component_blocks(
+            problem.objectives, sparsity.obj_hess_block_wrt,
+            sparsity.obj_hess_blocks
+        )
+        self.hess_blocks += component_blocks(
+            problem.constraints, sparsity.constr_hess_block_wrt,
+            sparsity.constr_hess_blocks
+        )
+        """Lagrangian Hessian nnz of each (function, variables) pair."""
+        
+        jac = self.pattern('jac')
+        self.jac_nnz = jac.nnz
+        """Number of unique nonzero positions of the Jacobian."""
+        
+        hess = sparse.tril(self.pattern('hess'))
+        self.hess_nnz = hess.nnz
+        """Number of unique nonzero positions of the Hessian lower triangle."""
+        
+        self.jac_bandwidth = bandwidth(jac)
+        """Lower and upper bandwidths of the Jacobian."""
+        
+        self.hess_bandwidth = bandwidth(hess)[0]
+        """Bandwidth of the Hessian."""
+        
+        kkt = sparse.tril(self.pattern('kkt'))
+        self.kkt_nnz = kkt.nnz
+        """Number of unique nonzero positions of the KKT lower triangle."""
+        
+        self.kkt_envelope = envelope(kkt)
+        """Envelope size of the KKT lower triangle, in the problem ordering.
+        
+        Upper bound on the number of strictly lower nonzeros of its LDL^T
+        factor without reordering, i.e., a worst-case fill-in estimate.
+        """
+    
+    @property
+    def index_nbytes(self):
+        """Memory used by the sparsity index arrays, by name."""
+        sparsity = self.sparsity
+        nbytes = {name: getattr(sparsity, name).nbytes
+                  for name in ('obj_hess_ind', 'constr_jac_ind',
+                               'constr_hess_ind', 'lag_hess_ind')}
+        for (name, format), assembly in sparsity.assemblies.items():
+            nbytes[f'{name}_{format}'] = assembly.nbytes
+        if sparsity.lag_hess_coalescing is not None:
+            nbytes['lag_hess_coalescing'] = sparsity.lag_hess_coalescing.nbytes
+        return nbytes
+    
+    def pattern(self, which='kkt'):
+        """Sparsity pattern as a COO matrix of ones.
+        
+        `which` is 'jac' for the (ncons, ndec) constraint Jacobian, 'hess'
+        for the symmetric (ndec, ndec) Lagrangian Hessian or 'kkt' for the
+        symmetric KKT matrix.
+        """
+        ndec = self.ndec
+        dec_ind, cons_ind = self.sparsity.constr_jac_ind
+        if which == 'jac':
+            row, col = cons_ind, dec_ind
+            shape = self.ncons, ndec
+        elif which in ('hess', 'kkt'):
+            h0, h1 = self.sparsity.lag_hess_ind
+            row, col = np.r_[h0, h1], np.r_[h1, h0]
+            if which == 'kkt':
+                row = np.r_[row, cons_ind + ndec, dec_ind]
+                col = np.r_[col, dec_ind, cons_ind + ndec]
+            shape = (ndec, ndec) if which == 'hess' else (ndec + self.ncons,) * 2
+        else:
+            raise ValueError(f"unknown sparsity pattern '{which}'")
+        
+        pattern = sparse.coo_matrix((np.ones(row.size), (row, col)), shape)
+        pattern.sum_duplicates()
+        pattern.data[:] = 1
+        return pattern
+    
+    def save_mtx(self, target, which='kkt'):
+        """Write a sparsity pattern to a Matrix Market file."""
+        from scipy import io
+        pattern = self.pattern(which)
+        symmetry = 'general' if which == 'jac' else 'symmetric'
+        io.mmwrite(target, pattern, field='pattern', symmetry=symmetry)
+    
+    def image(self, which='kkt', max_size=512):
+        """Downsampled boolean image of a sparsity pattern.
+        
+        Each pixel is set if any element of the block of the matrix it
+        covers is nonzero.
+        """
+        pattern = self.pattern(which)
+        scale = max(1, -(-max(pattern.shape) // max_size))
+        image_shape = tuple(-(-n // scale) for n in pattern.shape)
+        image = np.zeros(image_shape, bool)
+        image[pattern.row // scale, pattern.col // scale] = True
+        return image
+    
+    def save_image(self, target, which='kkt', max_size=512):
+        """Write a downsampled sparsity pattern image as a binary PBM file."""
+        image = self.image(which, max_size)
+        header = f'P4\n{image.shape[1]} {image.shape[0]}\n'.encode('ascii')
+        data = np.packbits(image, axis=1).tobytes()
+        if isinstance(target, (str, bytes)) or hasattr(target, '__fspath__'):
+            with open(target, 'wb') as f:
+                f.write(header + data)
+        else:
+            target.write(header + data)
+    
+    def __str__(self):
+        lines = [f'decision variables: {self.ndec}',
+                 f'constraints: {self.ncons}',
+                 f'Jacobian nnz: {self.jac_nnz}, '
+                 f'bandwidth (lower, upper): {self.jac_bandwidth}']
+        lines += [f'  {name} wrt {", ".join(wrt)}: {nnz}'
+                  for name, wrt, nnz in self.jac_blocks]
+        lines += [f'Hessian nnz: {self.hess_nnz} unique, '
+                  f'{self.sparsity.lag_hess_nnz} given to the solver, '
+                  f'bandwidth: {self.hess_bandwidth}']
+        lines += [f'  {name} wrt {", ".join(wrt)}: {nnz}'
+                  for name, wrt, nnz in self.hess_blocks]
+        lines += [f'KKT lower triangle nnz: {self.kkt_nnz}, '
+                  f'envelope: {self.kkt_envelope}']
+        lines += ['index memory (bytes):']
+        lines += [f'  {name}: {nbytes}'
+                  for name, nbytes in self.index_nbytes.items()]
+        return '\n'.join(lines)
+
+
+def component_blocks(components, block_wrt, block_nnz):
+    """List of (function name, variables, nnz) of the components' blocks."""
+    return [
+        (comp.name, wrt, nnz)
+        for comp, comp_wrt, comp_nnz in zip(components, block_wrt, block_nnz)
+        for wrt, nnz in zip(comp_wrt, comp_nnz)
+    ]
+
+
+def bandwidth(matrix):
+    """Lower and upper bandwidths of a COO sparse matrix."""
+    offset = np.asarray(matrix.row, int) - matrix.col
+    lower = max(0, int(offset.max(initial=0)))
+    upper = max(0, -int(offset.min(initial=0)))
+    return lower, upper
+
+
+def envelope(lower):
+    """Envelope (profile) size of a lower-triangular COO sparse matrix."""
+    first = np.arange(lower.shape[0])
+    np.minimum.at(first, lower.row, lower.col)
+    return int(np.sum(np.arange(lower.shape[0]) - first))
+
+
+def check_index_range(dtype, *counts):
+    """Ensure that indices up to the given counts are representable."""
+    limit = np.iinfo(dtype).max
+    largest = max(counts, default=0)
+    if largest > limit:
+        raise OverflowError(
+            f"problem size {largest} does not fit in {np.dtype(dtype)} "
+            f"indices, use a wider Problem.index_dtype"
+        )
+
+
+def slices_stop(slices):
+    """End of a list of consecutive slices."""
+    return slices[-1].stop if slices else 0
+
+
+def component_slices(nnz):
+    """List of consecutive slices with the given numbers of elements."""
+    slices = []
+    offset = 0
+    for comp_nnz in nnz:
+        slices.append(slice(offset, offset + comp_nnz))
+        offset += comp_nnz
+    return slices
+
+
+def fused_kwargs(fused):
+    """Keyword arguments passing a fused output to a function, if any."""
+    return {} if fused is None else dict(fused=fused)
+
+
+def readonly(a):
+    """Mark an array as read-only and return it."""
+    a.setflags(write=False)
+    return a
 
 
 class Component:
@@ -292,13 +1271,19 @@ class Component:
     @property
     def size(self):
         """Total number of elements."""
-        return np.prod(self.shape, dtype=np.intc)
+        return np.prod(self.shape, dtype=int)
     
     @property
     def slice(self):
         """This component's slice in the parent vector."""
         return slice(self.offset, self.offset + self.size)
     
+    @property
+    def parent_ind(self):
+        """Index of each element in the parent vector."""
+        ind = np.arange(self.offset, self.offset + self.size)
+        return ind.reshape(self.shape)
+    
     def unpack_from(self, vec):
         """Extract component from parent vector."""
         return np.asarray(vec)[self.slice].reshape(self.shape)
@@ -309,14 +1294,15 @@ class Component:
         destination[self.slice] += np.broadcast_to(value, self.shape).ravel()
     
     def pack_into(self, destination, value):
-        assert destination.ndim == 1
-        assert destination.size >= self.offset + self.size
-        destination[self.slice] = np.broadcast_to(value, self.shape).ravel()
+        assert destination.shape[-1] >= self.offset + self.size
+        batch_shape = destination.shape[:-1]
+        value = np.broadcast_to(value, batch_shape + self.shape)
+        destination[..., self.slice] = value.reshape(batch_shape + (-1,))
     
-    def convert_ind(self, comp_ind):
+    def convert_ind(self, comp_ind, dtype=int):
         """Convert component indices to parent vector indices."""
-        comp_ind = np.asarray(comp_ind, dtype=int)
-        return comp_ind + self.offset
+        comp_ind = np.asarray(comp_ind, dtype=dtype)
+        return comp_ind + comp_ind.dtype.type(self.offset)
 
 
 class Decision(Component):
@@ -324,7 +1310,7 @@ class Decision(Component):
 
 
 class OptimizationFunction:
-    def __init__(self, shape, fun, args=None):
+    def __init__(self, shape, fun, args=None, ext_variables=()):
         self.fun = fun
         """The underlying constraint object."""
         
@@ -341,9 +1327,151 @@ class OptimizationFunction:
         self.renamed = renamed
         """The map of function argument names to problem variable names."""
         
-    def __call__(self, variables):
-        args = (variables[arg] for arg in self.args)
-        return self.fun(*args)
+        self.ext_variables = ext_variables
+        """Problem variables vectorized along the first output axis, if not
+        known from the base shapes, see `Problem.ext_variables`."""
+        
+    def __call__(self, variables, batched=(), chunk=None, fused=None):
+        args = self.arguments(variables, batched, chunk)
+        return self.fun(*args, **fused_kwargs(fused))
+    
+    @property
+    def fused(self):
+        """Whether the function evaluates its value and derivatives together.
+        
+        The output of `fused_val` is then passed as the `fused` argument of
+        the value and derivative functions, which take their values from it.
+        """
+        return getattr(self.fun, 'fused', False)
+    
+    def fused_val(self, variables, batched=(), chunk=None):
+        """Output of the fused value and derivatives function."""
+        return self.fun.fused_val(*self.arguments(variables, batched, chunk))
+    
+    def arguments(self, variables, batched=(), chunk=None):
+        """Underlying function arguments from the problem variables.
+        
+        The variables named in `batched` have a leading batch axis. Singleton
+        axes are inserted after it so that they broadcast against the other
+        batched arguments with more vectorized (non-base) dimensions.
+        
+        If `chunk` is given, the arguments vectorized along the first
+        vectorized axis of the output are sliced with it. Those are the
+        arguments with as many vectorized dimensions as the output, and the
+        other arguments only if named in `ext_variables`.
+        """
+        args = [variables[arg] for arg in self.args]
+        if not batched and chunk is None:
+            return args
+        
+        ext_ndim = self._ext_ndim(args, batched)
+        if chunk is not None:
+            for i, axis in self._chunk_axes(args, batched, ext_ndim).items():
+                args[i] = args[i][(slice(None),) * axis + (chunk,)]
+        
+        if batched:
+            max_ext_ndim = max(ext_ndim.values(), default=0)
+            for i, ndim in ext_ndim.items():
+                if self.args[i] not in batched:
+                    continue
+                shape = np.shape(args[i])
+                pad = (1,) * (max_ext_ndim - ndim)
+                args[i] = np.reshape(args[i], shape[:1] + pad + shape[1:])
+        return args
+    
+    def _ext_ndim(self, args, batched):
+        """Number of vectorized dimensions of the arguments with base shape."""
+        base_shapes = self.base_shapes
+        fun_args = utils.sig_arg_names(self.fun)
+        ext_ndim = {}
+        for i, (fun_arg, arg) in enumerate(zip(fun_args, self.args)):
+            if fun_arg in base_shapes:
+                base_ndim = len(base_shapes[fun_arg])
+                batch_ndim = 1 if arg in batched else 0
+                ext_ndim[i] = np.ndim(args[i]) - base_ndim - batch_ndim
+        return ext_ndim
+    
+    def _chunk_axes(self, args, batched, ext_ndim):
+        """Axis of each argument sliced in chunked evaluations."""
+        out_ext = self.ext_shape
+        axes = {}
+        for i, arg in enumerate(args):
+            name = self.args[i]
+            ndim = ext_ndim.get(i)
+            if ndim is None:
+                vectorized = name in self.ext_variables
+            else:
+                vectorized = ndim == len(out_ext)
+            axis = 1 if name in batched else 0
+            if vectorized and np.shape(arg)[axis] == out_ext[0]:
+                axes[i] = axis
+        return axes
+    
+    def chunked_variables(self, variables, batched=()):
+        """Names of the variables sliced in chunked evaluations."""
+        if not self.ext_shape:
+            return set()
+        args = [variables[arg] for arg in self.args]
+        axes = self._chunk_axes(args, batched, self._ext_ndim(args, batched))
+        return {self.args[i] for i in axes}
+    
+    def chunk_view(self, out, chunk):
+        """View of the elements of a chunk evaluation in the output `out`.
+        
+        The trailing dimensions of `out` have this function's shape.
+        """
+        batch_ndim = out.ndim - len(self.shape)
+        return out[(slice(None),) * batch_ndim + (chunk,)]
+    
+    @property
+    def base_shapes(self):
+        """Base (non-vectorized) shapes of the function's model variables."""
+        base_shapes = getattr(self.fun, 'base_shapes', None)
+        if base_shapes is not None:
+            return base_shapes
+        model = getattr(self.fun, 'model', None)
+        return getattr(model, 'base_shapes', {})
+    
+    @property
+    def ext_shape(self):
+        """Vectorized (non-base) part of the function output shape."""
+        out_base_ndim = len(getattr(self.fun, 'out_shape', ()))
+        return self.shape[:len(self.shape) - out_base_ndim]
+    
+    def chunks(self, chunk_size=None, blocks=()):
+        """Slices of the first vectorized axis for chunked evaluation.
+        
+        Returns `[None]` if the function is to be evaluated at once. This is
+        also the case if the number of nonzeros of any of the derivative
+        `blocks` is not a multiple of the length of the axis, as they are then
+        not laid out by piece, e.g., if summed over a broadcast argument.
+        """
+        ext_shape = self.ext_shape
+        if chunk_size is None or not ext_shape or ext_shape[0] <= chunk_size:
+            return [None]
+        n = ext_shape[0]
+        if any(block_nnz % n for block_nnz in blocks):
+            return [None]
+        return [slice(i, min(i + chunk_size, n)) 
+                for i in range(0, n, chunk_size)]
+    
+    def chunk_blocks(self, out, blocks, chunk):
+        """Views of the derivative blocks in `out` for a chunk evaluation.
+        
+        The nonzeros of each block are laid out by piece, see `chunks`.
+        """
+        n = self.ext_shape[0]
+        batch_shape = out.shape[:-1]
+        views = []
+        offset = 0
+        for block_nnz in blocks:
+            assert block_nnz % n == 0
+            block = out[..., offset:offset + block_nnz]
+            block = block.reshape(batch_shape + (n, block_nnz // n))
+            assert np.may_share_memory(block, out)
+            views.append(block[..., chunk, :])
+            offset += block_nnz
+        return views
     
     def _rename_key(self, key):
         renamed = self.renamed
@@ -381,9 +1509,13 @@ class OptimizationFunction:
         ren_var_shapes = self.rename_kwargs(var_shapes)
         return self.rename(self.fun.hess_ind(ren_var_shapes, self.shape))
     
-    def hess_val(self, variables):
-        args = (variables[arg] for arg in self.args)
-        return self.rename(self.fun.hess_val(*args))
+    def hess_val(self, variables, out=None, batched=(), chunk=None, 
+                 fused=None):
+        args = self.arguments(variables, batched, chunk)
+        kwargs = fused_kwargs(fused)
+        if out is not None:
+            return self.fun.hess_val(*args, out=out, **kwargs)
+        return self.rename(self.fun.hess_val(*args, **kwargs))
     
     @property
     def name(self):
@@ -396,10 +1528,10 @@ class OptimizationFunction:
 class Constraint(Component, OptimizationFunction):
     """A constraint within an optimization problem."""
     
-    def __init__(self, shape, offset, fun, args=None):
+    def __init__(self, shape, offset, fun, args=None, ext_variables=()):
         # Initizalize base classes
         Component.__init__(self, shape, offset)
-        OptimizationFunction.__init__(self, shape, fun, args)
+        OptimizationFunction.__init__(self, shape, fun, args, ext_variables)
 
     def jac_nnz(self, var_shapes):
         ren_var_shapes = self.rename_kwargs(var_shapes)
@@ -409,14 +1541,129 @@ class Constraint(Component, OptimizationFunction):
         ren_var_shapes = self.rename_kwargs(var_shapes)
         return self.rename(self.fun.jac_ind(ren_var_shapes, self.shape))
     
-    def jac_val(self, variables):
-        args = (variables[arg] for arg in self.args)
-        return self.rename(self.fun.jac_val(*args))
+    def jac_val(self, variables, out=None, batched=(), chunk=None, 
+                fused=None):
+        args = self.arguments(variables, batched, chunk)
+        kwargs = fused_kwargs(fused)
+        if out is not None:
+            return self.fun.jac_val(*args, out=out, **kwargs)
+        return self.rename(self.fun.jac_val(*args, **kwargs))
 
 
 class Objective(OptimizationFunction):
     """An objective within an optimization problem."""
     
-    def grad(self, variables):
-        args = (variables[arg] for arg in self.args)
-        return self.rename(self.fun.grad(*args))
+    def grad(self, variables, batched=(), chunk=None, fused=None):
+        args = self.arguments(variables, batched, chunk)
+        return self.rename(self.fun.grad(*args, **fused_kwargs(fused)))
+
+
+class OffsetVariable:
+    """Variable of a subproblem placed at an offset of the decision vector.
+    
+    Wraps the specification of a (possibly dependent) variable of a problem
+    whose decision vector is a segment of a larger one, e.g., a phase of a
+    multi-phase problem.
+    """
+    
+    def __init__(self, spec, offset, parent_size):
+        self.spec = spec
+        """Specification of the variable in the subproblem."""
+        
+        self.offset = offset
+        """Offset of the subproblem's decision vector."""
+        
+        self.parent_size = parent_size
+        """Size of the subproblem's decision vector."""
+    
+    @property
+    def shape(self):
+        return self.spec.shape
+    
+    @property
+    def size(self):
+        return self.spec.size
+    
+    @property
+    def slice(self):
+        """Slice of the subproblem's decision vector."""
+        return slice(self.offset, self.offset + self.parent_size)
+    
+    @utils.cached_property
+    def parent_ind(self):
+        """Index of each element in the parent vector."""
+        return self.spec.parent_ind + self.offset
+    
+    def unpack_from(self, vec):
+        """Extract variable from parent vector."""
+        return self.spec.unpack_from(np.asarray(vec)[self.slice])
+    
+    def add_to(self, destination, value):
+        self.spec.add_to(destination[self.slice], value)
+    
+    def convert_ind(self, ind, dtype=int):
+        """Convert variable indices to parent vector indices."""
+        sub_ind = self.spec.convert_ind(ind, dtype)
+        return sub_ind + sub_ind.dtype.type(self.offset)
+
+
+class Linkage:
+    """Linear linkage constraint between elements of two variables.
+    
+    Its value is the difference between the selected elements of the first
+    and second variables, with the same sparse derivative interface as the
+    generated model functions.
+    """
+    
+    __name__ = 'linkage'
+    
+    def __init__(self, a_shape, a_ind, b_shape, b_ind):
+        self.a_shape = tuple(a_shape)
+        """Shape of the first variable."""
+        
+        self.b_shape = tuple(b_shape)
+        """Shape of the second variable."""
+        
+        self.a_ind = np.ravel(a_ind)
+        """Flat indices of the linked elements of the first variable."""
+        
+        self.b_ind = np.ravel(b_ind)
+        """Flat indices of the linked elements of the second variable."""
+        
+        if self.a_ind.size != self.b_ind.size:
+            raise ValueError("linked selections must have the same size")
+        
+        self.out_shape = (self.a_ind.size,)
+        """Base shape of the linkage output."""
+    
+    def __call__(self, a, b):
+        a = np.reshape(a, np.shape(a)[:np.ndim(a) - len(self.a_shape)] + (-1,))
+        b = np.reshape(b, np.shape(b)[:np.ndim(b) - len(self.b_shape)] + (-1,))
+        return a[..., self.a_ind] - b[..., self.b_ind]
+    
+    def jac_nnz(self, var_shapes, out_shape):
+        return 2 * self.a_ind.size
+    
+    def jac_ind(self, var_shapes, out_shape):
+        out_ind = np.arange(self.a_ind.size)
+        return {('a',): np.array([self.a_ind, out_ind]),
+                ('b',): np.array([self.b_ind, out_ind])}
+    
+    def jac_val(self, a, b, out=None):
+        n = self.a_ind.size
+        if out is None:
+            return {('a',): np.ones(n), ('b',): -np.ones(n)}
+        if isinstance(out, np.ndarray):
+            out = [out[..., :n], out[..., n:]]
+        out[0][...] = 1
+        out[1][...] = -1
+        return out
+    
+    def hess_nnz(self, var_shapes, out_shape):
+        return 0
+    
+    def hess_ind(self, var_shapes, out_shape):
+        return {}
+    
+    def hess_val(self, a, b, out=None):
+        return {} if out is None else out
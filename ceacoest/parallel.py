@@ -0,0 +1,188 @@
+"""Process-parallel evaluation of optimization problems."""
+
+
+import copy
+import multiprocessing
+import os
+from concurrent import futures
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+_worker_state = None
+"""Problem, shared arrays, variables and tasks of the current worker."""
+
+
+def _init_worker(problem, shm_names, shapes):
+    """Attach a worker process to the shared memory of the evaluator.
+    
+    The evaluation tasks of all functions are built once, against the
+    shared output arrays and a dictionary of variables which is refreshed
+    in place at each new decision vector.
+    """
+    global _worker_state
+    shms = {}
+    arrays = {}
+    for name, shm_name in shm_names.items():
+        shms[name] = shared_memory.SharedMemory(shm_name)
+        arrays[name] = np.ndarray(shapes[name], float, shms[name].buf)
+    
+    variables = {}
+    tasks = {}
+    for name in shapes:
+        if name in ProcessPoolEvaluator.summed:
+            tasks[name] = problem._objective_tasks(name, variables, ())
+        elif name != 'dvec':
+            tasks[name] = problem._evaluation_tasks(
+                name, variables, (), arrays[name]
+            )
+    _worker_state = problem, shms, arrays, variables, tasks
+
+
+def _evaluate(name, start, stop, part):
+    """Run a range of the evaluation tasks of `name` in a worker process.
+    
+    The objective and its gradient are sums of the tasks' terms, which are
+    accumulated in the row `part` of their output.
+    """
+    problem, shms, arrays, variables, tasks = _worker_state
+    problem.cached_variables(arrays['dvec'], out=variables)
+    if name in ProcessPoolEvaluator.summed:
+        out = arrays[name][part:part + 1].reshape(arrays[name].shape[1:])
+        out[...] = 0
+        for task in tasks[name][start:stop]:
+            task(out)
+    else:
+        for task in tasks[name][start:stop]:
+            task()
+
+
+class ProcessPoolEvaluator:
+    """Evaluates an optimization problem in a pool of worker processes.
+    
+    The decision vector and the outputs are exchanged through shared memory,
+    so that no arrays are pickled on each call. The evaluation tasks of the
+    problem, one per component or chunk of pieces, are partitioned among
+    the workers. The constraints and sparse value functions are written by
+    the workers directly into the shared buffers, while the objective and
+    its gradient are summed from one partial output per partition.
+    
+    The workers hold a deep copy of the problem made at construction, with
+    its own caches, so later changes to the problem are not seen by them.
+    Each worker builds its evaluation tasks once, and only refreshes the
+    variables they read at each new decision vector.
+    The fused function outputs cached by a worker at a point are only shared
+    by the tasks that it runs.
+    Set it as the `evaluator` of the problem to use it::
+        
+        with ProcessPoolEvaluator(problem) as evaluator:
+            problem.evaluator = evaluator
+            ...
+    
+    Only unbatched evaluations are delegated to the pool, and from a single
+    thread at a time.
+    """
+    
+    summed = frozenset({'obj', 'obj_grad'})
+    """Functions summed from the partial outputs of the partitions."""
+    
+    def __init__(self, problem, max_workers=None, chunk_size=None,
+                 mp_context=None, tasks_per_worker=4):
+        sparsity = problem.finalize()
+        worker_problem = copy.copy(problem)
+        worker_problem.executor = None
+        worker_problem.evaluator = None
+        worker_problem = copy.deepcopy(worker_problem)
+        if chunk_size is not None:
+            worker_problem.chunk_size = chunk_size
+        
+        self.problem = worker_problem
+        """Copy of the problem evaluated by the workers."""
+        
+        self.max_workers = max_workers or os.cpu_count() or 1
+        """Number of worker processes."""
+        
+        nparts = self.max_workers * tasks_per_worker
+        tasks = dict(
+            obj=worker_problem._objective_tasks('obj', None, ()),
+            obj_grad=worker_problem._objective_tasks('obj_grad', None, ()),
+        )
+        sizes = dict(
+            constr=problem.ncons,
+            obj_hess=sparsity.obj_hess_nnz,
+            constr_jac=sparsity.constr_jac_nnz,
+            constr_hess=sparsity.constr_hess_nnz,
+        )
+        for name, size in sizes.items():
+            out = np.empty(size)
+            tasks[name] = worker_problem._evaluation_tasks(name, None, (), out)
+        
+        self._partitions = {}
+        """Ranges of the evaluation tasks submitted to the workers."""
+        
+        for name, name_tasks in tasks.items():
+            ntasks = len(name_tasks)
+            bounds = np.linspace(0, ntasks, min(ntasks, nparts) + 1)
+            bounds = bounds.round().astype(int).tolist()
+            self._partitions[name] = list(zip(bounds[:-1], bounds[1:]))
+        
+        shapes = dict(dvec=(problem.ndec,), **sizes)
+        shapes['obj'] = (len(self._partitions['obj']),)
+        shapes['obj_grad'] = (len(self._partitions['obj_grad']), problem.ndec)
+        self._shms = {}
+        self._arrays = {}
+        for name, shape in shapes.items():
+            size = np.prod(shape, dtype=int)
+            nbytes = max(size, 1) * np.dtype(float).itemsize
+            shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self._shms[name] = shm
+            self._arrays[name] = np.ndarray(shape, float, shm.buf)
+        
+        fork_available = 'fork' in multiprocessing.get_all_start_methods()
+        if mp_context is None and fork_available:
+            mp_context = multiprocessing.get_context('fork')
+        shm_names = {name: shm.name for name, shm in self._shms.items()}
+        self.executor = futures.ProcessPoolExecutor(
+            self.max_workers, mp_context, initializer=_init_worker,
+            initargs=(worker_problem, shm_names, shapes)
+        )
+        """Underlying process pool."""
+    
+    def evaluate(self, name, dvec, out=None):
+        """Evaluate the function `name` at `dvec` into `out`.
+        
+        If `out` is None, the shared output array of the workers is returned
+        without copying, and its contents are only valid until the next
+        evaluation of `name`. The values are otherwise copied into `out`,
+        as the arrays returned by the problem functions are owned by their
+        callers and the output buffers of IPOPT are not in shared memory.
+        """
+        assert np.shape(dvec) == self._arrays['dvec'].shape
+        self._arrays['dvec'][...] = dvec
+        partitions = self._partitions[name]
+        pending = [self.executor.submit(_evaluate, name, start, stop, part)
+                   for part, (start, stop) in enumerate(partitions)]
+        for future in pending:
+            future.result()
+        if name in self.summed:
+            return self._arrays[name].sum(axis=0, out=out)
+        elif out is None:
+            return self._arrays[name]
+        out[...] = self._arrays[name]
+        return out
+    
+    def close(self):
+        """Shut down the workers and release the shared memory."""
+        self.executor.shutdown()
+        self._arrays.clear()
+        for shm in self._shms.values():
+            shm.close()
+            shm.unlink()
+        self._shms.clear()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
@@ -2,9 +2,11 @@
 
 
 import collections.abc
+import functools
 
 import numpy as np
-import scipy
+import scipy.linalg
+import scipy.special
 from numpy import linalg, polynomial
 
 
@@ -30,8 +32,47 @@ def lgl_points(n):
     if n < 2:
         raise ValueError("Collocation order of Lobatto methods must be > 1.")
     
-    ln = polynomial.Legendre([0]*(n - 1) + [1], [0, 1])
-    return np.r_[0.0, ln.deriv().roots(), 1.0]
+    # The interior points are the roots of the derivative of the Legendre
+    # polynomial of degree n - 1, i.e., the Gauss--Jacobi (1, 1) points,
+    # computed by the Golub--Welsch algorithm and polished by Newton's method
+    N = n - 1
+    x = scipy.special.roots_jacobi(N - 1, 1, 1)[0] if n > 2 else np.empty(0)
+    for i in range(10):
+        P, P_prev = legendre_pair(N, x)
+        dP = N * (x * P - P_prev) / (x ** 2 - 1)
+        d2P = (2 * x * dP - N * (N + 1) * P) / (1 - x ** 2)
+        step = dP / d2P
+        x = x - step
+        if np.all(np.abs(step) <= 2 * np.finfo(float).eps):
+            break
+    return np.r_[0.0, (x + 1) / 2, 1.0]
+
+
+def lgl_weights(n):
+    """Legendre Gauss Lobatto quadrature weights over the [0, 1] interval.
+    
+    >>> lgl_weights(3) * 6
+    array([1., 4., 1.])
+    
+    """
+    x = 2 * lgl_points(n) - 1
+    P = legendre_pair(n - 1, x)[0]
+    return 1 / (n * (n - 1) * P ** 2)
+
+
+def legendre_pair(N, x):
+    """Legendre polynomials of degrees `N` and `N - 1` over [-1, 1] at `x`.
+    
+    Evaluated with the three-term recurrence, for N > 0.
+    
+    >>> legendre_pair(2, np.array([0.5, 1]))
+    (array([-0.125,  1.   ]), array([0.5, 1. ]))
+    
+    """
+    P_prev, P = np.ones_like(x), x
+    for k in range(1, N):
+        P_prev, P = P, ((2 * k + 1) * x * P - k * P_prev) / (k + 1)
+    return P, P_prev
   
 
 def lagrange_basis(points):
@@ -44,6 +85,48 @@ def lagrange_basis(points):
     return l
 
 
+def barycentric_weights(points):
+    """Weights of the barycentric interpolation formula at given points.
+    
+    The weights are only defined up to a common factor, so they are scaled
+    to a unit maximum magnitude. The differences are also scaled by the
+    capacity of the interval, a quarter of its length, to keep the products
+    from overflowing or underflowing for many points.
+    
+    >>> barycentric_weights([0, 0.5, 1])
+    array([ 0.5, -1. ,  0.5])
+    
+    """
+    points = np.asarray(points, float)
+    diff = (points[:, None] - points) * (4 / np.ptp(points))
+    np.fill_diagonal(diff, 1)
+    weights = 1 / np.prod(diff, axis=1)
+    return weights / np.max(np.abs(weights))
+
+
+def differentiation_matrix(points, weights=None):
+    """Matrix of the interpolant's derivatives at the interpolation points.
+    
+    Its product with the values at the points gives the derivatives of their
+    interpolating polynomial at the points.
+    
+    >>> differentiation_matrix([0, 0.5, 1])
+    array([[-3.,  4., -1.],
+           [-1.,  0.,  1.],
+           [ 1., -4.,  3.]])
+    
+    """
+    points = np.asarray(points, float)
+    if weights is None:
+        weights = barycentric_weights(points)
+    diff = points[:, None] - points
+    np.fill_diagonal(diff, 1)
+    D = weights / weights[:, None] / diff
+    np.fill_diagonal(D, 0)
+    D[np.diag_indices_from(D)] -= D.sum(axis=1)
+    return D
+
+
 def pdinteg(p, limits, m=1):
     """Polynomial definite integral."""
     if isinstance(p, polynomial.Polynomial):
@@ -59,8 +142,6 @@ class LGLCollocation:
     
     def __init__(self, n):
         points = lgl_points(n)
-        l = lagrange_basis(points)
-        interv_integ = [pdinteg(l, points[i:i+2]) for i in range(n - 1)]
         
         self.n = n
         """Order of the collocation (number of collocation points)."""
@@ -70,11 +151,23 @@ class LGLCollocation:
         
         self.ninterv = n - 1
         """Number of collocation intervals."""
-
-        self.J = np.array(interv_integ)
+        
+        self.bary_weights = barycentric_weights(points)
+        """Barycentric interpolation weights of the collocation points."""
+        
+        self.D = differentiation_matrix(points, self.bary_weights)
+        """Differentiation matrix of the interpolant at the points."""
+        
+        # Integrate the interpolant across each interval with a Gauss rule
+        gauss_points, gauss_weights = polynomial.legendre.leggauss(n//2 + 1)
+        half_len = np.diff(points)[:, None] / 2
+        s = points[:-1, None] + half_len * (gauss_points + 1)
+        quad_weights = half_len * gauss_weights
+        
+        self.J = np.einsum('iq,iqj->ij', quad_weights, self.interp_matrix(s))
         """Coefficients of the interpolant's integral across each interval."""
          
-        self.K = np.sum(interv_integ, axis=0)
+        self.K = lgl_weights(n)
         """Coefficients of the quadrature across the whole piece."""        
 
         self.JP = np.linalg.pinv(self.J)
@@ -82,6 +175,36 @@ class LGLCollocation:
 
         self.JT_range = scipy.linalg.orth(self.J.T)
         """Orthogonal basis for the range of the J.T matrix."""
+        
+        # Use the discrete orthogonality of the Legendre polynomials under
+        # the Lobatto quadrature, exact except for the highest degree
+        norm = np.r_[2 * np.arange(n - 1) + 1, n - 1]
+        V = polynomial.legendre.legvander(2 * points - 1, n - 1)
+        self.legendre_transform = norm[:, None] * V.T * self.K
+        """Matrix of the interpolant's Legendre series from point values.
+        
+        The series is over the [0, 1] interval, shifted from [-1, 1].
+        """
+    
+    def interp_matrix(self, s):
+        """Matrix of the interpolant's weights at normalized points `s`.
+        
+        The last axis of the result indexes the collocation points, so its
+        product with the values at the points gives the interpolated values.
+        
+        >>> col = LGLCollocation(3)
+        >>> col.interp_matrix([0, 0.25])
+        array([[ 1.   ,  0.   ,  0.   ],
+               [ 0.375,  0.75 , -0.125]])
+        """
+        s = np.asarray(s, float)[..., None]
+        diff = s - self.points
+        exact = diff == 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = self.bary_weights / diff
+            weights = terms / np.sum(terms, axis=-1, keepdims=True)
+        on_point = np.any(exact, axis=-1, keepdims=True)
+        return np.where(on_point, exact, weights)
     
     def grid(self, t_piece):
         """Construct a collocation grid (fine) from a piece grid (coarse)."""
@@ -91,3 +214,19 @@ class LGLCollocation:
         increments = piece_len[:, None] * self.points[:-1]
         return np.r_[np.ravel(t_piece[:-1, None] + increments), tf]
 
+
+@functools.lru_cache()
+def lgl_collocation(n):
+    """LGL collocation of order `n`, shared by all its users in the process.
+    
+    The arrays of the returned object are read-only.
+    
+    >>> lgl_collocation(3) is lgl_collocation(3)
+    True
+    
+    """
+    collocation = LGLCollocation(n)
+    for value in vars(collocation).values():
+        if isinstance(value, np.ndarray) and value.dtype != object:
+            value.setflags(write=False)
+    return collocation
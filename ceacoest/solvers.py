@@ -0,0 +1,526 @@
+"""Nonlinear programming solvers for optimization problems.
+
+All solvers share the interface of the IPOPT `ez` problems: they are
+created with the problem and its bounds, and their `solve` method returns
+the optimal decision vector and an information dictionary with the
+constraint values `g`, the objective `obj_val`, the multipliers `mult_g`,
+`mult_x_L`, `mult_x_U` and the `status`, which is zero on success. The
+multipliers which a solver does not provide are None.
+"""
+
+
+import numbers
+import time
+
+import numpy as np
+from scipy import optimize, sparse
+from scipy.sparse import linalg
+
+
+SOLVERS = {}
+"""Registered solver classes, by name."""
+
+
+def register(cls):
+    """Class decorator registering a solver under its `name`."""
+    SOLVERS[cls.name] = cls
+    return cls
+
+
+def get(name):
+    """Get the solver class registered as `name`."""
+    try:
+        return SOLVERS[name]
+    except KeyError:
+        raise ValueError(f"unknown solver '{name}', available solvers are "
+                         f"{', '.join(SOLVERS)}") from None
+
+
+def solve(problem, dec0, d_bounds, constr_bounds, solver='ipopt', **options):
+    """Solve an optimization problem with the given solver."""
+    return get(solver)(problem, d_bounds, constr_bounds, **options).solve(dec0)
+
+
+def benchmark(problem, dec0, d_bounds, constr_bounds, solvers=None,
+              **options):
+    """Solve a problem with each solver, timing the runs.
+    
+    Returns a dictionary with the wall time, in seconds, and the solution
+    of each solver. The `options` are given to all of them. By default, all
+    the registered solvers whose backends are available are run.
+    """
+    if solvers is None:
+        solvers = [name for name, cls in SOLVERS.items() if cls.available()]
+    results = {}
+    for name in solvers:
+        start = time.perf_counter()
+        solution = solve(problem, dec0, d_bounds, constr_bounds, name,
+                         **options)
+        results[name] = time.perf_counter() - start, solution
+    return results
+
+
+class Solver:
+    """Base of the nonlinear programming solvers."""
+    
+    name = None
+    """Name under which the solver is registered."""
+    
+    def __init__(self, problem, d_bounds, constr_bounds, **options):
+        self.problem = problem
+        """The optimization problem."""
+        
+        self.d_bounds = np.asarray(d_bounds, float)
+        """Lower and upper bounds of the decision variables."""
+        
+        self.constr_bounds = np.asarray(constr_bounds, float)
+        """Lower and upper bounds of the constraints."""
+        
+        self.options = options
+        """Solver options."""
+        
+        assert self.d_bounds.shape == (2, problem.ndec)
+        assert self.constr_bounds.shape == (2, problem.ncons)
+    
+    @classmethod
+    def available(cls):
+        """Whether the backend of the solver can be used."""
+        return True
+    
+    def solve(self, dec0, mult_g=None, mult_x_L=None, mult_x_U=None):
+        """Solve the problem from the initial guess `dec0`.
+        
+        Solvers which support it use the given multipliers as warm start.
+        """
+        raise NotImplementedError
+    
+    def info(self, dec, mult_g, mult_x_L, mult_x_U, status, **extra):
+        """Build the solution information dictionary."""
+        problem = self.problem
+        info = dict(
+            g=problem.constr(dec),
+            obj_val=np.asarray(problem.obj(dec)),
+            mult_g=mult_g,
+            mult_x_L=mult_x_L,
+            mult_x_U=mult_x_U,
+            status=status,
+        )
+        info.update(extra)
+        return info
+
+
+@register
+class IpoptSolver(Solver):
+    """IPOPT through the `mseipopt` interface.
+    
+    The options are passed to IPOPT with the method matching their type.
+    """
+    
+    name = 'ipopt'
+    
+    @classmethod
+    def available(cls):
+        try:
+            import mseipopt
+        except ImportError:
+            return False
+        return True
+    
+    def solve(self, dec0, mult_g=None, mult_x_L=None, mult_x_U=None):
+        with self.problem.ipopt(self.d_bounds, self.constr_bounds) as nlp:
+            for key, value in self.options.items():
+                if isinstance(value, str):
+                    nlp.add_str_option(key, value)
+                elif isinstance(value, numbers.Integral):
+                    nlp.add_int_option(key, value)
+                else:
+                    nlp.add_num_option(key, value)
+            return nlp.solve(dec0, mult_g, mult_x_L, mult_x_U)
+
+
+class ScipySolver(Solver):
+    """Solver using `scipy.optimize.minimize`.
+    
+    The options are passed to `minimize` as its `options` argument.
+    """
+    
+    method = None
+    """The `scipy.optimize.minimize` method."""
+    
+    def solve(self, dec0, mult_g=None, mult_x_L=None, mult_x_U=None):
+        problem = self.problem
+        bounds = optimize.Bounds(*self.d_bounds)
+        constraints = self.constraints() if problem.ncons else []
+        res = optimize.minimize(
+            problem.obj, dec0, method=self.method, jac=problem.obj_grad,
+            hess=self.obj_hess(), bounds=bounds, constraints=constraints,
+            options=self.options
+        )
+        status = 0 if res.success else res.status or -1
+        extra = dict(iter_count=res.nit, message=res.message)
+        mult = self.multipliers(res)
+        return res.x, self.info(res.x, *mult, status, **extra)
+    
+    def constraints(self):
+        """List of the problem constraints in the format of the method."""
+        raise NotImplementedError
+    
+    def multipliers(self, res):
+        """The `mult_g`, `mult_x_L` and `mult_x_U` multipliers of a result.
+        
+        They follow the sign convention of IPOPT, with the Lagrangian
+        gradient `obj_grad + jac.T @ mult_g - mult_x_L + mult_x_U`.
+        """
+        raise NotImplementedError
+    
+    def obj_hess(self):
+        """Objective Hessian function, if used by the method."""
+        return None
+
+
+@register
+class TrustConstrSolver(ScipySolver):
+    """SciPy's trust-region interior-point method, with sparse derivatives."""
+    
+    name = 'trust-constr'
+    method = 'trust-constr'
+    
+    def constraints(self):
+        problem = self.problem
+        jac = lambda dec: problem.constr_jac(dec)
+        hess = lambda dec, v: problem.lag_hess(dec, 0, v)
+        return [optimize.NonlinearConstraint(
+            problem.constr, *self.constr_bounds, jac=jac, hess=hess
+        )]
+    
+    def obj_hess(self):
+        problem = self.problem
+        zeros = np.zeros(problem.ncons)
+        return lambda dec: problem.lag_hess(dec, 1, zeros)
+    
+    def multipliers(self, res):
+        """Multipliers of the constraints and of the bounds, which are last."""
+        ncons = self.problem.ncons
+        mult_g = np.array(res.v[0]) if ncons else np.zeros(0)
+        mult_bounds = np.asarray(res.v[-1])
+        return mult_g, np.maximum(-mult_bounds, 0), np.maximum(mult_bounds, 0)
+
+
+@register
+class SLSQPSolver(ScipySolver):
+    """SciPy's sequential least squares programming, with dense Jacobians.
+    
+    SLSQP does not return the multipliers of the bounds, so `mult_x_L` and
+    `mult_x_U` are None.
+    """
+    
+    name = 'slsqp'
+    method = 'SLSQP'
+    
+    @property
+    def rows(self):
+        """Rows of the equalities and of the finite lower and upper bounds."""
+        constr_L, constr_U = self.constr_bounds
+        eq = constr_L == constr_U
+        lower = ~eq & np.isfinite(constr_L)
+        upper = ~eq & np.isfinite(constr_U)
+        return tuple(map(np.flatnonzero, (eq, lower, upper)))
+    
+    def constraints(self):
+        """Equality and nonnegative inequality constraints, as in SLSQP.
+        
+        The inequalities are the distances to the finite lower bounds
+        followed by those to the finite upper bounds.
+        """
+        problem = self.problem
+        constr_L, constr_U = self.constr_bounds
+        eq, lower, upper = self.rows
+        
+        def ineq_fun(dec):
+            c = problem.constr(dec)
+            return np.r_[c[lower] - constr_L[lower], constr_U[upper] - c[upper]]
+        
+        def ineq_jac(dec):
+            jac = problem.constr_jac(dec)
+            return sparse.vstack([jac[lower], -jac[upper]]).toarray()
+        
+        constraints = []
+        if eq.size:
+            constraints.append(dict(
+                type='eq', 
+                fun=lambda dec: problem.constr(dec)[eq] - constr_L[eq],
+                jac=lambda dec: problem.constr_jac(dec)[eq].toarray(),
+            ))
+        if lower.size or upper.size:
+            constraints.append(dict(type='ineq', fun=ineq_fun, jac=ineq_jac))
+        return constraints
+    
+    def multipliers(self, res):
+        """Multipliers of the constraints, scattered back to their rows.
+        
+        SLSQP returns those of the equalities followed by the inequalities,
+        with the Lagrangian `obj - multipliers @ constraints`. They are None
+        with SciPy versions which do not return them.
+        """
+        multipliers = getattr(res, 'multipliers', None)
+        if multipliers is None:
+            return None, None, None
+        
+        eq, lower, upper = self.rows
+        mult_g = np.zeros(self.problem.ncons)
+        mult_eq, mult_L, mult_U = np.split(
+            multipliers, np.cumsum([eq.size, lower.size])
+        )
+        mult_g[eq] = -mult_eq
+        mult_g[lower] -= mult_L
+        mult_g[upper] += mult_U
+        return mult_g, None, None
+
+
+@register
+class InteriorPointSolver(Solver):
+    """Primal-dual interior-point method with sparse direct linear algebra.
+    
+    A simplified version of the IPOPT algorithm, without the filter: the
+    inequality constraints are converted to equalities with bounded slacks,
+    the bounds are handled by a logarithmic barrier with a monotone decrease
+    of the barrier parameter, and the Newton steps of the KKT conditions are
+    computed by solving the sparse KKT system with `scipy.sparse.linalg`.
+    The steps are globalized by a backtracking line search on an exact
+    penalty merit function, with Hessian regularization on negative
+    curvature.
+    
+    Options
+    -------
+    tol : float
+        Tolerance of the scaled KKT error.
+    max_iter : int
+        Maximum number of iterations.
+    mu_init : float
+        Initial barrier parameter.
+    bound_push : float
+        Minimum relative distance of the initial point to the bounds.
+    print_level : int
+        Print the progress of each iteration if positive.
+    """
+    
+    name = 'ip'
+    
+    defaults = dict(tol=1e-8, max_iter=500, mu_init=0.1, bound_push=1e-2,
+                    print_level=0)
+    """Default options."""
+    
+    def __init__(self, problem, d_bounds, constr_bounds, **options):
+        unknown = options.keys() - self.defaults.keys()
+        if unknown:
+            raise TypeError(f"unknown options {', '.join(unknown)}")
+        super().__init__(problem, d_bounds, constr_bounds,
+                         **{**self.defaults, **options})
+    
+    def solve(self, dec0, mult_g=None, mult_x_L=None, mult_x_U=None):
+        problem = self.problem
+        opts = self.options
+        tol = opts['tol']
+        ndec = problem.ndec
+        ncons = problem.ncons
+        
+        # Split equality and inequality constraints, with a slack for each
+        # inequality, so that the primal variables are z = (dec, slack)
+        constr_L, constr_U = self.constr_bounds
+        ineq = constr_L != constr_U
+        nslack = np.count_nonzero(ineq)
+        slack_sel = sparse.csr_matrix(
+            (-np.ones(nslack), (np.flatnonzero(ineq), np.arange(nslack))),
+            shape=(ncons, nslack)
+        )
+        lb = np.r_[self.d_bounds[0], constr_L[ineq]]
+        ub = np.r_[self.d_bounds[1], constr_U[ineq]]
+        
+        # Fixed variables are kept out of the barrier and the Newton steps
+        fixed = lb == ub
+        free = ~fixed
+        has_lb = np.isfinite(lb) & free
+        has_ub = np.isfinite(ub) & free
+        
+        def split(z):
+            return z[:ndec], z[ndec:]
+        
+        def residual(z):
+            dec, slack = split(z)
+            c = problem.constr(dec)
+            c[ineq] -= slack
+            c[~ineq] -= constr_L[~ineq]
+            return c
+        
+        def barrier(z, mu):
+            dec, slack = split(z)
+            dl = z[has_lb] - lb[has_lb]
+            du = ub[has_ub] - z[has_ub]
+            if np.any(dl <= 0) or np.any(du <= 0):
+                return np.inf
+            return (problem.obj(dec)
+                    - mu * np.sum(np.log(dl)) - mu * np.sum(np.log(du)))
+        
+        # Initial point, pushed strictly inside the bounds
+        dec0 = np.asarray(dec0, float)
+        z = np.r_[dec0, problem.constr(dec0)[ineq]]
+        lb_finite = np.where(has_lb, lb, 0)
+        ub_finite = np.where(has_ub, ub, 0)
+        gap = np.where(has_lb & has_ub, (ub_finite - lb_finite) / 2, np.inf)
+        push_l = opts['bound_push'] * np.maximum(1, np.abs(lb_finite))
+        push_u = opts['bound_push'] * np.maximum(1, np.abs(ub_finite))
+        z_lo = lb_finite + np.minimum(push_l, gap)
+        z_hi = ub_finite - np.minimum(push_u, gap)
+        z = np.where(has_lb, np.maximum(z, z_lo), z)
+        z = np.where(has_ub, np.minimum(z, z_hi), z)
+        z[fixed] = lb[fixed]
+        
+        mu = opts['mu_init']
+        y = np.zeros(ncons) if mult_g is None else np.array(mult_g, float)
+        zl = np.where(has_lb, mu / np.where(has_lb, z - lb, 1), 0)
+        zu = np.where(has_ub, mu / np.where(has_ub, ub - z, 1), 0)
+        if mult_x_L is not None:
+            zl[:ndec] = np.where(has_lb[:ndec], mult_x_L, 0)
+        if mult_x_U is not None:
+            zu[:ndec] = np.where(has_ub[:ndec], mult_x_U, 0)
+        
+        penalty = 1.0
+        reg = 0.0
+        status = 1
+        for iter_count in range(opts['max_iter'] + 1):
+            dec, slack = split(z)
+            c = residual(z)
+            obj_grad = np.r_[problem.obj_grad(dec), np.zeros(nslack)]
+            A = sparse.hstack([problem.constr_jac(dec), slack_sel], 'csr')
+            lag_grad = obj_grad + A.T @ y - zl + zu
+            
+            # Check convergence on the scaled KKT conditions
+            dl = np.where(has_lb, z - lb, 1)
+            du = np.where(has_ub, ub - z, 1)
+            smax = 100
+            nmult = np.sum(np.abs(y)) + np.sum(zl) + np.sum(zu)
+            sd = max(smax, nmult / max(ncons + 2 * z.size, 1)) / smax
+            sc = max(smax, (np.sum(zl) + np.sum(zu)) / max(z.size, 1)) / smax
+            compl = np.r_[(zl * dl)[has_lb], (zu * du)[has_ub]]
+            dual_err = norm_inf(lag_grad[free]) / sd
+            primal_err = norm_inf(c)
+            if max(dual_err, primal_err, norm_inf(compl) / sc) <= tol:
+                status = 0
+                break
+            
+            # Decrease the barrier parameter once its subproblem is solved
+            while mu > tol / 10:
+                mu_err = max(dual_err, primal_err, norm_inf(compl - mu) / sc)
+                if mu_err > 10 * mu:
+                    break
+                mu = max(tol / 10, min(0.2 * mu, mu ** 1.5))
+            
+            if opts['print_level'] > 0:
+                print(f'{iter_count:4d} {problem.obj(dec): .8e} '
+                      f'{primal_err:.2e} {dual_err:.2e} {mu:.1e}')
+            if iter_count == opts['max_iter']:
+                break
+            
+            # Compute the Newton step of the barrier problem
+            sigma = zl / dl * has_lb + zu / du * has_ub
+            W = sparse.block_diag(
+                [problem.lag_hess(dec, 1, y), sparse.csr_matrix((nslack,)*2)],
+                'csr'
+            )
+            barrier_grad = obj_grad - mu * has_lb / dl + mu * has_ub / du
+            rhs = -np.r_[(barrier_grad + A.T @ y)[free], c]
+            dz = np.zeros_like(z)
+            dz[free], dy, reg = self.kkt_step(
+                W[free][:, free], sigma[free], A[:, free], rhs, reg
+            )
+            dzl = (mu / dl - zl - zl / dl * dz) * has_lb
+            dzu = (mu / du - zu + zu / du * dz) * has_ub
+            
+            # Fraction to the boundary rule
+            tau = max(0.99, 1 - mu)
+            alpha_max = min(
+                boundary_step(np.where(has_lb, dl, np.inf), dz, tau),
+                boundary_step(np.where(has_ub, du, np.inf), -dz, tau),
+            )
+            alpha_dual = min(boundary_step(zl, dzl, tau, has_lb),
+                             boundary_step(zu, dzu, tau, has_ub))
+            
+            # Backtracking line search on the exact penalty merit function
+            penalty = max(penalty, 1.1 * norm_inf(y + dy))
+            c_norm = np.sum(np.abs(c))
+            merit = barrier(z, mu) + penalty * c_norm
+            slope = barrier_grad @ dz - penalty * c_norm
+            alpha = alpha_max
+            while alpha > 1e-14:
+                z_trial = z + alpha * dz
+                trial = barrier(z_trial, mu)
+                trial += penalty * np.sum(np.abs(residual(z_trial)))
+                if trial <= merit + 1e-4 * alpha * min(slope, 0):
+                    break
+                alpha /= 2
+            
+            z = z + alpha * dz
+            y = y + alpha * dy
+            zl = zl + alpha_dual * dzl
+            zu = zu + alpha_dual * dzu
+            
+            # Keep the bound multipliers close to the primal-dual central path
+            dl = np.where(has_lb, z - lb, 1)
+            du = np.where(has_ub, ub - z, 1)
+            kappa = 1e10
+            zl = np.clip(zl, mu / (kappa * dl), kappa * mu / dl) * has_lb
+            zu = np.clip(zu, mu / (kappa * du), kappa * mu / du) * has_ub
+        
+        # Multipliers of the fixed variables from the Lagrangian gradient
+        dec = split(z)[0]
+        obj_grad = np.r_[problem.obj_grad(dec), np.zeros(nslack)]
+        A = sparse.hstack([problem.constr_jac(dec), slack_sel], 'csr')
+        fixed_grad = (obj_grad + A.T @ y)[fixed]
+        zl[fixed] = np.maximum(fixed_grad, 0)
+        zu[fixed] = np.maximum(-fixed_grad, 0)
+        return dec, self.info(dec, y, zl[:ndec], zu[:ndec], status,
+                              iter_count=iter_count)
+    
+    @staticmethod
+    def kkt_step(W, sigma, A, rhs, reg):
+        """Solve the KKT system, regularizing the Hessian on bad curvature.
+        
+        Returns the primal and multiplier steps and the regularization used,
+        which is the starting point of the next iteration.
+        """
+        nz = W.shape[0]
+        ncons = A.shape[0]
+        H = W + sparse.diags(sigma)
+        reg = reg / 3 if reg > 1e-20 else 0.0
+        while True:
+            Hreg = H + reg * sparse.eye(nz) if reg else H
+            K = sparse.bmat([[Hreg, A.T], [A, -1e-8 * sparse.eye(ncons)]],
+                            'csc')
+            sol = linalg.spsolve(K, rhs)
+            dz = sol[:nz]
+            curvature = dz @ (Hreg @ dz)
+            if (np.all(np.isfinite(sol))
+                and curvature >= 1e-10 * (dz @ dz)):
+                return dz, sol[nz:], reg
+            if reg > 1e40:
+                raise RuntimeError('unable to regularize the KKT system')
+            reg = 1e-4 if reg == 0 else 8 * reg
+
+
+def norm_inf(a):
+    """Infinity norm of a vector, zero if empty."""
+    return np.max(np.abs(a), initial=0)
+
+
+def boundary_step(dist, step, tau, mask=None):
+    """Largest step length keeping a fraction `tau` of the distance `dist`.
+    
+    Only the elements selected by `mask` are considered.
+    """
+    if mask is not None:
+        dist = dist[mask]
+        step = step[mask]
+    decreasing = step < 0
+    if not np.any(decreasing):
+        return 1.0
+    return min(1.0, np.min(-tau * dist[decreasing] / step[decreasing]))
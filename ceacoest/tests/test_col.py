@@ -0,0 +1,176 @@
+"""Collocation problem common code test module."""
+
+
+import numpy as np
+import pytest
+
+from ceacoest import col, optim, utils
+from ceacoest.modelling import genoptim
+from .test_optim import point_values, seed
+
+
+from ceacoest.testsupport.array_cmp import ArrayDiff
+
+
+class PendulumModel(metaclass=genoptim.optimization_meta):
+    """Pendulum collocation model with the point function of its ODE.
+    
+    Written in the layout of the models generated without the symbolic
+    collocation functions, which are evaluated from `f` for any order.
+    """
+    
+    collocation_order = 3
+    
+    nx = 2
+    
+    base_shapes = {'x': (2,)}
+    
+    constraints = {}
+    
+    objectives = {}
+    
+    point_functions = {
+        'f': dict(shape=(2,), jac={('x',): 'df_dx'}, 
+                  hess={('x', 'x'): 'd2f_dx2'}),
+    }
+    
+    def f(self, x):
+        """ODE function."""
+        return point_values(x, x[..., 1], -np.sin(x[..., 0]))
+    
+    df_dx_ind = np.array([[1, 0], [0, 1]])
+    df_dx_nnz = 2
+    
+    def df_dx_val(self, x):
+        return point_values(x, 1, -np.cos(x[..., 0]))
+    
+    d2f_dx2_ind = np.array([[0], [0], [1]])
+    d2f_dx2_nnz = 1
+    
+    def d2f_dx2_val(self, x):
+        return point_values(x, np.sin(x[..., 0]))
+
+
+class TrapezoidalPendulumModel(PendulumModel, 
+                               metaclass=genoptim.optimization_meta):
+    """Pendulum model with the symbolic defects of 2-point collocation."""
+    
+    collocation_order = 2
+    
+    base_shapes = {'x': (2,), 'xp': (2, 2)}
+    
+    constraints = {
+        'e': dict(shape=(1, 2), jac={('xp',): 'de_dxp'}, 
+                  hess={('xp', 'xp'): 'd2e_dxp2'}),
+    }
+    
+    def e(self, xp, piece_len):
+        """Collocation defects."""
+        x0, x1 = xp[..., 0, :], xp[..., 1, :]
+        f_sum = self.f(x0) + self.f(x1)
+        defects = x1 - x0 - 0.5 * np.asarray(piece_len)[..., None] * f_sum
+        return defects[..., None, :]
+    
+    de_dxp_ind = np.array([[0, 1, 2, 3, 0, 1, 2, 3], [0, 0, 0, 0, 1, 1, 1, 1]])
+    de_dxp_nnz = 8
+    
+    def de_dxp_val(self, xp, piece_len):
+        x0 = xp[..., 0, :]
+        h = 0.5 * np.asarray(piece_len)
+        cos0, cos1 = np.cos(xp[..., 0, 0]), np.cos(xp[..., 1, 0])
+        return point_values(x0, -1, -h, 1, -h, h * cos0, -1, h * cos1, 1)
+    
+    d2e_dxp2_ind = np.array([[0, 2], [0, 2], [1, 1]])
+    d2e_dxp2_nnz = 2
+    
+    def d2e_dxp2_val(self, xp, piece_len):
+        x0 = xp[..., 0, :]
+        h = 0.5 * np.asarray(piece_len)
+        sin0, sin1 = np.sin(xp[..., 0, 0]), np.sin(xp[..., 1, 0])
+        return point_values(x0, -h * sin0, -h * sin1)
+
+
+@pytest.fixture(params=[2, 3, 5], ids=lambda i: f'{i}ord-col')
+def ncol(request):
+    """Number of collocation points per piece."""
+    return request.param
+
+
+@pytest.fixture(params=[1, 2, 4], ids=lambda i: f'{i}piece')
+def npieces(request):
+    """Number of collocation pieces."""
+    return request.param
+
+
+@pytest.fixture
+def xp(ncol, npieces):
+    """Piece-ravelled variable with an offset into the decision vector."""
+    npoints = npieces * (ncol - 1) + 1
+    x = optim.Decision((npoints, 3), 2)
+    return col.PieceRavelledVariable(x, npieces, ncol)
+
+
+def test_piece_ravelled_unpack(xp, seed):
+    vec = np.random.randn(xp.unravelled.offset + xp.unravelled.size)
+    x = xp.unravelled.unpack_from(vec)
+    unpacked = xp.unpack_from(vec)
+    ninterv = xp.ncol - 1
+    assert unpacked.shape == xp.shape
+    assert not unpacked.flags.writeable
+    for k in range(xp.npieces):
+        piece = x[k * ninterv : (k + 1) * ninterv + 1]
+        assert ArrayDiff(unpacked[k], piece) < 1e-15
+
+
+def test_piece_ravelled_add_to(xp, seed):
+    value = np.random.randn(*xp.shape)
+    dest = np.random.randn(xp.unravelled.offset + xp.unravelled.size)
+    expected = dest.copy()
+    np.add.at(expected, xp.convert_ind(np.arange(xp.size)), value.ravel())
+    xp.add_to(dest, value)
+    assert ArrayDiff(dest, expected) < 1e-12
+
+
+def test_missing_order_model():
+    model = TrapezoidalPendulumModel()
+    model.point_functions = {}
+    t = np.linspace(0, 1, 3)
+    col.Problem(model, t, 2)
+    with pytest.raises(ValueError):
+        col.Problem(model, t, [2, 3])
+
+
+def test_mixed_symbolic_order(seed):
+    model = TrapezoidalPendulumModel()
+    problem = col.Problem(model, np.linspace(0, 1, 5), [2, 3, 2, 3])
+    defects = dict(zip(problem.piece_groups, problem.constraints))
+    assert not isinstance(defects[2].fun, col.CollocationDefects)
+    assert isinstance(defects[3].fun, col.CollocationDefects)
+    
+    dec = np.random.randn(problem.ndec)
+    variables = problem.variables(dec)
+    constr = problem.constr(dec)
+    for n, e in defects.items():
+        fun = col.CollocationDefects(model, problem.collocations[n])
+        expected = fun(variables[f'xp_{n}'], variables[f'piece_len_{n}'])
+        assert ArrayDiff(e.unpack_from(constr), expected) < 1e-12, n
+    
+    jac = problem.constr_jac(dec).toarray()
+    jac_num = utils.central_diff(problem.constr, dec).T
+    assert ArrayDiff(jac, jac_num) < 1e-6
+
+
+def test_chunked_piece_len(seed):
+    model = TrapezoidalPendulumModel()
+    problem = col.Problem(model, np.linspace(0, 1, 8), [2, 3, 2, 3, 2, 3, 2])
+    dec = np.random.randn(problem.ndec)
+    names = ('constr', 'constr_jac_val', 'constr_hess_val')
+    whole = [getattr(problem, name)(dec) for name in names]
+    
+    problem.chunk_size = 2
+    variables = problem.variables(dec)
+    for n, e in zip(problem.piece_groups, problem.constraints):
+        chunked = e.chunked_variables(variables)
+        assert chunked == {f'xp_{n}', f'piece_len_{n}'}
+    for name, expected in zip(names, whole):
+        assert ArrayDiff(getattr(problem, name)(dec), expected) < 1e-12, name
@@ -1,7 +1,9 @@
 """Optimal control test module."""
 
 
+import collections
 import functools
+import itertools
 
 import numpy as np
 import pytest
@@ -9,10 +11,17 @@ import sympy
 import sym2num.model
 import sym2num.var
 
-from ceacoest import oc
-from ceacoest.modelling import symoc
+from ceacoest import oc, utils
+from ceacoest.modelling import symoc, symoptim
 from .test_optim import (test_merit_gradient, test_merit_hessian, 
                          test_constraint_jacobian, test_constraint_hessian,
+                         test_sparsity_cache, test_index_dtype,
+                         test_parent_ind, test_sparse_val_out,
+                         test_variables_cache, test_constr_jac_matrix,
+                         test_lag_hess_matrix, test_lag_hess_coalesced,
+                         test_sparsity_report, test_batch_evaluation,
+                         test_parallel_evaluation, test_chunked_evaluation,
+                         test_process_pool_evaluation, test_compile,
                          seed, dec)
 
 
@@ -25,14 +34,18 @@ def collocation_order(request):
     return request.param
 
 
-@pytest.fixture(scope='module')
-def model(collocation_order):
-    """Optimal control collocation model."""
+@functools.lru_cache()
+def generated_model(collocation_order, point_collocation=False, fused=False):
+    """Optimal control collocation model of a given order."""
     
     @symoc.collocate(order=collocation_order)
     class SymbolicModel:
         """Symbolic optimal control test model."""
         
+        symbolic_collocation = not point_collocation
+        
+        fused_derivatives = fused
+        
         @property
         @functools.lru_cache()
         def variables(self):
@@ -84,10 +97,16 @@ def model(collocation_order):
         
         
     symb_mdl = SymbolicModel()
-    GeneratedModel = sym2num.model.compile_class(symb_mdl)
+    GeneratedModel = symoptim.compile_class(symb_mdl)
     return GeneratedModel()
 
 
+@pytest.fixture(scope='module')
+def model(collocation_order):
+    """Optimal control collocation model."""
+    return generated_model(collocation_order)
+
+
 @pytest.fixture(params=[1, 2, 4], ids=lambda i: f'{i}piece')
 def npieces(request):
     """Number of collocation pieces."""
@@ -99,3 +118,286 @@ def problem(model, npieces):
     """Optimal control problem."""
     t = np.linspace(0, 1, npieces + 1)
     return oc.Problem(model, t)
+
+
+def test_warm_start_same_grid(problem, dec, seed):
+    info = dict(mult_g=np.random.randn(problem.ncons),
+                mult_x_L=np.random.rand(problem.ndec),
+                mult_x_U=np.random.rand(problem.ndec))
+    warm_start = oc.WarmStart(problem, dec, info)
+    dec0, mult = warm_start.shift(problem)
+    assert ArrayDiff(dec0, dec) < 1e-10
+    for name, value in mult.items():
+        assert ArrayDiff(value, info[name]) < 1e-10, name
+
+
+def test_warm_start_missing_mult(problem, dec, seed):
+    info = dict(mult_g=np.random.randn(problem.ncons),
+                mult_x_L=None, mult_x_U=None)
+    warm_start = oc.WarmStart(problem, dec, info)
+    dec0, mult = warm_start.shift(problem)
+    assert mult.keys() == {'mult_g'}
+    assert ArrayDiff(mult['mult_g'], info['mult_g']) < 1e-10
+
+
+def test_interpolate(problem):
+    ninterv = problem.collocation.ninterv
+    values = np.random.randn(problem.npoints, 2)
+    assert ArrayDiff(problem.interpolate(values, problem.tc), values) < 1e-12
+    
+    # Polynomials of the collocation degree are interpolated exactly
+    t = np.linspace(problem.t[0], problem.t[-1], 13)
+    poly = lambda t: np.c_[t ** ninterv, 1 - t]
+    assert ArrayDiff(problem.interpolate(poly(problem.tc), t), poly(t)) < 1e-10
+
+
+def test_interpolant(problem, seed):
+    values = np.random.randn(problem.npoints, 2, 3)
+    interpolant = problem.interpolant(values)
+    assert ArrayDiff(interpolant(problem.tc), values) < 1e-12
+    
+    t = np.random.uniform(problem.t[0], problem.t[-1], (4, 5))
+    col = problem.collocation
+    k = np.clip(np.searchsorted(problem.t, t, 'right') - 1, 0, 
+                problem.npieces - 1)
+    s = (t - problem.t[k]) / problem.piece_len[k]
+    ind = problem.piece_start[k, None] + np.arange(col.n)
+    expected = np.einsum('...i,...ijk->...jk', col.interp_matrix(s), 
+                         values[ind])
+    assert ArrayDiff(interpolant(t), expected) < 1e-12
+
+
+def test_warm_start_offset(problem, dec, seed):
+    info = dict(mult_g=np.zeros(problem.ncons),
+                mult_x_L=np.zeros(problem.ndec),
+                mult_x_U=np.zeros(problem.ndec))
+    warm_start = oc.WarmStart(problem, dec, info)
+    offset = 0.3 * problem.piece_len[0]
+    dec0, mult = warm_start.shift(problem, offset)
+    x = problem.variables(dec)['x']
+    x0 = problem.variables(dec0)['x']
+    assert ArrayDiff(x0, problem.interpolate(x, problem.tc + offset)) < 1e-12
+    assert ArrayDiff(problem.variables(dec0)['p'], 
+                     problem.variables(dec)['p']) < 1e-15
+
+
+@pytest.fixture
+def multi_phase(model, npieces):
+    """Two-phase optimal control problem with state continuity."""
+    first = oc.Problem(model, np.linspace(0, 1, npieces + 1))
+    second = oc.Problem(model, np.linspace(1, 3, npieces + 2))
+    problem = oc.MultiPhaseProblem([('first', first), ('second', second)])
+    problem.link_states('first', 'second')
+    return problem
+
+
+def test_multi_phase(multi_phase, seed):
+    problem = multi_phase
+    first, second = problem.phases.values()
+    dec = np.random.randn(problem.ndec)
+    first_dec = problem.phase_dec('first', dec)
+    second_dec = problem.phase_dec('second', dec)
+    
+    obj = first.obj(first_dec) + second.obj(second_dec)
+    assert ArrayDiff(problem.obj(dec), obj) < 1e-10
+    
+    x_first = first.variables(first_dec)['x']
+    x_second = second.variables(second_dec)['x']
+    linkage = problem.constraints[-1]
+    linkage_val = linkage.unpack_from(problem.constr(dec))
+    assert ArrayDiff(linkage_val, x_first[-1] - x_second[0]) < 1e-15
+    
+    jac = problem.constr_jac(dec).toarray()
+    jac_num = utils.central_diff(problem.constr, dec).T
+    assert ArrayDiff(jac, jac_num) < 1e-6
+
+
+def test_mpc_step(model, seed):
+    problem = oc.Problem(model, np.linspace(0, 1, 5))
+    d_bounds = np.repeat([[-2.0], [2.0]], problem.ndec, axis=-1)
+    constr_bounds = np.zeros((2, problem.ncons))
+    for constr in problem.constraints[1:]:
+        constr_bounds[:, constr.slice] = [[-10], [10]]
+    mpc = oc.MPC(problem, d_bounds, constr_bounds, 'ip', max_iter=100)
+    
+    # Record the initial guesses given to the solver
+    guesses = []
+    solver_solve = mpc.solver.solve
+    def solve(dec0, **mult):
+        guesses.append(dec0.copy())
+        return solver_solve(dec0, **mult)
+    mpc.solver.solve = solve
+    
+    x0 = np.array([0.1, 0.2, 0.1])
+    p = np.array([0.5, 0.3])
+    dt = 0.1
+    for k in range(3):
+        if k:
+            shifted, _ = mpc.warm_start.shift(problem, dt)
+        decopt, info = mpc.step(x0, k * dt, p=p)
+        assert info['status'] == 0
+        
+        variables = problem.variables(decopt)
+        assert ArrayDiff(variables['x'][0], x0) < 1e-8
+        assert ArrayDiff(variables['p'], p) < 1e-8
+        assert np.array_equal(problem.variables(mpc.d_bounds[0])['p'], p)
+        assert np.array_equal(problem.variables(mpc.d_bounds[1])['p'], p)
+        if k:
+            free = mpc.d_bounds[0] != mpc.d_bounds[1]
+            assert ArrayDiff(guesses[k][free], shifted[free]) < 1e-12
+    
+    with pytest.raises(ValueError):
+        mpc.step(x0, 3 * dt, not_a_variable=0)
+    with pytest.raises(ValueError):
+        mpc.step(x0, 3 * dt, x=x0)
+
+
+def test_piece_errors(problem, dec):
+    errors = problem.piece_errors(dec)
+    assert errors.shape == (problem.npieces,)
+    assert np.all(errors >= 0)
+
+
+def refinement_bounds(problem):
+    """Bounds of the mesh refinement test problems."""
+    d_bounds = np.repeat([[-2.0], [2.0]], problem.ndec, axis=-1)
+    var_L, var_U = map(problem.variables, d_bounds)
+    var_L['x'][0] = var_U['x'][0] = [0.1, 0.2, 0.1]
+    var_L['p'][:] = var_U['p'][:] = [0.5, 0.3]
+    constr_bounds = np.zeros((2, problem.ncons))
+    for constr in problem.constraints[len(problem.piece_groups):]:
+        constr_bounds[:, constr.slice] = [[-10], [10]]
+    return d_bounds, constr_bounds
+
+
+def check_refinement(model, order=None, **options):
+    """Check that mesh refinement only refines the inaccurate pieces."""
+    t = np.linspace(0, 1, 3)
+    tol = 1e-5
+    args = (refinement_bounds, lambda problem: np.zeros(problem.ndec), 'ip')
+    options.update(tol=tol, order=order)
+    coarse, dec, info = oc.refine_mesh(model, t, *args, max_iter=0, **options)
+    errors = info['piece_errors']
+    assert np.any(errors > tol)
+    
+    refined, dec, info = oc.refine_mesh(model, t, *args, max_iter=1, **options)
+    for k, err in enumerate(errors):
+        inside = np.flatnonzero((refined.t >= t[k]) & (refined.t < t[k + 1]))
+        unchanged = inside.size == 1 and refined.order[inside] == coarse.order[k]
+        assert unchanged == (err <= tol)
+    
+    final, dec, info = oc.refine_mesh(model, t, *args, **options)
+    assert info['status'] == 0
+    assert np.all(info['piece_errors'] <= tol)
+    return final
+
+
+def test_refine_mesh(model):
+    final = check_refinement(model)
+    assert final.npieces > 2
+    assert np.all(final.order == model.collocation_order)
+
+
+def test_refine_mesh_order():
+    point_model = generated_model(2, point_collocation=True)
+    final = check_refinement(point_model, order=3, max_order=8)
+    assert np.any(final.order > 3)
+
+
+def test_mixed_order(model, seed):
+    models = [model, generated_model(3)]
+    order = [3, model.collocation_order, 3, model.collocation_order]
+    problem = oc.Problem(models, np.linspace(0, 1, 5), order)
+    assert problem.npoints == sum(order) - 3
+    assert abs(problem.point_weights.sum() - 1) < 1e-12
+    
+    values = np.random.randn(problem.npoints, 2)
+    assert ArrayDiff(problem.interpolate(values, problem.tc), values) < 1e-12
+    
+    dec = np.random.randn(problem.ndec)
+    grad = problem.obj_grad(dec)
+    grad_num = utils.central_diff(problem.obj, dec)
+    assert ArrayDiff(grad, grad_num) < 1e-6
+    jac = problem.constr_jac(dec).toarray()
+    jac_num = utils.central_diff(problem.constr, dec).T
+    assert ArrayDiff(jac, jac_num) < 1e-6
+
+
+def test_point_collocation(model, npieces, seed):
+    t = np.linspace(0, 1, npieces + 1)
+    problem = oc.Problem(model, t)
+    point_model = generated_model(2, point_collocation=True)
+    point_problem = oc.Problem(point_model, t, model.collocation_order)
+    assert point_problem.ndec == problem.ndec
+    assert point_problem.ncons == problem.ncons
+    
+    dec = np.random.randn(problem.ndec)
+    mult = np.random.randn(problem.ncons)
+    for name in 'obj', 'obj_grad', 'constr':
+        value = getattr(point_problem, name)(dec)
+        assert ArrayDiff(value, getattr(problem, name)(dec)) < 1e-10, name
+    jac = point_problem.constr_jac(dec).toarray()
+    assert ArrayDiff(jac, problem.constr_jac(dec).toarray()) < 1e-10
+    hess = point_problem.lag_hess(dec, 2.0, mult).toarray()
+    assert ArrayDiff(hess, problem.lag_hess(dec, 2.0, mult).toarray()) < 1e-10
+
+
+@pytest.mark.parametrize('point_collocation', [False, True])
+def test_fused_derivatives(model, npieces, point_collocation, seed):
+    t = np.linspace(0, 1, npieces + 1)
+    order = model.collocation_order
+    problem = oc.Problem(model, t)
+    fused_model = type(generated_model(order, point_collocation, fused=True))()
+    fused_problem = oc.Problem(fused_model, t, order)
+    
+    # Count the calls of the fused functions
+    calls = collections.Counter()
+    descs = itertools.chain(fused_model.constraints.values(),
+                            fused_model.point_functions.values())
+    for desc in descs:
+        name = desc['fused']['name']
+        def counted(*args, name=name, fun=getattr(fused_model, name)):
+            calls[name] += 1
+            return fun(*args)
+        setattr(fused_model, name, counted)
+    
+    dec = np.random.randn(problem.ndec)
+    mult = np.random.randn(problem.ncons)
+    assert abs(fused_problem.obj(dec) - problem.obj(dec)) < 1e-10
+    assert ArrayDiff(fused_problem.constr(dec), problem.constr(dec)) < 1e-10
+    grad = fused_problem.obj_grad(dec)
+    assert ArrayDiff(grad, problem.obj_grad(dec)) < 1e-10
+    jac = fused_problem.constr_jac(dec).toarray()
+    assert ArrayDiff(jac, problem.constr_jac(dec).toarray()) < 1e-10
+    hess = fused_problem.lag_hess(dec, 2.0, mult).toarray()
+    assert ArrayDiff(hess, problem.lag_hess(dec, 2.0, mult).toarray()) < 1e-10
+    
+    # Each fused function is evaluated once per point
+    assert calls and set(calls.values()) == {1}
+
+
+@pytest.mark.parametrize('point_collocation', [False, True])
+def test_fused_chunk_memory(model, point_collocation, seed):
+    order = model.collocation_order
+    fused_model = generated_model(order, point_collocation, fused=True)
+    ncached = []
+    for npieces in (4, 8):
+        t = np.linspace(0, 1, npieces + 1)
+        problem = oc.Problem(fused_model, t, order)
+        dec = np.random.randn(problem.ndec)
+        mult = np.random.randn(problem.ncons)
+        whole = [problem.obj_grad(dec), problem.constr(dec),
+                 problem.constr_jac_val(dec), 
+                 problem.lag_hess_val(dec, 2.0, mult)]
+        
+        problem.chunk_size = 2
+        problem.invalidate()
+        chunked = [problem.obj_grad(dec), problem.constr(dec),
+                   problem.constr_jac_val(dec), 
+                   problem.lag_hess_val(dec, 2.0, mult)]
+        for a, b in zip(whole, chunked):
+            assert ArrayDiff(a, b) < 1e-10
+        
+        # Only the unchunked fused outputs are kept at the point
+        ncached.append(len(problem._variables_cache[2]))
+    assert ncached[0] == ncached[1]
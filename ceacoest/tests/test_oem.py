@@ -13,6 +13,13 @@ from ceacoest import oem
 from ceacoest.modelling import symoem
 from .test_optim import (test_merit_gradient, test_merit_hessian, 
                          test_constraint_jacobian, test_constraint_hessian,
+                         test_sparsity_cache, test_index_dtype,
+                         test_parent_ind, test_sparse_val_out,
+                         test_variables_cache, test_constr_jac_matrix,
+                         test_lag_hess_matrix, test_lag_hess_coalesced,
+                         test_sparsity_report, test_batch_evaluation,
+                         test_parallel_evaluation, test_chunked_evaluation,
+                         test_process_pool_evaluation, test_compile,
                          seed, dec)
 
 
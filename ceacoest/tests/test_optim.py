@@ -1,11 +1,16 @@
 """Optimization problem tests and test infrastructure."""
 
 
+import copy
+import pickle
+from concurrent import futures
+
 import numpy as np
 import pytest
-from scipy import sparse
+from scipy import io, sparse
 
-from ceacoest import utils
+from ceacoest import optim, parallel, utils
+from ceacoest.modelling import genoptim
 from ceacoest.testsupport.array_cmp import ArrayDiff
 
 
@@ -22,41 +27,42 @@ def sparse_fun_to_full(val, ind, shape, fix_sym=False):
 
 
 def full_hessian(problem):
-    ind = problem.merit_hessian_ind()
+    ind = problem.obj_hess_ind
     shape = (problem.ndec,) * 2
-    return sparse_fun_to_full(problem.merit_hessian_val, ind, shape, True)
+    return sparse_fun_to_full(problem.obj_hess_val, ind, shape, True)
 
 
 def full_jac(problem):
-    ind = problem.constraint_jacobian_ind()
+    ind = problem.constr_jac_ind
     shape = (problem.ndec, problem.ncons)
-    return sparse_fun_to_full(problem.constraint_jacobian_val, ind, shape)
+    return sparse_fun_to_full(problem.constr_jac_val, ind, shape)
 
 
 def full_cons_hessian(problem):
-    ind = problem.constraint_hessian_ind()
+    ind = problem.lag_hess_ind
     shape = (problem.ndec,) * 2
-    return sparse_fun_to_full(problem.constraint_hessian_val, ind, shape, True)
+    val = lambda dvec, mult: problem.lag_hess_val(dvec, 0, mult)
+    return sparse_fun_to_full(val, ind, shape, True)
 
 
 def test_merit_gradient(problem, dec):
     dec = np.random.randn(problem.ndec) if dec is None else dec
-    grad = problem.merit_gradient(dec)
-    merit_diff = utils.central_diff(problem.merit, dec)
+    grad = problem.obj_grad(dec)
+    merit_diff = utils.central_diff(problem.obj, dec)
     assert ArrayDiff(grad, merit_diff) < 1e-7
 
 
 def test_merit_hessian(problem, dec):
     dec = np.random.randn(problem.ndec) if dec is None else dec
     hess = full_hessian(problem)(dec)
-    grad_diff = utils.central_diff(problem.merit_gradient, dec)
+    grad_diff = utils.central_diff(problem.obj_grad, dec)
     assert ArrayDiff(hess, grad_diff) < 1e-7
 
 
 def test_constraint_jacobian(problem, dec):
     dec = np.random.randn(problem.ndec) if dec is None else dec
     jac = full_jac(problem)(dec)
-    cons_diff = utils.central_diff(problem.constraint, dec)
+    cons_diff = utils.central_diff(problem.constr, dec)
     assert ArrayDiff(jac, cons_diff) < 1e-7
 
 
@@ -71,10 +77,509 @@ def test_constraint_hessian(problem, dec):
         assert ArrayDiff(H, jac_diff[:,:,i]) < 1e-7, f'{i}-th constraint'
 
 
-@pytest.fixture(params=[])
+def test_sparsity_cache(problem):
+    sparsity = problem.finalize()
+    assert problem.sparsity is sparsity
+    assert problem.constr_jac_ind is sparsity.constr_jac_ind
+    assert not problem.lag_hess_ind.flags.writeable
+    
+    problem.add_decision('extra_decision', 1)
+    assert problem.sparsity is not sparsity
+
+
+def test_index_dtype(problem):
+    assert problem.constr_jac_ind.dtype == np.int32
+    assert problem.lag_hess_ind.dtype == np.int32
+    jac_ind = problem.constr_jac_ind
+    
+    problem.index_dtype = np.int64
+    assert problem.constr_jac_ind.dtype == np.int64
+    assert np.array_equal(problem.constr_jac_ind, jac_ind)
+    
+    problem.index_dtype = np.int8
+    problem.add_decision('large_decision', 200)
+    with pytest.raises(OverflowError):
+        problem.finalize()
+
+
+def test_parent_ind(problem):
+    dvec = np.arange(problem.ndec, dtype=float)
+    for name in problem.variable_shapes:
+        spec = problem.variable_spec(name)
+        assert np.array_equal(spec.unpack_from(dvec), spec.parent_ind), name
+
+
+def test_sparse_val_out(problem, dec):
+    mult = np.random.randn(problem.ncons)
+    jac = np.empty(problem.constr_jac_nnz)
+    hess = np.empty(problem.lag_hess_nnz)
+    assert problem.constr_jac_val(dec, out=jac) is jac
+    assert problem.lag_hess_val(dec, 1.5, mult, out=hess) is hess
+    assert ArrayDiff(jac, problem.constr_jac_val(dec)) < 1e-15
+    assert ArrayDiff(hess, problem.lag_hess_val(dec, 1.5, mult)) < 1e-15
+
+
+def test_variables_cache(problem, dec):
+    variables = problem.cached_variables(dec)
+    assert problem.cached_variables(dec.copy())['x'] is variables['x']
+    
+    dec_copy = dec.copy()
+    problem.cached_variables(dec_copy)
+    dec_copy += 1
+    assert problem.cached_variables(dec_copy)['x'] is not variables['x']
+    assert ArrayDiff(problem.cached_variables(dec)['x'], variables['x']) < 1e-15
+    
+    problem.variables(dec_copy)['x'][...] = 0
+    assert ArrayDiff(problem.cached_variables(dec_copy)['x'], 0) < 1e-15
+    
+    out = {}
+    assert problem.cached_variables(dec, out=out) is out
+    assert problem.cached_variables(dec, out=out) is out
+    assert ArrayDiff(out['x'], variables['x']) < 1e-15
+    assert problem.cached_variables(dec_copy, out=out) is out
+    assert ArrayDiff(out['x'], 0) < 1e-15
+
+
+def test_constr_jac_matrix(problem, dec):
+    shape = (problem.ncons, problem.ndec)
+    ind = problem.constr_jac_ind[::-1]
+    val = problem.constr_jac_val(dec)
+    expected = sparse.coo_matrix((val, ind), shape=shape).toarray()
+    for format in ('csr', 'csc'):
+        J = problem.constr_jac(dec, format)
+        assert J.format == format
+        assert ArrayDiff(J.toarray(), expected) < 1e-12
+        assert problem.constr_jac(dec, format, out=J) is J
+
+
+def test_lag_hess_matrix(problem, dec):
+    mult = np.random.randn(problem.ncons)
+    shape = (problem.ndec,) * 2
+    ind = problem.lag_hess_ind
+    val = problem.lag_hess_val(dec, 2.0, mult)
+    A = sparse.coo_matrix((val, ind), shape=shape).toarray()
+    expected = A + A.T - np.diag(np.diag(A))
+    H = problem.lag_hess(dec, 2.0, mult)
+    assert ArrayDiff(H.toarray(), expected) < 1e-12
+
+
+def test_lag_hess_coalesced(problem, dec):
+    mult = np.random.randn(problem.ncons)
+    shape = (problem.ndec,) * 2
+    H = problem.lag_hess(dec, 2.0, mult).toarray()
+    
+    problem.coalesce_hessian = True
+    ind = problem.lag_hess_ind
+    val = problem.lag_hess_val(dec, 2.0, mult)
+    assert np.all(ind[0] >= ind[1])
+    assert len(set(zip(*ind))) == ind.shape[1] == val.size
+    A = sparse.coo_matrix((val, ind), shape=shape).toarray()
+    assert ArrayDiff(A + A.T - np.diag(np.diag(A)), H) < 1e-12
+    assert ArrayDiff(problem.lag_hess(dec, 2.0, mult).toarray(), H) < 1e-12
+
+
+def test_batch_evaluation(problem, seed):
+    nbatch = 3
+    dvec = np.random.randn(nbatch, problem.ndec)
+    constr_mult = np.random.randn(nbatch, problem.ncons)
+    obj_mult = np.random.randn(nbatch)
+    for name in ('obj', 'obj_grad', 'constr', 'constr_jac_val'):
+        fun = getattr(problem, name)
+        batch = fun(dvec)
+        single = [fun(d) for d in dvec]
+        assert ArrayDiff(batch, single) < 1e-12, name
+    
+    batch = problem.lag_hess_val(dvec, obj_mult, constr_mult)
+    single = [problem.lag_hess_val(*args) 
+              for args in zip(dvec, obj_mult, constr_mult)]
+    assert ArrayDiff(batch, single) < 1e-12
+
+
+def test_parallel_evaluation(problem, seed):
+    dvec = np.random.randn(problem.ndec)
+    constr_mult = np.random.randn(problem.ncons)
+    serial = [problem.obj(dvec), problem.obj_grad(dvec),
+              problem.constr_jac_val(dvec), 
+              problem.lag_hess_val(dvec, 1.5, constr_mult)]
+    
+    problem.chunk_size = 1
+    with futures.ThreadPoolExecutor(2) as executor:
+        problem.executor = executor
+        parallel = [problem.obj(dvec), problem.obj_grad(dvec),
+                    problem.constr_jac_val(dvec), 
+                    problem.lag_hess_val(dvec, 1.5, constr_mult)]
+    problem.executor = None
+    problem.chunk_size = None
+    for a, b in zip(serial, parallel):
+        assert ArrayDiff(a, b) < 1e-12
+
+
+def test_chunked_evaluation(problem, seed):
+    dvec = np.random.randn(problem.ndec)
+    constr_mult = np.random.randn(problem.ncons)
+    names = ('obj', 'obj_grad', 'constr', 'constr_jac_val')
+    whole = [getattr(problem, name)(dvec) for name in names]
+    whole_hess = problem.lag_hess_val(dvec, 1.5, constr_mult)
+    
+    problem.chunk_size = 2
+    try:
+        for name, expected in zip(names, whole):
+            chunked = getattr(problem, name)(dvec)
+            assert ArrayDiff(chunked, expected) < 1e-12, name
+        chunked_hess = problem.lag_hess_val(dvec, 1.5, constr_mult)
+        assert ArrayDiff(chunked_hess, whole_hess) < 1e-12
+    finally:
+        problem.chunk_size = None
+
+
+def test_chunked_summed_hessian(seed):
+    npoints = 5
+    problem = optim.Problem()
+    problem.add_decision('x', (npoints, 2))
+    problem.add_decision('p', 2)
+    problem.add_objective(SummedHessianCost(), npoints)
+    dvec = np.random.randn(problem.ndec)
+    whole = [problem.obj_grad(dvec), problem.obj_hess_val(dvec)]
+    
+    problem.chunk_size = 2
+    chunked = [problem.obj_grad(dvec), problem.obj_hess_val(dvec)]
+    for a, b in zip(whole, chunked):
+        assert ArrayDiff(a, b) < 1e-12
+    H = full_hessian(problem)(dvec)
+    assert ArrayDiff(H, utils.central_diff(problem.obj_grad, dvec)) < 1e-7
+
+
+def test_chunked_constant(seed):
+    npoints = 4
+    w = np.arange(npoints, dtype=float)
+    
+    class ConstantProblem(optim.Problem):
+        def variables(self, dvec):
+            return {'w': w, **super().variables(dvec)}
+    
+    problem = ConstantProblem()
+    problem.add_decision('x', (npoints, 2))
+    problem.add_objective(ConstantWeightCost(), npoints)
+    dvec = np.random.randn(problem.ndec)
+    whole = [problem.obj(dvec), problem.obj_grad(dvec)]
+    
+    # The weights are not sliced, despite their length of one per point
+    problem.chunk_size = 2
+    obj = problem.objectives[0]
+    assert obj.chunked_variables(problem.variables(dvec)) == {'x'}
+    chunked = [problem.obj(dvec), problem.obj_grad(dvec)]
+    for a, b in zip(whole, chunked):
+        assert ArrayDiff(a, b) < 1e-12
+    
+    problem.ext_variables.add('w')
+    assert obj.chunked_variables(problem.variables(dvec)) == {'x', 'w'}
+
+
+def test_process_pool_evaluation(problem, seed):
+    dvec = np.random.randn(problem.ndec)
+    constr_mult = np.random.randn(problem.ncons)
+    names = ('obj', 'obj_grad', 'constr', 'constr_jac_val')
+    serial = [getattr(problem, name)(dvec) for name in names]
+    serial_hess = problem.lag_hess_val(dvec, 1.5, constr_mult)
+    serial_jac = problem.constr_jac(dvec).toarray()
+    serial_lag_hess = problem.lag_hess(dvec, 1.5, constr_mult).toarray()
+    
+    with parallel.ProcessPoolEvaluator(problem, 2, chunk_size=1) as evaluator:
+        assert evaluator.problem.sparsity is not problem.sparsity
+        problem.evaluator = evaluator
+        try:
+            for name, expected in zip(names, serial):
+                pooled = getattr(problem, name)(dvec)
+                assert ArrayDiff(pooled, expected) < 1e-12, name
+            pooled_hess = problem.lag_hess_val(dvec, 1.5, constr_mult)
+            assert ArrayDiff(pooled_hess, serial_hess) < 1e-12
+            pooled_jac = problem.constr_jac(dvec).toarray()
+            assert ArrayDiff(pooled_jac, serial_jac) < 1e-12
+            pooled_lag_hess = problem.lag_hess(dvec, 1.5, constr_mult)
+            pooled_lag_hess = pooled_lag_hess.toarray()
+            assert ArrayDiff(pooled_lag_hess, serial_lag_hess) < 1e-12
+            
+            # Without an output, the shared array is returned uncopied
+            shared = evaluator.evaluate('constr', dvec)
+            assert evaluator.evaluate('constr', dvec) is shared
+            assert ArrayDiff(shared, serial[names.index('constr')]) < 1e-12
+            
+            # The workers' tasks see the variables of each new point
+            dvec2 = dvec + 1
+            problem.evaluator = None
+            serial2 = [getattr(problem, name)(dvec2) for name in names]
+            problem.evaluator = evaluator
+            for name, expected in zip(names, serial2):
+                pooled = getattr(problem, name)(dvec2)
+                assert ArrayDiff(pooled, expected) < 1e-12, name
+        finally:
+            problem.evaluator = None
+
+
+def test_compile(problem, dec):
+    compiled = problem.compile()
+    assert isinstance(compiled, type(problem))
+    assert isinstance(compiled, optim.CompiledProblem)
+    assert compiled.compile() is compiled
+    for name in ('constr', 'constr_jac_val', 'obj_grad'):
+        expected = getattr(problem, name)(dec)
+        assert ArrayDiff(getattr(compiled, name)(dec), expected) < 1e-15
+    
+    with pytest.raises(TypeError):
+        compiled.add_decision('compiled_test_extra', 3)
+    with pytest.raises(AttributeError):
+        compiled.coalesce_hessian = True
+    
+    ndec = compiled.ndec
+    problem.add_decision('compiled_test_extra', 3)
+    assert compiled.ndec == ndec
+    assert 'compiled_test_extra' not in compiled.decision
+
+
+def test_compiled_copies(problem, dec):
+    compiled = problem.compile()
+    expected = compiled.constr_jac_val(dec)
+    copied = copy.deepcopy(compiled)
+    assert isinstance(copied, optim.CompiledProblem)
+    assert ArrayDiff(copied.constr_jac_val(dec), expected) < 1e-15
+    with pytest.raises(TypeError):
+        copied.add_decision('compiled_test_extra', 3)
+    
+    with parallel.ProcessPoolEvaluator(compiled, 2, chunk_size=1) as evaluator:
+        assert isinstance(evaluator.problem, optim.CompiledProblem)
+        compiled.evaluator = evaluator
+        try:
+            for name in ('obj', 'obj_grad', 'constr', 'constr_jac_val'):
+                pooled = getattr(compiled, name)(dec)
+                serial = getattr(problem, name)(dec)
+                assert ArrayDiff(pooled, serial) < 1e-12, name
+        finally:
+            compiled.evaluator = None
+
+
+def test_compiled_pickle(seed):
+    problem = optim.Problem()
+    problem.add_decision('a', (3, 2))
+    problem.add_decision('b', 4)
+    linkage = optim.Linkage((3, 2), [1, 4], (4,), [0, 3])
+    problem.add_constraint(linkage, 2, ['a', 'b'])
+    compiled = problem.compile()
+    
+    unpickled = pickle.loads(pickle.dumps(compiled))
+    assert type(unpickled) is type(compiled)
+    dec = np.random.randn(problem.ndec)
+    assert ArrayDiff(unpickled.constr(dec), compiled.constr(dec)) < 1e-15
+    with pytest.raises(TypeError):
+        unpickled.add_decision('compiled_test_extra', 3)
+
+
+def test_sparsity_report(problem, tmp_path):
+    report = problem.sparsity_report()
+    assert sum(b[-1] for b in report.jac_blocks) == problem.constr_jac_nnz
+    assert sum(b[-1] for b in report.hess_blocks) == problem.lag_hess_nnz
+    assert report.jac_nnz <= problem.constr_jac_nnz
+    assert report.kkt_nnz == report.jac_nnz + report.hess_nnz
+    assert str(report)
+    
+    kkt_size = problem.ndec + problem.ncons
+    report.save_mtx(tmp_path / 'kkt.mtx')
+    kkt = io.mmread(str(tmp_path / 'kkt.mtx'))
+    assert kkt.shape == (kkt_size, kkt_size)
+    
+    image = report.image('jac', max_size=8)
+    assert image.any() and max(image.shape) <= 8
+    report.save_image(tmp_path / 'jac.pbm', 'jac', max_size=8)
+    assert (tmp_path / 'jac.pbm').read_bytes().startswith(b'P4\n')
+
+
+@pytest.mark.parametrize('format', ['csr', 'csc'])
+@pytest.mark.parametrize('symmetric', [False, True])
+def test_sparse_assembly(format, symmetric, seed):
+    shape = (7, 7) if symmetric else (6, 9)
+    nnz = 40
+    row = np.random.randint(shape[0], size=nnz)
+    col = np.random.randint(shape[1], size=nnz)
+    val = np.random.randn(nnz)
+    A = sparse.coo_matrix((val, (row, col)), shape=shape).toarray()
+    if symmetric:
+        A += A.T - np.diag(np.diag(A))
+    
+    assembly = optim.SparseAssembly(row, col, shape, format, symmetric)
+    M = assembly(val)
+    assert M.format == format
+    assert ArrayDiff(M.toarray(), A) < 1e-12
+    
+    assert assembly(2 * val, out=M) is M
+    assert ArrayDiff(M.toarray(), 2 * A) < 1e-12
+
+
+def test_sparse_assembly_overflow():
+    # The triangle fits in int8 indices, but not the doubled entries
+    row, col = np.triu_indices(14, 1)
+    row, col = row[:100].astype(np.int8), col[:100].astype(np.int8)
+    optim.SparseAssembly(row, col, (14, 14))
+    with pytest.raises(OverflowError):
+        optim.SparseAssembly(row, col, (14, 14), symmetric=True)
+
+
+def point_values(x, *values):
+    """Stack values, broadcast to the points of `x`, along the last axis."""
+    shape = np.broadcast_shapes(np.shape(x)[:-1], *map(np.shape, values))
+    return np.stack([np.broadcast_to(v, shape) for v in values], axis=-1)
+
+
+class Model(metaclass=genoptim.optimization_meta):
+    """Optimization test model, written in the layout of generated models.
+    
+    Its functions are vectorized over the points of the state `x` and
+    broadcast over the parameters `p`.
+    """
+    
+    base_shapes = {'x': (2,), 'p': (2,)}
+    
+    constraints = {
+        'g': dict(shape=(2,),
+                  jac={('x',): 'dg_dx', ('p',): 'dg_dp'},
+                  hess={('x', 'x'): 'd2g_dx2', ('x', 'p'): 'd2g_dx_dp'}),
+    }
+    
+    objectives = {
+        'L': dict(grad={'x': 'dL_dx', 'p': 'dL_dp'},
+                  hess={('x', 'x'): 'd2L_dx2', ('x', 'p'): 'd2L_dx_dp',
+                        ('p', 'p'): 'd2L_dp2'}),
+    }
+    
+    def g(self, x, p):
+        """Constraints at each point."""
+        x1, x2, p1, p2 = x[..., 0], x[..., 1], p[..., 0], p[..., 1]
+        return point_values(x, x1 * x2 * p1, np.sin(x1) + p2 * x2 ** 2)
+    
+    dg_dx_ind = np.array([[0, 1, 0, 1], [0, 0, 1, 1]])
+    dg_dx_nnz = 4
+    
+    def dg_dx_val(self, x, p):
+        x1, x2, p1, p2 = x[..., 0], x[..., 1], p[..., 0], p[..., 1]
+        return point_values(x, x2 * p1, x1 * p1, np.cos(x1), 2 * p2 * x2)
+    
+    dg_dp_ind = np.array([[0, 1], [0, 1]])
+    dg_dp_nnz = 2
+    
+    def dg_dp_val(self, x, p):
+        x1, x2 = x[..., 0], x[..., 1]
+        return point_values(x, x1 * x2, x2 ** 2)
+    
+    d2g_dx2_ind = np.array([[0, 0, 1], [1, 0, 1], [0, 1, 1]])
+    d2g_dx2_nnz = 3
+    
+    def d2g_dx2_val(self, x, p):
+        x1, p1, p2 = x[..., 0], p[..., 0], p[..., 1]
+        return point_values(x, p1, -np.sin(x1), 2 * p2)
+    
+    d2g_dx_dp_ind = np.array([[0, 1, 1], [0, 0, 1], [0, 0, 1]])
+    d2g_dx_dp_nnz = 3
+    
+    def d2g_dx_dp_val(self, x, p):
+        x1, x2 = x[..., 0], x[..., 1]
+        return point_values(x, x2, x1, 2 * x2)
+    
+    def L(self, x, p):
+        """Cost of each point."""
+        x1, x2, p1, p2 = x[..., 0], x[..., 1], p[..., 0], p[..., 1]
+        return x1 ** 2 * p2 + np.exp(p1) * x2
+    
+    def dL_dx(self, x, p):
+        x1, p1, p2 = x[..., 0], p[..., 0], p[..., 1]
+        return point_values(x, 2 * x1 * p2, np.exp(p1))
+    
+    def dL_dp(self, x, p):
+        x1, x2, p1 = x[..., 0], x[..., 1], p[..., 0]
+        return point_values(x, np.exp(p1) * x2, x1 ** 2)
+    
+    d2L_dx2_ind = np.array([[0], [0], [0]])
+    d2L_dx2_nnz = 1
+    
+    def d2L_dx2_val(self, x, p):
+        return point_values(x, 2 * p[..., 1])
+    
+    d2L_dx_dp_ind = np.array([[0, 1], [1, 0], [0, 0]])
+    d2L_dx_dp_nnz = 2
+    
+    def d2L_dx_dp_val(self, x, p):
+        return point_values(x, 2 * x[..., 0], np.exp(p[..., 0]))
+    
+    d2L_dp2_ind = np.array([[0], [0], [0]])
+    d2L_dp2_nnz = 1
+    
+    def d2L_dp2_val(self, x, p):
+        return point_values(x, np.exp(p[..., 0]) * x[..., 1])
+
+
+class SummedHessianCost:
+    """Cost of each point, with its Hessian wrt the parameters summed.
+    
+    The nonzeros of its parameter Hessian are not laid out by point, unlike
+    those of the generated models.
+    """
+    
+    out_shape = ()
+    
+    base_shapes = {'x': (2,), 'p': (2,)}
+    
+    def __call__(self, x, p):
+        return x[..., 0] * p[..., 0] ** 2 + x[..., 1]
+    
+    def grad(self, x, p):
+        x_grad = point_values(x, p[..., 0] ** 2, 1)
+        p_grad = [np.sum(2 * x[..., 0] * p[..., 0], -1), 0]
+        return {'x': x_grad, 'p': np.array(p_grad)}
+    
+    def hess_nnz(self, var_shapes, out_shape):
+        return out_shape[0] + 1
+    
+    def hess_ind(self, var_shapes, out_shape):
+        x_ind = 2 * np.arange(out_shape[0])
+        return {('x', 'p'): np.array([x_ind, np.zeros_like(x_ind)]),
+                ('p', 'p'): np.array([[0], [0]])}
+    
+    def hess_val(self, x, p, out=None):
+        xp_val = point_values(x, 2 * p[..., 0])
+        pp_val = np.sum(2 * x[..., 0], -1, keepdims=True)
+        if out is None:
+            return {('x', 'p'): xp_val, ('p', 'p'): pp_val}
+        if isinstance(out, np.ndarray):
+            out = [out[..., :-1], out[..., -1:]]
+        out[0][...] = xp_val.reshape(out[0].shape)
+        out[1][...] = pp_val
+        return out
+
+
+class ConstantWeightCost:
+    """Cost of each point, scaled by the sum of a constant weight array."""
+    
+    out_shape = ()
+    
+    base_shapes = {'x': (2,)}
+    
+    def __call__(self, x, w):
+        return x[..., 0] * np.sum(w)
+    
+    def grad(self, x, w):
+        return {'x': point_values(x, np.sum(w), 0)}
+
+
+@pytest.fixture(params=[1, 3, 6], ids=lambda i: f'{i}point')
 def problem(request):
     """Optimization problem."""
-    raise NotImplementedError
+    npoints = request.param
+    model = Model()
+    problem = optim.Problem()
+    x = problem.add_decision('x', (npoints, 2))
+    problem.add_decision('p', 2)
+    problem.add_objective(model.L, npoints)
+    problem.add_constraint(model.g, (npoints, 2))
+    linkage = optim.Linkage(x.shape, 0, (2,), 1)
+    problem.add_constraint(linkage, 1, ['x', 'p'])
+    return problem
 
 
 @pytest.fixture(params=range(4), ids=lambda i: f'seed{i}')
@@ -0,0 +1,67 @@
+"""Runge--Kutta integration and collocation test module."""
+
+
+import numpy as np
+import pytest
+
+from ceacoest import rk
+
+
+from ceacoest.testsupport.array_cmp import ArrayDiff
+
+
+@pytest.fixture(params=[2, 3, 5, 20, 100], ids=lambda i: f'{i}ord-col')
+def collocation(request):
+    """LGL collocation method."""
+    return rk.LGLCollocation(request.param)
+
+
+def test_points(collocation):
+    points = collocation.points
+    assert points[0] == 0 and points[-1] == 1
+    assert np.all(np.diff(points) > 0)
+    assert ArrayDiff(points + points[::-1], 1) < 1e-14
+
+
+def test_interval_integrals(collocation):
+    # The interpolant of polynomials of degree n - 1 is exact
+    points = collocation.points
+    deg = collocation.n - 1
+    integ = np.diff(points ** (deg + 1)) / (deg + 1)
+    assert ArrayDiff(collocation.J @ points ** deg, integ) < 1e-13
+    assert ArrayDiff(collocation.J.sum(axis=0), collocation.K) < 1e-13
+
+
+def test_quadrature(collocation):
+    # Lobatto quadrature is exact for polynomials of degree 2n - 3
+    deg = 2 * collocation.n - 3
+    integ = collocation.K @ collocation.points ** deg
+    assert abs(integ - 1 / (deg + 1)) < 1e-14
+
+
+def test_differentiation(collocation):
+    points = collocation.points
+    deg = collocation.n - 1
+    deriv = deg * points ** (deg - 1)
+    assert ArrayDiff(collocation.D @ points ** deg, deriv) < 1e-11
+
+
+def test_interp_matrix(collocation):
+    n = collocation.n
+    assert ArrayDiff(collocation.interp_matrix(collocation.points),
+                     np.eye(n)) < 1e-15
+    s = np.linspace(0, 1, 7)
+    values = collocation.points ** (n - 1)
+    assert ArrayDiff(collocation.interp_matrix(s) @ values,
+                     s ** (n - 1)) < 1e-12
+
+
+@pytest.mark.parametrize('n', [200, 400])
+def test_barycentric_weights_scale(n):
+    # The unscaled weights overflow beyond a few hundred points
+    points = rk.lgl_points(n)
+    weights = rk.barycentric_weights(points)
+    assert np.all(np.isfinite(weights)) and np.max(np.abs(weights)) == 1
+    s = np.linspace(0, 1, 7)
+    interp = rk.lgl_collocation(n).interp_matrix(s) @ np.cos(3 * points)
+    assert ArrayDiff(interp, np.cos(3 * s)) < 1e-12
@@ -0,0 +1,99 @@
+"""Nonlinear programming solver tests."""
+
+
+import sys
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from ceacoest import solvers
+from ceacoest.testsupport.array_cmp import ArrayDiff
+
+
+class HS071:
+    """Hock--Schittkowski problem 71, with the optim.Problem interface."""
+    
+    ndec = 4
+    ncons = 2
+    d_bounds = np.array([[1, 1, 1, 1], [5, 5, 5, 5]], float)
+    constr_bounds = np.array([[25, 40], [np.inf, 40]], float)
+    dec0 = np.array([1, 5, 5, 1], float)
+    decopt = np.array([1, 4.74299963, 3.82114998, 1.37940829])
+    mult_g = np.array([-0.55229366, 0.16146857])
+    mult_x_L = np.array([1.08787122, 0, 0, 0])
+    
+    def obj(self, x):
+        return x[0] * x[3] * (x[0] + x[1] + x[2]) + x[2]
+    
+    def obj_grad(self, x):
+        return np.array([x[3] * (2 * x[0] + x[1] + x[2]), x[0] * x[3],
+                         x[0] * x[3] + 1, x[0] * (x[0] + x[1] + x[2])])
+    
+    def constr(self, x):
+        return np.array([np.prod(x), np.sum(x ** 2)])
+    
+    def constr_jac(self, x, format='csr'):
+        jac = [np.prod(x) / x, 2 * x]
+        return sparse.csr_matrix(np.array(jac)).asformat(format)
+    
+    def lag_hess(self, x, obj_mult, constr_mult, format='csr'):
+        obj_hess = np.array([[2 * x[3], x[3], x[3], 2 * x[0] + x[1] + x[2]],
+                             [x[3], 0, 0, x[0]],
+                             [x[3], 0, 0, x[0]],
+                             [2 * x[0] + x[1] + x[2], x[0], x[0], 0]])
+        prod_hess = np.prod(x) / np.outer(x, x)
+        np.fill_diagonal(prod_hess, 0)
+        hess = (obj_mult * obj_hess + constr_mult[0] * prod_hess
+                + constr_mult[1] * 2 * np.eye(4))
+        return sparse.csr_matrix(hess).asformat(format)
+
+
+@pytest.fixture(params=['ip', 'trust-constr', 'slsqp'])
+def solver(request):
+    """Name of the solver tested."""
+    return request.param
+
+
+def test_hs071(solver):
+    problem = HS071()
+    options = {'ip': {}, 'trust-constr': dict(gtol=1e-10, xtol=1e-12),
+               'slsqp': dict(ftol=1e-10)}[solver]
+    decopt, info = solvers.solve(problem, problem.dec0, problem.d_bounds,
+                                 problem.constr_bounds, solver, **options)
+    assert info['status'] == 0
+    assert ArrayDiff(decopt, problem.decopt) < 1e-5
+    assert ArrayDiff(info['mult_g'], problem.mult_g) < 1e-4
+    if solver == 'slsqp':
+        assert info['mult_x_L'] is None and info['mult_x_U'] is None
+    else:
+        assert ArrayDiff(info['mult_x_L'], problem.mult_x_L) < 1e-4
+        assert ArrayDiff(info['mult_x_U'], 0) < 1e-4
+
+
+def test_unknown_solver():
+    with pytest.raises(ValueError):
+        solvers.get('no-such-solver')
+
+
+def test_ip_fixed_variable():
+    problem = HS071()
+    d_bounds = problem.d_bounds.copy()
+    d_bounds[1, 0] = 1
+    decopt, info = solvers.solve(problem, problem.dec0, d_bounds, 
+                                 problem.constr_bounds, 'ip')
+    assert info['status'] == 0
+    assert ArrayDiff(decopt, problem.decopt) < 1e-5
+    assert info['mult_x_L'][0] > 0
+
+
+def test_benchmark_without_ipopt(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'mseipopt', None)
+    assert not solvers.SOLVERS['ipopt'].available()
+    problem = HS071()
+    results = solvers.benchmark(problem, problem.dec0, problem.d_bounds,
+                                problem.constr_bounds)
+    assert set(results) == set(solvers.SOLVERS) - {'ipopt'}
+    for name, (elapsed, (decopt, info)) in results.items():
+        assert elapsed >= 0
+        assert ArrayDiff(decopt, problem.decopt) < 1e-3, name
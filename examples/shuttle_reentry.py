@@ -19,6 +19,11 @@ from ceacoest.modelling import symoc
 class ShuttleReentry:
     """Shuttle Reentry maximum crossrange optimal control model."""
     
+    # To evaluate the values and sparse derivatives of the model functions
+    # together, sharing their common subexpressions, set
+    #     fused_derivatives = True
+    # and generate the model with `ceacoest.modelling.symoptim.compile_class`.
+    
     @sym2num.utils.classproperty
     @functools.lru_cache()
     def variables(cls):
@@ -21,6 +21,7 @@ setup(
     version="0.1.dev4",
     packages=find_packages(),
     install_requires=["attrdict", "numpy", "scipy", "sym2num"],
+    extras_require={"ipopt": ["mseipopt"]},
     tests_require=["pytest"],
     
     # metadata for upload to PyPI